@@ -205,7 +205,9 @@ export default {
             Properties: {
                 Enabled: 'True',
                 EventSourceArn:  cf.getAtt('PredTileQueue', 'Arn'),
-                FunctionName: cf.ref('PredLambdaFunction')
+                FunctionName: cf.ref('PredLambdaFunction'),
+                // Only the messages with unsaved chips are retried, see the lambda handler
+                FunctionResponseTypes: ['ReportBatchItemFailures']
             }
         },
         PredLambdaFunction: {
@@ -233,6 +235,14 @@ export default {
                         INF_SUPERTILE: cf.ref('InfSupertile'),
                         MODEL_TYPE: cf.ref('ModelType'),
                         IMAGERY_ID: cf.ref('ImageryId'),
+                        PREDICTION_CACHE: cf.join([
+                            's3://', cf.ref('StackName'), '-', cf.accountId, '-', cf.region,
+                            '/project/', cf.ref('ProjectId'), '/iteration/', cf.ref('IterationId'), '/prediction-cache/'
+                        ]),
+                        TILE_CACHE: cf.join([
+                            'sqlite:///tmp/tiles.db?max_size=268435456,',
+                            's3://', cf.ref('StackName'), '-', cf.accountId, '-', cf.region, '/tile-cache/'
+                        ]),
                         PREDICTION_ENDPOINT: cf.join([
                             'http://', cf.getAtt('PredELB', 'DNSName'), cf.findInMap('Models', cf.ref('ModelType'), 'Prediction')
                         ]),
@@ -96,6 +96,7 @@ export default async function router(schema, config) {
 
             const payload = {
                 fmt: imagery.fmt,
+                pack: req.body.pack || 1,
                 queue: `${process.env.StackName}-project-${req.params.pid}-iteration-${req.params.iterationid}-queue`
             };
 
@@ -102,7 +102,8 @@ export default {
                         { Name: 'AWS_ACCOUNT_ID', Value: cf.accountId },
                         { Name: 'AWS_REGION', Value: cf.region },
                         { Name: 'AWS_DEFAULT_REGION' , Value: cf.region },
-                        { Name: 'API_URL', Value: cf.join(['http://', cf.getAtt('MLEnablerELB', 'DNSName')]) }
+                        { Name: 'API_URL', Value: cf.join(['http://', cf.getAtt('MLEnablerELB', 'DNSName')]) },
+                        { Name: 'ASSET_BUCKET', Value: cf.ref('MLEnablerBucket') }
                     ],
                     Memory: 512,
                     Privileged: true,
@@ -162,7 +163,9 @@ export default {
                         { Name: 'BATCH_ECR' , Value: cf.ref('BatchECR') },
                         { Name: 'AWS_ACCOUNT_ID', Value: cf.accountId },
                         { Name: 'AWS_REGION', Value: cf.region },
-                        { Name: 'API_URL', Value: cf.join(['http://', cf.getAtt('MLEnablerELB', 'DNSName')]) }
+                        { Name: 'API_URL', Value: cf.join(['http://', cf.getAtt('MLEnablerELB', 'DNSName')]) },
+                        { Name: 'ASSET_BUCKET', Value: cf.ref('MLEnablerBucket') },
+                        { Name: 'TILE_CACHE', Value: cf.join(['s3://', cf.ref('MLEnablerBucket'), '/tile-cache/']) }
                     ],
                     Memory: 4000,
                     Privileged: true,
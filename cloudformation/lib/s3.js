@@ -5,7 +5,15 @@ export default {
         MLEnablerBucket: {
             Type: 'AWS::S3::Bucket',
             Properties: {
-                BucketName: cf.join('-', [cf.stackName, cf.accountId, cf.region])
+                BucketName: cf.join('-', [cf.stackName, cf.accountId, cf.region]),
+                LifecycleConfiguration: {
+                    Rules: [{
+                        Id: 'tile-cache',
+                        Prefix: 'tile-cache/',
+                        Status: 'Enabled',
+                        ExpirationInDays: 30
+                    }]
+                }
             }
         }
     }
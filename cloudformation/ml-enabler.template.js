@@ -431,6 +431,33 @@ const Resources = {
                         Resource: cf.join([
                             'arn:aws:firehose:', cf.region,':', cf.accountId, ':deliverystream/', cf.stackName, '-*'
                         ])
+                    },{
+                        Effect: 'Allow',
+                        Action: [
+                            's3:GetObject',
+                            's3:PutObject'
+                        ],
+                        Resource: [
+                            cf.join(['arn:aws:s3:::', cf.stackName, '-', cf.accountId, '-', cf.region, '/project/*/iteration/*/prediction-cache/*']),
+                            cf.join(['arn:aws:s3:::', cf.stackName, '-', cf.accountId, '-', cf.region, '/tile-cache/*'])
+                        ]
+                    },{
+                        // Without ListBucket a GET on a missing cache key or tile is a 403 rather than a 404
+                        Effect: 'Allow',
+                        Action: [
+                            's3:ListBucket'
+                        ],
+                        Resource: [
+                            cf.join(['arn:aws:s3:::', cf.stackName, '-', cf.accountId, '-', cf.region])
+                        ],
+                        Condition: {
+                            StringLike: {
+                                's3:prefix': [
+                                    'project/*/iteration/*/prediction-cache/*',
+                                    'tile-cache/*'
+                                ]
+                            }
+                        }
                     },{
                         Effect: 'Allow',
                         Action: [
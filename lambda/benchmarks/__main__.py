@@ -0,0 +1,153 @@
+"""
+Benchmark the prediction lambda handler against local stand-ins
+
+    python -m benchmarks --tiles 100 --runs 10 --tile-latency 20 --model-latency 50
+
+Every scenario runs in its own process so its peak RSS is not shared with the
+others, and reports the p50/p99 latency of an invocation, tiles/sec and peak RSS
+@author:Development Seed
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import contextlib
+import subprocess
+import mercantile
+import numpy as np
+
+SCENARIOS = {
+    'classification': { 'MODEL_TYPE': 'tensorflow', 'INF_TYPE': 'classification', 'INF_SUPERTILE': 'False' },
+    'detection': { 'MODEL_TYPE': 'tensorflow', 'INF_TYPE': 'detection', 'INF_SUPERTILE': 'False' },
+    'segmentation': { 'MODEL_TYPE': 'tensorflow', 'INF_TYPE': 'segmentation', 'INF_SUPERTILE': 'False' },
+    'supertile': { 'MODEL_TYPE': 'tensorflow', 'INF_TYPE': 'detection', 'INF_SUPERTILE': 'True' },
+    'pytorch-segmentation': { 'MODEL_TYPE': 'pytorch', 'INF_TYPE': 'segmentation', 'INF_SUPERTILE': 'False' }
+}
+
+def event(imagery: str, tiles: int, zoom: int = 18) -> dict:
+    """SQS event of `tiles` single chip messages laid out in rows of 64 tiles"""
+    origin = mercantile.tile(-77.03, 38.89, zoom)
+
+    records = []
+    for i in range(tiles):
+        x = origin.x + i % 64
+        y = origin.y + i // 64
+
+        records.append({ "body": json.dumps({
+            "submission": 1,
+            "name": "{}-{}-{}".format(x, y, zoom),
+            "url": imagery.format(x=x, y=y, z=zoom),
+            "bounds": list(mercantile.bounds(x, y, zoom)),
+            "x": x,
+            "y": y,
+            "z": zoom
+        }) })
+
+    return { "Records": records }
+
+def run(scenario: str, args) -> dict:
+    """Run a single scenario in this process"""
+    from benchmarks import servers
+
+    env = SCENARIOS[scenario]
+    os.environ.update(env)
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ['StackName'] = 'benchmark'
+    os.environ['INFERENCES'] = 'background,building'
+    os.environ['IMAGERY_CONCURRENCY'] = str(args.concurrency)
+    os.environ['PREDICTION_BATCH_SIZE'] = str(args.batch_size)
+
+    # Measure the handler itself, not the caches
+    os.environ.pop('PREDICTION_CACHE', None)
+    os.environ.pop('TILE_CACHE', None)
+
+    tiles = servers.tile_server(latency=args.tile_latency / 1000)
+
+    if env['MODEL_TYPE'] == 'pytorch':
+        os.environ['PREDICTION_ENDPOINT'] = servers.pt_server(latency=args.model_latency / 1000)
+    else:
+        os.environ['PREDICTION_ENDPOINT'] = servers.tf_server(env['INF_TYPE'], dtype=args.dtype, latency=args.model_latency / 1000)
+
+    from download_and_predict import chips
+    from download_and_predict.handler import handler
+
+    firehose = servers.StubFirehose()
+    chips.firehose = firehose
+
+    ev = event(tiles + '/{z}/{x}/{y}.png', args.tiles)
+
+    latencies = []
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        # Warm up sessions and the model metadata cache, as a warm lambda would have
+        handler(ev, {})
+
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            handler(ev, {})
+            latencies.append(time.perf_counter() - start)
+
+    latencies = np.array(latencies)
+
+    return {
+        "scenario": scenario,
+        "tiles": args.tiles,
+        "runs": args.runs,
+        "p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 1),
+        "p99_ms": round(float(np.percentile(latencies, 99)) * 1000, 1),
+        "tiles_per_sec": round(args.tiles / float(latencies.mean()), 1),
+        # ru_maxrss is in KiB on linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "records": firehose.records // (args.runs + 1),
+        "record_bytes": firehose.bytes // (args.runs + 1)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the prediction lambda handler against local stand-ins')
+    parser.add_argument('--scenario', action='append', choices=list(SCENARIOS.keys()), help='Scenario to run, may be repeated (default: all)')
+    parser.add_argument('--tiles', type=int, default=50, help='Tiles per invocation')
+    parser.add_argument('--runs', type=int, default=10, help='Timed invocations per scenario')
+    parser.add_argument('--tile-latency', type=float, default=0, help='Injected latency of each tile request (ms)')
+    parser.add_argument('--model-latency', type=float, default=0, help='Injected latency of each prediction request (ms)')
+    parser.add_argument('--concurrency', type=int, default=10, help='IMAGERY_CONCURRENCY')
+    parser.add_argument('--batch-size', type=int, default=10, help='PREDICTION_BATCH_SIZE')
+    parser.add_argument('--dtype', default='DT_STRING', choices=['DT_STRING', 'DT_UINT8', 'DT_FLOAT'], help='Input dtype of the TF model signature')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON lines')
+    parser.add_argument('--inline', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    scenarios = args.scenario or list(SCENARIOS.keys())
+
+    if args.inline:
+        print(json.dumps(run(scenarios[0], args)))
+        return
+
+    results = []
+    for scenario in scenarios:
+        argv = [a for a in sys.argv[1:] if a != '--json']
+        argv = [arg for i, arg in enumerate(argv) if arg != '--scenario' and (i == 0 or argv[i - 1] != '--scenario')]
+
+        out = subprocess.run(
+            [sys.executable, '-m', 'benchmarks', '--inline', '--scenario', scenario] + argv,
+            check=True,
+            stdout=subprocess.PIPE,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        )
+
+        result = json.loads(out.stdout.decode('utf-8').strip().splitlines()[-1])
+        results.append(result)
+
+        if args.json:
+            print(json.dumps(result))
+
+    if not args.json:
+        columns = ['scenario', 'p50_ms', 'p99_ms', 'tiles_per_sec', 'peak_rss_mb', 'records', 'record_bytes']
+        widths = [max(len(col), max(len(str(r[col])) for r in results)) for col in columns]
+
+        print('  '.join(col.ljust(w) for col, w in zip(columns, widths)))
+        for r in results:
+            print('  '.join(str(r[col]).ljust(w) for col, w in zip(columns, widths)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+"""
+Local stand-ins for the services the prediction lambda talks to
+@author:Development Seed
+"""
+import io
+import json
+import time
+import base64
+import threading
+import numpy as np
+
+from PIL import Image
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, Any
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    # Default backlog is too small for the concurrency of the handler
+    request_queue_size = 128
+
+    def start(self) -> str:
+        """Serve on a daemon thread and return the base url"""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, body: bytes, content_type: str = 'application/json', status: int = 200):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+
+def tile_server(latency: float = 0) -> str:
+    """
+    XYZ tile server returning a 256x256 PNG for /{z}/{x}/{y}(.png)
+
+    Tiles are coloured by their index so supertiles and decoding can be checked,
+    every request is delayed by `latency` seconds
+    """
+    cache: Dict[tuple, bytes] = {}
+
+    class TileHandler(Handler):
+        def do_GET(self):
+            time.sleep(latency)
+
+            z, x, y = [int(v) for v in self.path.split('?')[0].split('.')[0].strip('/').split('/')[-3:]]
+
+            tile = cache.get((z, x, y))
+            if tile is None:
+                buf = io.BytesIO()
+                Image.new('RGB', (256, 256), (x % 256, y % 256, z)).save(buf, 'PNG')
+                tile = cache[(z, x, y)] = buf.getvalue()
+
+            self.reply(tile, 'image/png')
+
+    return Server(('127.0.0.1', 0), TileHandler).start()
+
+
+def tf_server(inf_type: str, dtype: str = 'DT_STRING', size: int = 256, classes: int = 2, latency: float = 0, batch: int = -1) -> str:
+    """
+    TF Serving stand-in for a single model, returns the model endpoint url
+
+    GET  /v1/models/default           model version status
+    GET  /v1/models/default/metadata  signature with a `dtype` input
+    POST /v1/models/default:predict   random predictions of `inf_type` for each instance
+
+    Array inputs have a fixed batch dimension if `batch` is set, requests with any other
+    number of instances are rejected as TF Serving does
+    """
+    if dtype == 'DT_STRING':
+        dims = [{ "size": "-1" }]
+    else:
+        dims = [{ "size": str(batch) }, { "size": str(size) }, { "size": str(size) }, { "size": "3" }]
+
+    metadata = {
+        "model_spec": { "name": "default", "version": "1" },
+        "metadata": { "signature_def": { "signature_def": { "serving_default": {
+            "inputs": { "inputs": { "dtype": dtype, "tensor_shape": { "dim": dims } } },
+            "outputs": { "outputs": { "dtype": "DT_FLOAT" } }
+        } } } }
+    }
+
+    status = { "model_version_status": [{ "version": "1", "state": "AVAILABLE" }] }
+
+    rng = np.random.default_rng(0)
+
+    def predict(count: int) -> Any:
+        if inf_type == 'classification':
+            return rng.random((count, classes)).round(4).tolist()
+        elif inf_type == 'detection':
+            preds = []
+            for _ in range(count):
+                boxes = np.sort(rng.random((10, 4)).reshape(10, 2, 2), axis=1).reshape(10, 4)
+                preds.append({
+                    "num_detections": 10.0,
+                    "detection_scores": rng.random(10).round(4).tolist(),
+                    "detection_boxes": boxes.round(4).tolist(),
+                    "detection_classes": [1.0] * 10
+                })
+            return preds
+        elif inf_type == 'segmentation':
+            return rng.random((count, size, size, classes)).round(3).tolist()
+
+        raise Exception('Unknown inference type: {}'.format(inf_type))
+
+    class TFHandler(Handler):
+        def do_GET(self):
+            if self.path.endswith('/metadata'):
+                self.reply(json.dumps(metadata).encode('utf-8'))
+            else:
+                self.reply(json.dumps(status).encode('utf-8'))
+
+        def do_POST(self):
+            instances = json.loads(self.body())['instances']
+
+            if dtype != 'DT_STRING' and batch != -1 and len(instances) != batch:
+                error = { "error": "Expected a batch of {} instances, got {}".format(batch, len(instances)) }
+                return self.reply(json.dumps(error).encode('utf-8'), status=400)
+
+            time.sleep(latency)
+
+            self.reply(json.dumps({ "predictions": predict(len(instances)) }).encode('utf-8'))
+
+    return Server(('127.0.0.1', 0), TFHandler).start() + '/v1/models/default'
+
+
+def pt_server(size: int = 256, classes: int = 2, latency: float = 0, failures: int = 0) -> str:
+    """
+    TorchServe stand-in returning a random single band PNG class mask for each image posted to :predict
+
+    The first `failures` requests are answered with a 503, as TorchServe does while a worker is restarting
+    """
+    rng = np.random.default_rng(0)
+    lock = threading.Lock()
+    failed = [0]
+
+    class PTHandler(Handler):
+        def do_POST(self):
+            self.body()
+            time.sleep(latency)
+
+            with lock:
+                fail = failed[0] < failures
+                failed[0] += fail
+
+            if fail:
+                error = { "code": 503, "type": "ServiceUnavailableException", "message": "Model worker not ready" }
+                return self.reply(json.dumps(error).encode('utf-8'), status=503)
+
+            buf = io.BytesIO()
+            Image.fromarray(rng.integers(0, classes, (size, size), dtype=np.uint8)).save(buf, 'PNG')
+
+            self.reply(buf.getvalue(), 'image/png')
+
+    return Server(('127.0.0.1', 0), PTHandler).start() + '/predictions/default'
+
+
+class StubFirehose:
+    """Stand-in for the firehose client that only counts what would have been delivered"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.records = 0
+        self.bytes = 0
+
+    def put_record_batch(self, DeliveryStreamName, Records):
+        with self.lock:
+            self.calls += 1
+            self.records += len(Records)
+            self.bytes += sum(len(record['Data']) for record in Records)
+
+        return {
+            'FailedPutCount': 0,
+            'RequestResponses': [{ 'RecordId': str(i) } for i in range(len(Records))]
+        }
@@ -0,0 +1,514 @@
+"""
+Model serving backends, selected by name from a registry so the handler runs every
+model through the same prepare_batch -> predict -> postprocess steps
+@author:Development Seed
+"""
+import os
+import time
+import hashlib
+import requests
+import boto3
+import numpy as np
+
+from abc import ABC, abstractmethod
+from threading import Lock
+from urllib.parse import urlparse
+from typing import Dict, List, Optional, Tuple, Any
+
+from download_and_predict.chips import json_loads
+from download_and_predict.metrics import metrics
+from download_and_predict.tensorflow import TFDownloadAndPredict, TFModelMeta
+from download_and_predict.pytorch import PTDownloadAndPredict
+
+# NumPy dtype of each TF Serving dtype an image input or model output can have,
+# DT_BFLOAT16 has none and is converted by to_bfloat16 and from_bfloat16
+NP_DTYPES = {
+    'DT_FLOAT': np.float32,
+    'DT_HALF': np.float16,
+    'DT_DOUBLE': np.float64,
+    'DT_UINT8': np.uint8,
+    'DT_INT8': np.int8,
+    'DT_UINT16': np.uint16,
+    'DT_INT16': np.int16,
+    'DT_INT32': np.int32,
+    'DT_INT64': np.int64
+}
+
+def to_bfloat16(value: Any) -> np.ndarray:
+    """Round float values to bfloat16, returned as the uint16 bit patterns of a DT_BFLOAT16 tensor"""
+    bits = np.ascontiguousarray(value, dtype=np.float32).view(np.uint32)
+
+    # Round to nearest even on the 16 dropped mantissa bits
+    return ((bits + 0x7FFF + ((bits >> 16) & 1)) >> 16).astype(np.uint16)
+
+def from_bfloat16(bits: Any) -> np.ndarray:
+    """Widen the uint16 bit patterns of a DT_BFLOAT16 tensor to float32"""
+    return (np.asarray(bits, dtype=np.uint16).astype(np.uint32) << 16).view(np.float32)
+
+def instances(outputs: Dict[str, np.ndarray]) -> List[Dict[str, Any]]:
+    """Split named [batch, ...] output tensors into a dict per instance, as the TF Serving REST API returns them"""
+    count = len(next(iter(outputs.values())))
+
+    return [{ name: value[i].tolist() for name, value in outputs.items() } for i in range(count)]
+
+class Backend(ABC):
+    """
+    Runs micro-batches of (chip, image) pairs through a model
+
+    - prepare_batch: build the model input from the downloaded images
+    - predict: run the model, returning its raw output
+    - postprocess: turn the raw output into the prediction records of each chip
+
+    Backends are registered by name and selected by MODEL_TYPE, or PREDICTION_BACKEND
+    to use another backend for the same model:
+
+    - tensorflow: TF Serving REST API
+    - tensorflow-grpc: TF Serving gRPC API
+    - pytorch: TorchServe
+    - onnx: ONNX Runtime on the lambda CPU, without a serving container
+
+    batch_size and concurrency are the micro-batch size and the number of concurrent
+    predictions a backend works best with, PREDICTION_BATCH_SIZE and PREDICTION_CONCURRENCY
+    override them. max_batch_size is set once the model only accepts a fixed number of
+    instances per request, shorter micro-batches are then padded with zero images
+    """
+
+    backends: Dict[str, Any] = {}
+
+    # Inference types the backend can post-process
+    inf_types: Tuple[str, ...] = ()
+
+    batch_size = 10
+    concurrency = 2
+    max_batch_size: Optional[int] = None
+
+    def __init__(self, endpoint: str, inf_type: str, fmt: str = 'png', inferences: Optional[List[str]] = None, **options: Any):
+        self.endpoint = endpoint
+        self.inf_type = inf_type
+        self.fmt = fmt
+        self.inferences = inferences
+        self.options = options
+
+    @staticmethod
+    def register(name: str):
+        def decorator(cls):
+            Backend.backends[name] = cls
+            return cls
+
+        return decorator
+
+    @staticmethod
+    def create(name: str, endpoint: str, inf_type: str, **options: Any) -> 'Backend':
+        """Return the named backend, raising for unknown backends or unsupported inference types"""
+        backend = Backend.backends.get(name)
+        if backend is None:
+            raise Exception('Unsupported prediction backend: {}'.format(name))
+
+        if inf_type not in backend.inf_types:
+            raise Exception('Unsupported INF_TYPE for the {} backend: {}'.format(name, inf_type))
+
+        return backend(endpoint, inf_type, **options)
+
+    @property
+    def version(self) -> Optional[str]:
+        """Version of the served model, used to invalidate cached predictions"""
+        return None
+
+    @property
+    def array_input(self) -> bool:
+        """Whether supertiles are passed to prepare_batch as decoded arrays instead of JPEG bytes"""
+        return False
+
+    def allow_empty(self) -> bool:
+        """Whether a chip without predictions is a valid result, rather than a failed request, that may be cached"""
+        return self.inf_type == 'detection' or self.fmt == 'vector'
+
+    @abstractmethod
+    def prepare_batch(self, t_i: List[Tuple[dict, Any]]) -> Any:
+        pass
+
+    @abstractmethod
+    def predict(self, payload: Any) -> Any:
+        pass
+
+    @abstractmethod
+    def postprocess(self, chips: List[dict], output: Any) -> List[dict]:
+        pass
+
+    def __call__(self, t_i: List[Tuple[dict, Any]]) -> List[dict]:
+        chips = [chip for chip, image in t_i]
+
+        return self.postprocess(chips, self.predict(self.prepare_batch(t_i)))
+
+
+@Backend.register('tensorflow')
+class TFRestBackend(Backend):
+    """TF Serving REST API, images are sent with the cheapest encoding the model signature accepts"""
+
+    inf_types = ('classification', 'detection', 'segmentation')
+
+    def __init__(self, endpoint: str, inf_type: str, **options: Any):
+        super(TFRestBackend, self).__init__(endpoint, inf_type, **options)
+
+        if inf_type == 'classification':
+            assert(self.inferences)
+
+        self.dap = TFDownloadAndPredict(prediction_endpoint=endpoint)
+        self.load_meta()
+
+        # a fixed batch dimension caps the instances of a single request
+        self.max_batch_size = self.dap.meta.batch
+
+    def load_meta(self):
+        self.dap.get_meta(self.inf_type, ttl=self.options.get('meta_ttl', 300))
+
+    @property
+    def version(self) -> Optional[str]:
+        return self.dap.meta.version
+
+    @property
+    def array_input(self) -> bool:
+        return self.dap.meta.array_input
+
+    def padding(self, count: int) -> int:
+        """Number of zero images completing a micro-batch of `count` chips to the fixed batch size"""
+        if self.max_batch_size is None:
+            return 0
+
+        return max(self.max_batch_size - count, 0)
+
+    def prepare_batch(self, t_i: List[Tuple[dict, Any]]) -> Any:
+        return self.dap.get_prediction_payload(t_i, self.padding(len(t_i)))
+
+    def predict(self, payload: Any) -> Any:
+        try:
+            r = self.dap.post(payload)
+        except requests.exceptions.HTTPError as e:
+            print (e.response.text)
+            raise
+
+        return json_loads(r.content)["predictions"]
+
+    def predictions(self, outputs: Dict[str, np.ndarray]) -> Any:
+        """Shape the named output arrays of a model as the REST API returns its predictions"""
+        if self.inf_type == 'detection':
+            return instances(outputs)
+
+        output = outputs[self.dap.meta.output_name]
+
+        if self.inf_type == 'classification':
+            return output.tolist()
+
+        return output
+
+    def postprocess(self, chips: List[dict], output: Any) -> List[dict]:
+        if self.inf_type == 'classification':
+            return self.dap.cl_postprocess(output, chips, self.inferences)
+        elif self.inf_type == 'detection':
+            return self.dap.od_postprocess(output, chips)
+
+        return self.dap.seg_postprocess(output, chips, self.fmt, self.inferences)
+
+    def __call__(self, t_i: List[Tuple[dict, Any]]) -> List[dict]:
+        chips = [chip for chip, image in t_i]
+
+        # Predictions of the zero images padding the batch are dropped
+        return self.postprocess(chips, self.predict(self.prepare_batch(t_i))[:len(chips)])
+
+
+@Backend.register('tensorflow-grpc')
+class TFGrpcBackend(TFRestBackend):
+    """
+    TF Serving gRPC API at PREDICTION_GRPC_ENDPOINT (host:8500)
+
+    Images and outputs are sent as binary tensors instead of JSON, image bytes of
+    DT_STRING models are sent without base64 encoding. The model signature is still
+    read from the REST API at PREDICTION_ENDPOINT
+
+    Requests are built from the vendored protos/predict.proto messages so only grpcio
+    and protobuf are needed, not the tensorflow and tensorflow-serving-api packages
+    """
+
+    concurrency = 4
+
+    def __init__(self, endpoint: str, inf_type: str, **options: Any):
+        super(TFGrpcBackend, self).__init__(endpoint, inf_type, **options)
+
+        try:
+            import grpc
+            from download_and_predict.protos import predict_pb2
+        except ImportError:
+            raise Exception('The tensorflow-grpc backend needs the grpcio and protobuf packages')
+
+        target = options.get('grpc_endpoint')
+        if not target:
+            raise Exception('The tensorflow-grpc backend needs PREDICTION_GRPC_ENDPOINT')
+
+        self.pb2 = predict_pb2
+
+        # /v1/models/{name} or /v1/models/{name}/versions/{version}
+        path = urlparse(endpoint).path.strip('/').split('/')
+        self.model_name = path[2] if len(path) > 2 else 'default'
+        self.model_version = path[4] if len(path) > 4 else None
+
+        self.timeout = options.get('timeout', 60)
+        channel = grpc.insecure_channel(target, options=[
+            ('grpc.max_send_message_length', -1),
+            ('grpc.max_receive_message_length', -1)
+        ])
+        # Requests are serialized while timing the encode stage, the stub sends the bytes as is
+        self.stub = channel.unary_unary(
+            '/tensorflow.serving.PredictionService/Predict',
+            response_deserializer=predict_pb2.PredictResponse.FromString
+        )
+
+    def prepare_batch(self, t_i: List[Tuple[dict, Any]]) -> Any:
+        tile_indices, images = zip(*t_i)
+
+        if self.dap.meta.array_input:
+            return self.dap.listencode_images(images, self.padding(len(images)))
+
+        return list(images)
+
+    def tensor(self, value: Any) -> Any:
+        """TensorProto of a batch of image bytes or an image array of the model input dtype"""
+        dtype = self.dap.meta.signature.input.dtype
+
+        if dtype == 'DT_STRING':
+            proto = self.pb2.TensorProto(dtype=self.pb2.DT_STRING)
+            proto.tensor_shape.dim.add(size=len(value))
+            proto.string_val.extend(value)
+
+            return proto
+
+        if dtype == 'DT_BFLOAT16':
+            value = to_bfloat16(value)
+        else:
+            value = np.ascontiguousarray(value, dtype=NP_DTYPES[dtype])
+
+        proto = self.pb2.TensorProto(dtype=self.pb2.DataType.Value(dtype))
+        for size in value.shape:
+            proto.tensor_shape.dim.add(size=size)
+        proto.tensor_content = value.tobytes()
+
+        return proto
+
+    def ndarray(self, proto: Any) -> np.ndarray:
+        """Decode an output TensorProto"""
+        shape = [dim.size for dim in proto.tensor_shape.dim]
+
+        if proto.dtype == self.pb2.DT_BFLOAT16:
+            if len(proto.tensor_content) > 0:
+                values = from_bfloat16(np.frombuffer(proto.tensor_content, dtype=np.uint16))
+            else:
+                values = from_bfloat16(proto.half_val)
+        elif len(proto.tensor_content) > 0:
+            return np.frombuffer(proto.tensor_content, dtype=NP_DTYPES[self.pb2.DataType.Name(proto.dtype)]).reshape(shape)
+        elif proto.dtype == self.pb2.DT_HALF:
+            values = np.array(proto.half_val, dtype=np.uint16).view(np.float16)
+        else:
+            values = np.array(
+                proto.float_val or proto.double_val or proto.int64_val or proto.int_val,
+                dtype=NP_DTYPES[self.pb2.DataType.Name(proto.dtype)]
+            )
+
+        # Tensors of a single repeated value only hold it once
+        if values.size == 1 and int(np.prod(shape)) != 1:
+            return np.full(shape, values[0], dtype=values.dtype)
+
+        return values.reshape(shape)
+
+    def predict(self, payload: Any) -> Any:
+        request = self.pb2.PredictRequest()
+        request.model_spec.name = self.model_name
+        request.model_spec.signature_name = 'serving_default'
+        if self.model_version is not None:
+            request.model_spec.version.value = int(self.model_version)
+
+        with metrics.timer('encode') as timer:
+            request.inputs[self.dap.meta.input_name].CopyFrom(self.tensor(payload))
+            data = request.SerializeToString()
+            timer.bytes = len(data)
+
+        with metrics.timer('predict') as timer:
+            response = self.stub(data, timeout=self.timeout)
+            timer.bytes = len(data) + response.ByteSize()
+
+        outputs = { name: self.ndarray(proto) for name, proto in response.outputs.items() }
+
+        return self.predictions(outputs)
+
+
+@Backend.register('pytorch')
+class TorchServeBackend(Backend):
+    """TorchServe, every image is posted as is in its own request"""
+
+    inf_types = ('segmentation', )
+
+    def __init__(self, endpoint: str, inf_type: str, **options: Any):
+        super(TorchServeBackend, self).__init__(endpoint, inf_type, **options)
+
+        self.dap = PTDownloadAndPredict(prediction_endpoint=endpoint)
+        self.dap.get_meta(inf_type)
+
+    def prepare_batch(self, t_i: List[Tuple[dict, Any]]) -> Any:
+        return self.dap.get_prediction_payloads(t_i)
+
+    def predict(self, payload: Any) -> Any:
+        # Every request of the micro-batch is sent at once for the server side batcher
+        return self.dap.post(payload, len(payload), self.options.get('retries', 3))
+
+    def postprocess(self, chips: List[dict], output: Any) -> List[dict]:
+        return self.dap.seg_postprocess(output, chips, self.fmt, self.inferences)
+
+
+# ONNX Runtime sessions and the sha256 of their model are kept across warm invocations, keyed by model url
+onnx_sessions: Dict[str, Dict[str, Any]] = {}
+onnx_lock = Lock()
+
+# TF Serving dtype of each ONNX tensor type
+ONNX_DTYPES = {
+    'tensor(float)': 'DT_FLOAT',
+    'tensor(float16)': 'DT_HALF',
+    'tensor(double)': 'DT_DOUBLE',
+    'tensor(uint8)': 'DT_UINT8',
+    'tensor(int8)': 'DT_INT8',
+    'tensor(uint16)': 'DT_UINT16',
+    'tensor(int16)': 'DT_INT16',
+    'tensor(int32)': 'DT_INT32',
+    'tensor(int64)': 'DT_INT64'
+}
+
+@Backend.register('onnx')
+class ONNXBackend(TFRestBackend):
+    """
+    ONNX Runtime on the lambda CPU, skipping the network hop to a serving container
+
+    PREDICTION_ENDPOINT is the path or s3:// url of the .onnx model, downloaded to /tmp
+    and reloaded once the model at the url changes. Its input is described as a TF Serving signature so images are
+    preprocessed and outputs post-processed as they are for TF Serving, channels first
+    (NCHW) models get their input and [batch, classes, height, width] output transposed.
+    Needs the onnxruntime package
+    """
+
+    batch_size = 4
+
+    # Each prediction already runs on every vCPU
+    concurrency = 1
+
+    def load_meta(self):
+        self.session, self.digest = ONNXBackend.get_session(self.endpoint, ttl=self.options.get('meta_ttl', 300))
+
+        model_input = self.session.get_inputs()[0]
+        outputs = self.session.get_outputs()
+
+        # A [batch, 1|3|4, height, width] input with more than 4 columns is channels first
+        shape = model_input.shape
+        self.channels_first = len(shape) == 4 and shape[1] in (1, 3, 4) and shape[3] not in (1, 3, 4)
+
+        def signature(tensor) -> Dict[str, Any]:
+            dims = [dim if isinstance(dim, int) else -1 for dim in tensor.shape]
+            if self.channels_first and len(dims) == 4:
+                dims = [dims[0], dims[2], dims[3], dims[1]]
+
+            return {
+                "dtype": ONNX_DTYPES.get(tensor.type, 'DT_INVALID'),
+                "tensor_shape": { "dim": [{ "size": str(dim) } for dim in dims] }
+            }
+
+        self.dap.meta = TFModelMeta({
+            "metadata": { "signature_def": { "signature_def": { "serving_default": {
+                "inputs": { model_input.name: signature(model_input) },
+                "outputs": { output.name: signature(output) for output in outputs }
+            } } } }
+        }, self.inf_type)
+
+        if not self.dap.meta.array_input:
+            raise Exception('Unsupported ONNX model input type: {}'.format(model_input.type))
+
+        self.input_dtype = NP_DTYPES[self.dap.meta.signature.input.dtype]
+        self.output_names = [output.name for output in outputs]
+
+    @staticmethod
+    def get_tag(url: str) -> str:
+        """Return a cheap version tag of the model at url, the ETag on S3 or the mtime and size of a local file"""
+        parsed = urlparse(url)
+        if parsed.scheme == 's3':
+            return boto3.client('s3').head_object(Bucket=parsed.netloc, Key=parsed.path.lstrip('/'))['ETag']
+
+        stat = os.stat(url)
+        return '{}-{}'.format(stat.st_mtime_ns, stat.st_size)
+
+    @staticmethod
+    def get_session(url: str, ttl: float = 300) -> Tuple[Any, str]:
+        """
+        Return the inference session and sha256 of the model at url, downloading it on first use
+        Once the session is older than ttl seconds it is only reused if the model is unchanged
+        """
+        with onnx_lock:
+            cached = onnx_sessions.get(url)
+            now = time.monotonic()
+
+            if cached is not None and now < cached['expires']:
+                return cached['session'], cached['digest']
+
+            tag = ONNXBackend.get_tag(url)
+
+            if cached is not None and cached['tag'] == tag:
+                cached['expires'] = now + ttl
+                return cached['session'], cached['digest']
+
+            try:
+                import onnxruntime
+            except ImportError:
+                raise Exception('The onnx backend needs the onnxruntime package')
+
+            path = url
+            parsed = urlparse(url)
+            if parsed.scheme == 's3':
+                path = os.path.join('/tmp', hashlib.sha256((url + tag).encode('utf-8')).hexdigest() + '.onnx')
+
+                if not os.path.exists(path):
+                    boto3.client('s3').download_file(parsed.netloc, parsed.path.lstrip('/'), path)
+
+            with open(path, 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+
+            session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+            onnx_sessions[url] = {
+                'session': session,
+                'digest': digest,
+                'tag': tag,
+                'expires': now + ttl
+            }
+
+            return session, digest
+
+    @property
+    def version(self) -> Optional[str]:
+        # Models replaced at the same url invalidate cached predictions as well
+        return self.digest
+
+    def prepare_batch(self, t_i: List[Tuple[dict, Any]]) -> Any:
+        tile_indices, images = zip(*t_i)
+
+        batch = self.dap.listencode_images(images, self.padding(len(images))).astype(self.input_dtype, copy=False)
+
+        if self.channels_first:
+            batch = np.ascontiguousarray(batch.transpose(0, 3, 1, 2))
+
+        return batch
+
+    def predict(self, payload: Any) -> Any:
+        with metrics.timer('predict') as timer:
+            timer.bytes = payload.nbytes
+
+            outputs = dict(zip(self.output_names, self.session.run(None, {
+                self.dap.meta.input_name: payload
+            })))
+
+        output = outputs[self.dap.meta.output_name]
+        if self.channels_first and output.ndim == 4:
+            outputs[self.dap.meta.output_name] = output.transpose(0, 2, 3, 1)
+
+        return self.predictions(outputs)
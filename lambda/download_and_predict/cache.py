@@ -0,0 +1,244 @@
+"""
+Tile level prediction cache, so tiles inferred by an earlier submission with the
+same model version and imagery are not downloaded or predicted again
+@author:Development Seed
+"""
+import json
+import sqlite3
+import hashlib
+import mercantile
+import boto3
+
+from abc import ABC, abstractmethod
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from threading import Lock
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Any, Iterable, Tuple
+
+# Error codes of a GET on a missing key, S3 answers 403 rather than 404 without s3:ListBucket
+MISSING_CODES = ('NoSuchKey', 'NotFound', '404', 'AccessDenied', '403')
+
+class PredictionCache(ABC):
+    """
+    Content addressed store of the predictions made for a single tile
+
+    Entries are keyed by the hash of (model version, imagery id, quadkey, supertile)
+    and hold the list of prediction bodies of the tile, which is empty for a tile
+    without detections. Backends implement get_many and put_many and are selected by
+    the scheme of the PREDICTION_CACHE url. The cache is best effort, a failing backend
+    only costs predicting the tiles again:
+
+    - sqlite:///tmp/predictions.db
+    - s3://bucket/prefix/
+    """
+
+    backends: Dict[str, Any] = {}
+
+    def __init__(self, version: str, imagery: str, supertile: bool):
+        self.version = str(version)
+        self.imagery = str(imagery)
+        self.supertile = bool(supertile)
+
+    @staticmethod
+    def register(scheme: str):
+        def decorator(cls):
+            PredictionCache.backends[scheme] = cls
+            return cls
+
+        return decorator
+
+    @staticmethod
+    def from_url(url: Optional[str], version: str, imagery: str, supertile: bool) -> Optional['PredictionCache']:
+        """Return the cache backend for the given url, or None if caching is disabled"""
+        if not url:
+            return None
+
+        parsed = urlparse(url)
+        backend = PredictionCache.backends.get(parsed.scheme)
+        if backend is None:
+            raise Exception('Unsupported PREDICTION_CACHE scheme: {}'.format(parsed.scheme))
+
+        return backend(parsed, version, imagery, supertile)
+
+    @staticmethod
+    def quadkey(chip: dict) -> Optional[str]:
+        """Return the quadkey of a chip, None for chips that are not XYZ tiles"""
+        if chip.get('x') is None or chip.get('y') is None or chip.get('z') is None:
+            return None
+
+        return mercantile.quadkey(chip.get('x'), chip.get('y'), chip.get('z'))
+
+    def key(self, quadkey: str) -> str:
+        return hashlib.sha256('\n'.join([
+            self.version,
+            self.imagery,
+            quadkey,
+            str(self.supertile)
+        ]).encode('utf-8')).hexdigest()
+
+    def lookup(self, chips: List[dict]) -> Tuple[List[dict], List[dict]]:
+        """
+        Split chips into the cached predictions and the chips that still need to be predicted
+        Cached predictions are attributed to the submission of the chip they are reused for
+        """
+        keys = {}
+        for chip in chips:
+            quadkey = PredictionCache.quadkey(chip)
+            if quadkey is not None:
+                keys[quadkey] = self.key(quadkey)
+
+        hits: Dict[str, List[dict]] = {}
+        if len(keys) > 0:
+            try:
+                hits = self.get_many(list(set(keys.values())))
+            except Exception as e:
+                print('CACHE: lookup failed: {}'.format(e))
+
+        preds = []
+        misses = []
+        for chip in chips:
+            key = keys.get(PredictionCache.quadkey(chip))
+
+            if key is None or key not in hits:
+                misses.append(chip)
+                continue
+
+            for pred in hits[key]:
+                pred['submission_id'] = chip.get('submission')
+                preds.append(pred)
+
+        print('CACHE: {} hits, {} misses'.format(len(chips) - len(misses), len(misses)))
+
+        return preds, misses
+
+    def store(self, chips: List[dict], preds: List[dict], allow_empty: bool = False):
+        """
+        Store the predictions of each predicted tile
+
+        Tiles without any prediction are only stored if allow_empty is set, ie for
+        detection where no detections is a valid result rather than a failed request
+        """
+        by_quadkey: Dict[str, List[dict]] = {}
+        for chip in chips:
+            quadkey = PredictionCache.quadkey(chip)
+            if quadkey is not None:
+                by_quadkey[quadkey] = []
+
+        for pred in preds:
+            quadkey = pred.get('quadkey') or PredictionCache.quadkey(pred)
+            if quadkey in by_quadkey:
+                by_quadkey[quadkey].append(pred)
+
+        if not allow_empty:
+            by_quadkey = { quadkey: tile_preds for quadkey, tile_preds in by_quadkey.items() if len(tile_preds) > 0 }
+
+        if len(by_quadkey) == 0:
+            return
+
+        try:
+            self.put_many([(self.key(quadkey), tile_preds) for quadkey, tile_preds in by_quadkey.items()])
+        except Exception as e:
+            print('CACHE: store failed: {}'.format(e))
+
+    @abstractmethod
+    def get_many(self, keys: List[str]) -> Dict[str, List[dict]]:
+        pass
+
+    @abstractmethod
+    def put_many(self, items: Iterable[Tuple[str, List[dict]]]):
+        pass
+
+
+@PredictionCache.register('sqlite')
+class SQLiteCache(PredictionCache):
+    """Single file cache, for local runs and tests"""
+
+    # Connections are kept across warm invocations, one per database file
+    connections: Dict[str, sqlite3.Connection] = {}
+    lock = Lock()
+
+    def __init__(self, url, version: str, imagery: str, supertile: bool):
+        super(SQLiteCache, self).__init__(version, imagery, supertile)
+
+        self.path = url.netloc + url.path
+
+        with SQLiteCache.lock:
+            self.db = SQLiteCache.connections.get(self.path)
+
+            if self.db is None:
+                self.db = sqlite3.connect(self.path, check_same_thread=False)
+                self.db.execute('CREATE TABLE IF NOT EXISTS predictions (key TEXT PRIMARY KEY, preds TEXT NOT NULL)')
+                SQLiteCache.connections[self.path] = self.db
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[dict]]:
+        found = {}
+
+        # Stay below the default limit of 999 bound parameters
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+
+            with SQLiteCache.lock:
+                rows = self.db.execute(
+                    'SELECT key, preds FROM predictions WHERE key IN ({})'.format(','.join('?' * len(batch))),
+                    batch
+                ).fetchall()
+
+            for key, preds in rows:
+                found[key] = json.loads(preds)
+
+        return found
+
+    def put_many(self, items: Iterable[Tuple[str, List[dict]]]):
+        with SQLiteCache.lock, self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO predictions (key, preds) VALUES (?, ?)',
+                [(key, json.dumps(preds)) for key, preds in items]
+            )
+
+
+@PredictionCache.register('s3')
+class S3Cache(PredictionCache):
+    """One JSON object per tile under the given bucket prefix"""
+
+    def __init__(self, url, version: str, imagery: str, supertile: bool, concurrency: int = 16):
+        super(S3Cache, self).__init__(version, imagery, supertile)
+
+        self.bucket = url.netloc
+        self.prefix = url.path.lstrip('/')
+        if len(self.prefix) > 0 and not self.prefix.endswith('/'):
+            self.prefix += '/'
+
+        self.concurrency = concurrency
+        self.s3 = boto3.client('s3', config=Config(max_pool_connections=concurrency))
+
+    def get(self, key: str) -> Optional[List[dict]]:
+        try:
+            obj = self.s3.get_object(Bucket=self.bucket, Key=self.prefix + key + '.json')
+            return json.loads(obj['Body'].read())
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in MISSING_CODES:
+                return None
+
+            raise
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[dict]]:
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            found = pool.map(self.get, keys)
+
+        return { key: preds for key, preds in zip(keys, found) if preds is not None }
+
+    def put(self, item: Tuple[str, List[dict]]):
+        key, preds = item
+
+        self.s3.put_object(
+            Bucket=self.bucket,
+            Key=self.prefix + key + '.json',
+            Body=json.dumps(preds).encode('utf-8'),
+            ContentType='application/json'
+        )
+
+    def put_many(self, items: Iterable[Tuple[str, List[dict]]]):
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            list(pool.map(self.put, items))
@@ -4,6 +4,7 @@ to a remote ML serving image, and saving them
 @author:Development Seed
 """
 import json
+import time
 import base64
 import affine
 import geojson
@@ -30,78 +31,295 @@ import mercantile
 from mercantile import children
 import numpy as np
 from base64 import b64encode
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from botocore.config import Config
 
 from download_and_predict.custom_types import SQSEvent
+from download_and_predict.tilecache import TileCache
+from download_and_predict.metrics import metrics
 
-firehose = boto3.client('firehose')
+# orjson encodes NumPy arrays natively and parses large nested lists several times
+# faster than the standard library, it is in requirements.txt and the standard library
+# is only a fallback for local runs without it
+try:
+    import orjson
+
+    json_loads = orjson.loads
+
+    def json_dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+except ImportError:
+    json_loads = json.loads
+
+    def json_default(o: np.ndarray) -> list:
+        # float32 arrays only hold normalized pixel values, written with 6 decimals instead of
+        # the digits of their float64 widening
+        if o.dtype == np.float32:
+            wide = o.astype(np.float64)
+            return np.round(wide, 6, out=wide).tolist()
+
+        return o.tolist()
+
+    def json_dumps(obj: Any) -> bytes:
+        return json.dumps(obj, default=json_default).encode('utf-8')
+
+# Throttled calls are retried by botocore, records rejected by a successful call by Chips.put_records
+firehose = boto3.client('firehose', config=Config(
+    max_pool_connections=10,
+    retries={ 'max_attempts': 5, 'mode': 'standard' }
+))
+
+# PutRecordBatch limits
+FIREHOSE_MAX_RECORDS = 500
+FIREHOSE_MAX_BATCH_BYTES = 4 * 1024 * 1024
+FIREHOSE_MAX_RECORD_BYTES = 1000 * 1024
+
+# Keep-alive sessions are shared across warm invocations, one per imagery host
+sessions: Dict[str, requests.Session] = {}
+sessions_lock = Lock()
+
+def get_session(url: str, concurrency: int = 10) -> requests.Session:
+    """Return the pooled session for the host serving the given url"""
+    host = urlparse(url).netloc
+
+    with sessions_lock:
+        session = sessions.get(host)
+
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+
+            sessions[host] = session
+
+    return session
+
+# Child tiles of supertiles are fetched on their own pool, get_super_image already runs
+# on a worker of the pipeline pool and would deadlock waiting on tasks queued behind it
+child_pools: Dict[int, ThreadPoolExecutor] = {}
+
+def get_child_pool(concurrency: int = 10) -> ThreadPoolExecutor:
+    """Return the pool fetching the 4 child tiles of `concurrency` supertiles at once"""
+    with sessions_lock:
+        pool = child_pools.get(concurrency)
+
+        if pool is None:
+            pool = child_pools[concurrency] = ThreadPoolExecutor(max_workers=4 * concurrency)
+
+    return pool
 
 class Chips:
     @staticmethod
-    def save(payload, stream):
-        firehose.put_record_batch(
-            DeliveryStreamName=stream,
-            Records=[{
-                "Data": json.dumps(p)
-            } for p in payload]
-        )
+    def save(payload, stream, concurrency: int = 4, retries: int = 5):
+        """
+        Write predictions to the Firehose delivery stream
+
+        Records are split into PutRecordBatch calls within the Firehose count and size
+        limits, up to `concurrency` of which are sent at once. Records over the per record
+        limit can not be delivered, they are logged, counted as firehose errors with an
+        oversized Reason and skipped so the rest of the batch is still saved.
+        """
+        records = []
+        oversized = []
+        for p in payload:
+            data = json_dumps(p)
+
+            if len(data) > FIREHOSE_MAX_RECORD_BYTES:
+                oversized.append(p.get('name') or p.get('quadkey'))
+            else:
+                records.append({ "Data": data })
+
+        if len(oversized) > 0:
+            print('FIREHOSE: skipping {} predictions over the record size limit: {}'.format(len(oversized), oversized))
+            metrics.record('firehose', calls=0, errors=len(oversized), Reason='oversized')
+
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(lambda batch: Chips.put_records(batch, stream, retries), Chips.batch_records(records)))
 
         return True
 
+    @staticmethod
+    def batch_records(records: List[dict]) -> Iterator[List[dict]]:
+        """Split records into batches of at most 500 records and 4 MiB"""
+        batch: List[dict] = []
+        size = 0
+
+        for record in records:
+            if len(batch) == FIREHOSE_MAX_RECORDS or size + len(record["Data"]) > FIREHOSE_MAX_BATCH_BYTES:
+                yield batch
+                batch = []
+                size = 0
+
+            batch.append(record)
+            size += len(record["Data"])
+
+        if len(batch) > 0:
+            yield batch
+
+    @staticmethod
+    def put_records(records: List[dict], stream: str, retries: int = 5):
+        """Send a single batch, resending only the records Firehose rejected with exponential backoff"""
+        for attempt in range(retries + 1):
+            with metrics.timer('firehose') as timer:
+                timer.bytes = sum(len(record["Data"]) for record in records)
+
+                res = firehose.put_record_batch(
+                    DeliveryStreamName=stream,
+                    Records=records
+                )
+
+            if res.get('FailedPutCount', 0) == 0:
+                return
+
+            metrics.record('firehose', calls=0, errors=res['FailedPutCount'])
+
+            # Responses are in the same order as the records
+            failed = [record for record, response in zip(records, res['RequestResponses']) if 'ErrorCode' in response]
+            errors = set(response['ErrorCode'] for response in res['RequestResponses'] if 'ErrorCode' in response)
+
+            print('FIREHOSE: {} of {} records failed ({}), retrying'.format(len(failed), len(records), ', '.join(errors)))
+
+            records = failed
+            time.sleep(min(0.1 * 2 ** attempt, 5))
+
+        raise Exception('Failed to deliver {} records to {} after {} retries'.format(len(records), stream, retries))
 
     @staticmethod
     def b64encode_image(image_binary: bytes) -> str:
         return b64encode(image_binary).decode('utf-8')
 
     @staticmethod
-    def get_chips(event: SQSEvent) -> List[str]:
+    def get_chips(event: SQSEvent) -> List[dict]:
         """
         Return the body of our incoming SQS messages as an array of dicts
         Expects events of the following format:
 
         { 'Records': [ { "body": '{ "url": "", "bounds": "" }' }] }
 
+        Packed messages carrying several chips are expanded into individual chips:
+
+        { "submission": 1, "chips": [{ "name": "", "url": "", "bounds": [] }] }
+        { "submission": 1, "imagery": "", "quadkey": "", "z": 18, "tiles": [[dx, dy]] }
+
+        Every chip keeps the messageId of its record as `message`, so failed chips can be
+        reported back to SQS as batch item failures
         """
         chips = []
-        for record in event['Records']:
-            chips.append(json.loads(record['body']))
+        with metrics.timer('parse') as timer:
+            for record in event['Records']:
+                timer.bytes += len(record['body'])
+                body = json.loads(record['body'])
+
+                if 'chips' in body:
+                    record_chips = body['chips']
+                    for chip in record_chips:
+                        chip['submission'] = body.get('submission')
+                elif 'tiles' in body:
+                    record_chips = Chips.unpack_tiles(body)
+                else:
+                    record_chips = [body]
+
+                for chip in record_chips:
+                    chip['message'] = record.get('messageId')
+
+                chips.extend(record_chips)
 
         return chips
 
     @staticmethod
-    def get_images(chips: List[dict]) -> Iterator[Tuple[dict, bytes]]:
-        for chip in chips:
-            print("IMAGE: " + chip.get('url'))
-            r = requests.get(chip.get('url'))
-            yield (chip, r.content)
+    def unpack_tiles(body: dict) -> List[dict]:
+        """Expand a packed parent quadkey + tile offset message into chips"""
+        parent = mercantile.quadkey_to_tile(body['quadkey'])
+        z = body['z']
+        shift = z - parent.z
+
+        chips = []
+        for dx, dy in body['tiles']:
+            x = (parent.x << shift) + dx
+            y = (parent.y << shift) + dy
+
+            chips.append({
+                "submission": body.get('submission'),
+                "name": "{x}-{y}-{z}".format(x=x, y=y, z=z),
+                "url": body['imagery'].format(x=x, y=y, z=z),
+                "bounds": list(mercantile.bounds(x, y, z)),
+                "x": x,
+                "y": y,
+                "z": z
+            })
+
+        return chips
 
     @staticmethod
-    def get_supert_images(chips: List[dict]) -> Iterator[Tuple[dict, bytes]]:
-        """return bounds of original tile filled with the 4 child chips 1 zoom level up in bytes"""
-        for chip in chips:
-            w_lst = []
-            for i in range(2):
-                for j in range(2):
-                    window = Window(i * 256, j * 256, 256, 256)
-                    w_lst.append(window)
-
-            child_tiles = children(chip.get('x'), chip.get('y'), chip.get('z')) #get this from database (tile_zoom)
-            child_tiles.sort()
-
-            with MemoryFile() as memfile:
-                with memfile.open(driver='jpeg', height=512, width=512, count=3, dtype=rasterio.uint8) as dataset:
-                    for num, t in enumerate(child_tiles):
-                        url = chip.get('url').replace(str(chip.get('x')), str(t.x), 1).replace(str(chip.get('y')), str(t.y), 1).replace(str(chip.get('z')), str(t.z), 1)
-
-                        r = requests.get(url)
-                        img = np.array(Image.open(io.BytesIO(r.content)), dtype=np.uint8)
-                        try:
-                            img = img.reshape((256, 256, 3)) # 4 channels returned from some endpoints, but not all
-                        except ValueError:
-                            img = img.reshape((256, 256, 4))
-                        img = img[:, :, :3]
-                        img = np.rollaxis(img, 2, 0)
-                        dataset.write(img, window=w_lst[num])
-                dataset_b = memfile.read() #but this fails
-                yield(
-                    chip,
-                    dataset_b)
+    def fetch(url: str, concurrency: int = 10, timeout: float = 30) -> bytes:
+        """Return the image at url, from the TILE_CACHE tile cache if one is configured"""
+        def download(url: str) -> bytes:
+            print("IMAGE: " + url)
+            with metrics.timer('fetch', Host=urlparse(url).netloc) as timer:
+                r = get_session(url, concurrency).get(url, timeout=timeout)
+                r.raise_for_status()
+
+                timer.bytes = len(r.content)
+
+            return r.content
+
+        cache = TileCache.default()
+        if cache is None:
+            return download(url)
+
+        return cache.fetch(url, download)
+
+    @staticmethod
+    def child_url(chip: dict, tile: mercantile.Tile) -> str:
+        """Return the url of a child tile by substituting its indices into the parent chip url"""
+        parent = '{}/{}/{}'.format(chip.get('z'), chip.get('x'), chip.get('y'))
+        if parent in chip.get('url'):
+            return chip.get('url').replace(parent, '{}/{}/{}'.format(tile.z, tile.x, tile.y), 1)
+
+        return chip.get('url').replace(str(chip.get('x')), str(tile.x), 1).replace(str(chip.get('y')), str(tile.y), 1).replace(str(chip.get('z')), str(tile.z), 1)
+
+    @staticmethod
+    def decode_tile(image: bytes, size: int = 256) -> np.ndarray:
+        """Decode an imagery tile into a (size, size, 3) uint8 array"""
+        with metrics.timer('decode') as timer:
+            timer.bytes = len(image)
+            img = Image.open(io.BytesIO(image))
+
+            # 4 channels returned from some endpoints, but not all
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+
+            if img.size != (size, size):
+                img = img.resize((size, size))
+
+            return np.asarray(img, dtype=np.uint8)
+
+    @staticmethod
+    def get_super_image(chip: dict, raw: bool = False, concurrency: int = 10, timeout: float = 30) -> Any:
+        """
+        Return a single chip filled with its 4 child tiles 1 zoom level up, as a
+        (512, 512, 3) uint8 array if raw is set or as JPEG bytes otherwise
+
+        The child tiles are fetched and decoded concurrently, `concurrency` is the number
+        of supertiles downloaded at once so the imagery session is sized for 4 times as many
+        """
+        supertile = np.zeros((512, 512, 3), dtype=np.uint8)
+
+        def fill(t: mercantile.Tile):
+            row = (t.y - chip.get('y') * 2) * 256
+            col = (t.x - chip.get('x') * 2) * 256
+            supertile[row:row + 256, col:col + 256] = Chips.decode_tile(Chips.fetch(Chips.child_url(chip, t), 4 * concurrency, timeout))
+
+        # consume the results so any download error is raised here
+        list(get_child_pool(concurrency).map(fill, children(chip.get('x'), chip.get('y'), chip.get('z'))))
+
+        if raw:
+            return supertile
+
+        with metrics.timer('encode'):
+            img_bytes = BytesIO()
+            Image.fromarray(supertile).save(img_bytes, 'JPEG')
+            return img_bytes.getvalue()
@@ -1,11 +1,22 @@
 import os
 from typing import Dict, Any
-from download_and_predict.tensorflow import TFDownloadAndPredict
-from download_and_predict.pytorch import PTDownloadAndPredict
+from download_and_predict.backends import Backend
 from download_and_predict.chips import Chips
+from download_and_predict.cache import PredictionCache
+from download_and_predict.pipeline import Pipeline
+from download_and_predict.metrics import metrics
 from download_and_predict.custom_types import SQSEvent
 
-def handler(event: SQSEvent, context: Dict[str, Any]) -> bool:
+def handler(event: SQSEvent, context: Dict[str, Any]) -> Dict[str, Any]:
+    # stage timings are printed as CloudWatch EMF lines at the end of every invocation, failed or not
+    metrics.reset({ 'Stack': os.getenv('StackName', '') })
+
+    try:
+        return process(event, context)
+    finally:
+        metrics.flush()
+
+def process(event: SQSEvent, context: Dict[str, Any]) -> Dict[str, Any]:
     # read all our environment variables to throw errors early
     prediction_endpoint = os.getenv('PREDICTION_ENDPOINT')
     stream = os.getenv('StackName')
@@ -14,71 +25,101 @@ def handler(event: SQSEvent, context: Dict[str, Any]) -> bool:
     inf_type = os.getenv('INF_TYPE')
     model_type = os.getenv('MODEL_TYPE')
 
+    concurrency = int(os.getenv('IMAGERY_CONCURRENCY', '10'))
+    timeout = float(os.getenv('IMAGERY_TIMEOUT', '30'))
+    meta_ttl = float(os.getenv('META_TTL', '300'))
+    prediction_cache = os.getenv('PREDICTION_CACHE')
+    imagery_id = os.getenv('IMAGERY_ID')
+    seg_format = os.getenv('SEGMENTATION_FORMAT', 'png')
+
+    # class names of classification scores and vectorized segmentation output
+    inferences = os.getenv('INFERENCES').split(',') if os.getenv('INFERENCES') else None
+
     assert(stream)
     assert(inf_type)
     assert(prediction_endpoint)
     assert(model_type)
 
-    # instantiate our DownloadAndPredict class
-    if model_type == "tensorflow":
-        dap = TFDownloadAndPredict(
-            prediction_endpoint=prediction_endpoint
-        )
-    elif model_type == "pytorch":
-        dap = PTDownloadAndPredict(
-            prediction_endpoint=prediction_endpoint
-        )
+    # PREDICTION_BACKEND runs the model of MODEL_TYPE through another backend, ie tensorflow-grpc
+    backend = Backend.create(
+        os.getenv('PREDICTION_BACKEND') or model_type,
+        prediction_endpoint,
+        inf_type,
+        fmt=seg_format,
+        inferences=inferences,
+        meta_ttl=meta_ttl,
+        grpc_endpoint=os.getenv('PREDICTION_GRPC_ENDPOINT')
+    )
 
-    dap.get_meta(inf_type)
+    batch_size = int(os.getenv('PREDICTION_BATCH_SIZE') or backend.batch_size)
+    predictions = int(os.getenv('PREDICTION_CONCURRENCY') or backend.concurrency)
 
+    # models with a fixed batch dimension get full batches, only the last one is padded
+    if backend.max_batch_size is not None:
+        batch_size = backend.max_batch_size
 
     # get tiles from our SQS event
     chips = Chips.get_chips(event)
 
-    # tiles & images zipped
-    if super_tile == 'True':
-        t_i = Chips.get_super_images(chips)
-    else:
-        t_i = Chips.get_images(chips)
+    # reuse the predictions of tiles inferred by an earlier submission
+    cache = PredictionCache.from_url(
+        prediction_cache,
+        version='{}:{}:{}'.format(stream, backend.version, seg_format),
+        imagery=imagery_id,
+        supertile=super_tile == 'True'
+    )
+
+    cached = []
+    if cache is not None:
+        cached, chips = cache.lookup(chips)
+
+    if len(cached) > 0:
+        print('Saving:', len(cached), ' cached predictions')
+        Chips.save(cached, stream)
+
+    if len(chips) == 0:
+        return { 'batchItemFailures': [] }
 
-    if model_type == "tensorflow":
-        payload = dap.get_prediction_payload(t_i)
+    # chips are only done once their predictions are written
+    unsaved = set(id(chip) for chip in chips)
 
-        if inf_type == "detection":
-            print("TYPE: Object Detection")
+    def download(chip):
+        if super_tile == 'True':
+            return Chips.get_super_image(chip, raw=backend.array_input, concurrency=concurrency, timeout=timeout)
 
-            # send prediction request
-            preds = dap.od_post_prediction(payload, chips)
-        elif inf_type == "classification":
-            print("TYPE: Classification")
+        return Chips.fetch(chip.get('url'), concurrency, timeout)
 
-            inferences = os.getenv('INFERENCES')
-            assert(inferences)
-            inferences = inferences.split(',')
+    def save(batch, preds):
+        if cache is not None:
+            cache.store(batch, preds, allow_empty=backend.allow_empty())
 
-            # send prediction request
-            preds = dap.cl_post_prediction(payload, chips, inferences)
-        elif inf_type == "segmentation":
-            print("TYPE: Segmentation")
+        print('Saving:', len(preds), ' predictions')
 
-            # send prediction request
-            preds = dap.seg_post_prediction(payload, chips)
-        else:
-            print("Unknown Model")
-    elif model_type == "pytorch":
-        preds = []
+        if len(preds) > 0:
+            Chips.save(preds, stream)
 
-        payloads = dap.get_prediction_payloads(t_i)
-        for i in range(len(payloads)):
-            if inf_type == "segmentation":
-                print("TYPE: Segmentation")
+        for chip in batch:
+            unsaved.discard(id(chip))
 
-                # send prediction request
-                preds.append(dap.segmentation(payloads[i], chips[i]))
+    # downloads, predictions and firehose writes of successive micro-batches overlap
+    try:
+        Pipeline(
+            download=download,
+            predict=backend,
+            save=save,
+            concurrency=concurrency,
+            batch_size=batch_size,
+            predictions=predictions
+        ).run(chips)
+    except Exception as e:
+        # only the messages with unsaved chips are redelivered, so saved predictions are not written twice
+        failed = set(chip.get('message') for chip in chips if id(chip) in unsaved)
 
-    print('Saving:', len(preds), ' predictions')
+        if None in failed or len(failed) == len(event['Records']):
+            raise
 
-    Chips.save(preds, stream)
+        print('ERROR: retrying {} of {} messages: {}'.format(len(failed), len(event['Records']), e))
 
-    return True
+        return { 'batchItemFailures': [{ 'itemIdentifier': message } for message in sorted(failed)] }
 
+    return { 'batchItemFailures': [] }
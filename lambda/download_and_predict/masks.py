@@ -0,0 +1,162 @@
+"""
+Encode segmentation class masks into prediction records
+@author:Development Seed
+"""
+import zlib
+import base64
+import affine
+import mercantile
+import numpy as np
+
+from io import BytesIO
+from PIL import Image
+from rasterio import features
+from shapely.geometry import shape, mapping
+from shapely.ops import unary_union
+from typing import List, Optional
+
+from download_and_predict.chips import Chips
+
+FORMATS = ('png', 'rle', 'vector')
+
+class Masks:
+    @staticmethod
+    def resize(mask: np.ndarray, size: int = 256) -> np.ndarray:
+        """Resize a class mask with nearest neighbour sampling so class ids are never blended"""
+        if mask.shape == (size, size):
+            return mask
+
+        return np.asarray(Image.fromarray(mask).resize((size, size), Image.NEAREST), dtype=np.uint8)
+
+    @staticmethod
+    def rle(mask: np.ndarray) -> str:
+        """
+        Run length encode a 2D uint8 mask in row major order
+
+        Each run is a class byte followed by the run length as an unsigned LEB128
+        varint. Runs repeat from row to row in blobby masks so the bytes are deflated
+        (zlib) before being base64 encoded
+        """
+        flat = mask.ravel()
+
+        starts = np.concatenate(([0], np.flatnonzero(flat[1:] != flat[:-1]) + 1))
+        lengths = np.diff(np.concatenate((starts, [flat.size])))
+
+        out = bytearray()
+        for value, length in zip(flat[starts].tolist(), lengths.tolist()):
+            out.append(value)
+
+            while length >= 0x80:
+                out.append((length & 0x7F) | 0x80)
+                length >>= 7
+            out.append(length)
+
+        return base64.b64encode(zlib.compress(bytes(out), 9)).decode('utf-8')
+
+    @staticmethod
+    def unrle(rle: str, shape: tuple) -> np.ndarray:
+        """Decode a mask encoded by Masks.rle"""
+        data = zlib.decompress(base64.b64decode(rle))
+        mask = np.empty(shape[0] * shape[1], dtype=np.uint8)
+
+        i = 0
+        pos = 0
+        while i < len(data):
+            value = data[i]
+            i += 1
+
+            length = 0
+            shift = 0
+            while True:
+                byte = data[i]
+                i += 1
+                length |= (byte & 0x7F) << shift
+                shift += 7
+
+                if byte < 0x80:
+                    break
+
+            mask[pos:pos + length] = value
+            pos += length
+
+        return mask.reshape(shape)
+
+    @staticmethod
+    def polygons(mask: np.ndarray, bounds: List[float], inferences: Optional[List[str]] = None) -> List[dict]:
+        """
+        Vectorize a mask into one GeoJSON (Multi)Polygon Feature per class found in the chip
+
+        Class 0 is treated as background and not vectorized
+        """
+        west, south, east, north = bounds
+        height, width = mask.shape
+        transform = affine.Affine((east - west) / width, 0, west, 0, -(north - south) / height, north)
+
+        geoms = {}
+        for geom, value in features.shapes(mask, mask=mask != 0, transform=transform):
+            geoms.setdefault(int(value), []).append(shape(geom))
+
+        res = []
+        for value, polys in sorted(geoms.items()):
+            res.append({
+                "type": "Feature",
+                "properties": {
+                    "class": inferences[value] if inferences is not None and value < len(inferences) else value
+                },
+                "geometry": mapping(unary_union(polys))
+            })
+
+        return res
+
+    @staticmethod
+    def predictions(chip: dict, mask: np.ndarray, fmt: str = 'png', inferences: Optional[List[str]] = None) -> List[dict]:
+        """
+        Return the prediction records of the class mask of a single chip
+
+        - png: 256x256 PNG mask, base64 encoded in "image"
+        - rle: 256x256 run length encoded mask in "rle", see Masks.rle
+        - vector: GeoJSON Features of the non background classes at model resolution
+        """
+        if fmt not in FORMATS:
+            raise Exception('Unsupported segmentation format: {}'.format(fmt))
+
+        quadkey = None
+        if chip.get('x') is not None and chip.get('y') is not None and chip.get('z') is not None:
+            quadkey = mercantile.quadkey(chip.get('x'), chip.get('y'), chip.get('z'))
+
+        if fmt == 'vector':
+            res = Masks.polygons(mask, chip.get('bounds'), inferences)
+
+            for feat in res:
+                feat['submission_id'] = chip.get('submission')
+                if quadkey is not None:
+                    feat['quadkey'] = quadkey
+
+            return res
+
+        body = {
+            "type": "Image",
+            "name": chip.get("name"),
+            "bounds": chip.get("bounds"),
+            "x": chip.get("x"),
+            "y": chip.get("y"),
+            "z": chip.get("z"),
+            "submission_id": chip.get('submission')
+        }
+
+        if quadkey is not None:
+            body['quadkey'] = quadkey
+
+        # TODO don't assume the desired end state is 256^2
+        mask = Masks.resize(mask)
+
+        if fmt == 'rle':
+            body['encoding'] = 'rle'
+            body['shape'] = list(mask.shape)
+            body['rle'] = Masks.rle(mask)
+        else:
+            img_bytes = BytesIO()
+            Image.fromarray(mask).save(img_bytes, 'PNG')
+            body['image'] = Chips.b64encode_image(img_bytes.getvalue())
+
+        return [body]
@@ -0,0 +1,125 @@
+"""
+Per stage timings, byte and error counts of an invocation, emitted as CloudWatch
+Embedded Metric Format (EMF) log lines
+@author:Development Seed
+"""
+import json
+import time
+
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+UNITS = {
+    "Duration": "Milliseconds",
+    "Calls": "Count",
+    "Bytes": "Bytes",
+    "Errors": "Count"
+}
+
+class Timer:
+    """Context manager adding its duration to a stage, set `bytes` to count transferred bytes"""
+
+    def __init__(self, metrics: 'Metrics', stage: str, dimensions: Dict[str, str]):
+        self.metrics = metrics
+        self.stage = stage
+        self.dimensions = dimensions
+        self.bytes = 0
+
+    def __enter__(self) -> 'Timer':
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.record(
+            self.stage,
+            duration=(time.perf_counter() - self.start) * 1000,
+            bytes=self.bytes,
+            errors=0 if exc_type is None else 1,
+            **self.dimensions
+        )
+
+        return False
+
+
+class Metrics:
+    """
+    Thread safe accumulator of stage metrics
+
+    Each stage, and each extra dimension value such as the imagery host of a fetch,
+    gets one EMF document per flush with the summed Duration, Calls, Bytes and Errors:
+
+        { "_aws": { ... }, "Stack": "", "Stage": "fetch", "Host": "", "Duration": 1.2, "Calls": 4, "Bytes": 1024, "Errors": 0 }
+    """
+
+    def __init__(self, namespace: str = 'MLEnabler/Prediction', dimensions: Optional[Dict[str, str]] = None):
+        self.namespace = namespace
+        self.dimensions = dimensions or {}
+
+        self.lock = Lock()
+        self.stages: Dict[Tuple, Dict[str, float]] = {}
+
+    def reset(self, dimensions: Optional[Dict[str, str]] = None):
+        """Drop everything recorded so far and set the dimensions common to every stage"""
+        with self.lock:
+            self.stages = {}
+
+            if dimensions is not None:
+                self.dimensions = dimensions
+
+    def timer(self, stage: str, **dimensions: str) -> Timer:
+        return Timer(self, stage, dimensions)
+
+    def record(self, stage: str, duration: float = 0, calls: int = 1, bytes: int = 0, errors: int = 0, **dimensions: str):
+        key = (stage, ) + tuple(sorted(dimensions.items()))
+
+        with self.lock:
+            values = self.stages.get(key)
+            if values is None:
+                values = self.stages[key] = { "Duration": 0, "Calls": 0, "Bytes": 0, "Errors": 0 }
+
+            values["Duration"] += duration
+            values["Calls"] += calls
+            values["Bytes"] += bytes
+            values["Errors"] += errors
+
+    def documents(self) -> List[dict]:
+        timestamp = int(time.time() * 1000)
+
+        docs = []
+        with self.lock:
+            for key, values in self.stages.items():
+                dimensions = dict(self.dimensions)
+                dimensions["Stage"] = key[0]
+                dimensions.update(dict(key[1:]))
+
+                doc = {
+                    "_aws": {
+                        "Timestamp": timestamp,
+                        "CloudWatchMetrics": [{
+                            "Namespace": self.namespace,
+                            "Dimensions": [list(dimensions.keys())],
+                            "Metrics": [{ "Name": name, "Unit": unit } for name, unit in UNITS.items()]
+                        }]
+                    }
+                }
+                doc.update(dimensions)
+                doc.update({ name: round(value, 3) for name, value in values.items() })
+
+                docs.append(doc)
+
+        return docs
+
+    def flush(self) -> List[dict]:
+        """Print one EMF log line per stage and reset the recorded values"""
+        docs = self.documents()
+
+        for doc in docs:
+            print(json.dumps(doc))
+
+        self.reset()
+
+        return docs
+
+
+# Shared by every module of the lambda, reset and flushed by the handler for each invocation
+metrics = Metrics()
@@ -0,0 +1,137 @@
+"""
+Overlap the download, prediction and saving of the chips of an invocation
+@author:Development Seed
+"""
+import asyncio
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Callable, Any
+
+class Pipeline:
+    """
+    Run download -> predict -> save as concurrent stages connected by bounded queues
+
+        download (concurrency) -> images -> batcher -> batches -> predict (predictions) -> preds -> save
+
+    Each stage calls a blocking function on a shared thread pool:
+    - download(chip) returns the image of a single chip
+    - predict([(chip, image), ...]) returns the predictions of a micro-batch
+    - save(chips, preds) writes the predictions of a micro-batch
+
+    A micro-batch is sent to the model as soon as batch_size images have been downloaded,
+    and saved while later batches are still being predicted. The bounded queues keep at
+    most a few batches worth of images in memory. The first error of any stage cancels
+    the others and is raised by run.
+    """
+
+    def __init__(self,
+            download: Callable[[dict], Any],
+            predict: Callable[[List[Tuple[dict, Any]]], List[dict]],
+            save: Callable[[List[dict], List[dict]], Any],
+            concurrency: int = 10,
+            batch_size: int = 10,
+            predictions: int = 2):
+
+        self.download = download
+        self.predict = predict
+        self.save = save
+
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.predictions = predictions
+
+    def run(self, chips: List[dict]) -> int:
+        """Process every chip and return the number of saved predictions"""
+        return asyncio.run(self.process(chips))
+
+    async def process(self, chips: List[dict]) -> int:
+        loop = asyncio.get_running_loop()
+
+        images: asyncio.Queue = asyncio.Queue(maxsize=self.batch_size * 2)
+        batches: asyncio.Queue = asyncio.Queue(maxsize=self.predictions)
+        preds: asyncio.Queue = asyncio.Queue(maxsize=self.predictions)
+
+        saved = 0
+
+        async def download():
+            semaphore = asyncio.Semaphore(self.concurrency)
+
+            async def one(chip):
+                # Hold the slot until the image is queued so finished downloads can not pile up
+                async with semaphore:
+                    image = await loop.run_in_executor(pool, self.download, chip)
+                    await images.put((chip, image))
+
+            await asyncio.gather(*[one(chip) for chip in chips])
+            await images.put(None)
+
+        async def batcher():
+            batch = []
+            while True:
+                item = await images.get()
+
+                if item is not None:
+                    batch.append(item)
+
+                if len(batch) == self.batch_size or (item is None and len(batch) > 0):
+                    await batches.put(batch)
+                    batch = []
+
+                if item is None:
+                    break
+
+            for _ in range(self.predictions):
+                await batches.put(None)
+
+        async def predict():
+            while True:
+                batch = await batches.get()
+
+                if batch is None:
+                    await preds.put(None)
+                    return
+
+                res = await loop.run_in_executor(pool, self.predict, batch)
+
+                if res is None:
+                    raise Exception('Prediction request failed')
+
+                await preds.put(([chip for chip, image in batch], res))
+
+        async def save():
+            nonlocal saved
+
+            finished = 0
+            while finished < self.predictions:
+                item = await preds.get()
+
+                if item is None:
+                    finished += 1
+                    continue
+
+                batch_chips, res = item
+                await loop.run_in_executor(pool, self.save, batch_chips, res)
+
+                saved += len(res)
+
+        with ThreadPoolExecutor(max_workers=self.concurrency + self.predictions + 1) as pool:
+            tasks = [asyncio.ensure_future(stage) for stage in [
+                download(),
+                batcher(),
+                *[predict() for _ in range(self.predictions)],
+                save()
+            ]]
+
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+
+            # Stages waiting on the queues of a failed one would never finish, calls already
+            # running on the pool can not be interrupted and are waited for
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+            for task in done:
+                if task.exception() is not None:
+                    raise task.exception()
+
+        return saved
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# Generated by the protocol buffer compiler.  DO NOT EDIT!
+# source: download_and_predict/protos/predict.proto
+"""Generated protocol buffer code."""
+from google.protobuf.internal import builder as _builder
+from google.protobuf import descriptor as _descriptor
+from google.protobuf import descriptor_pool as _descriptor_pool
+from google.protobuf import symbol_database as _symbol_database
+# @@protoc_insertion_point(imports)
+
+_sym_db = _symbol_database.Default()
+
+
+
+
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n)download_and_predict/protos/predict.proto\x12\x13mlenabler.tfserving\"\x83\x01\n\x10TensorShapeProto\x12\x36\n\x03\x64im\x18\x02 \x03(\x0b\x32).mlenabler.tfserving.TensorShapeProto.Dim\x12\x14\n\x0cunknown_rank\x18\x03 \x01(\x08\x1a!\n\x03\x44im\x12\x0c\n\x04size\x18\x01 \x01(\x03\x12\x0c\n\x04name\x18\x02 \x01(\t\"\xab\x02\n\x0bTensorProto\x12,\n\x05\x64type\x18\x01 \x01(\x0e\x32\x1d.mlenabler.tfserving.DataType\x12;\n\x0ctensor_shape\x18\x02 \x01(\x0b\x32%.mlenabler.tfserving.TensorShapeProto\x12\x16\n\x0eversion_number\x18\x03 \x01(\x05\x12\x16\n\x0etensor_content\x18\x04 \x01(\x0c\x12\x10\n\x08half_val\x18\r \x03(\x05\x12\x11\n\tfloat_val\x18\x05 \x03(\x02\x12\x12\n\ndouble_val\x18\x06 \x03(\x01\x12\x0f\n\x07int_val\x18\x07 \x03(\x05\x12\x12\n\nstring_val\x18\x08 \x03(\x0c\x12\x11\n\tint64_val\x18\n \x03(\x03\x12\x10\n\x08\x62ool_val\x18\x0b \x03(\x08\"\x1b\n\nInt64Value\x12\r\n\x05value\x18\x01 \x01(\x03\"c\n\tModelSpec\x12\x0c\n\x04name\x18\x01 \x01(\t\x12\x30\n\x07version\x18\x02 \x01(\x0b\x32\x1f.mlenabler.tfserving.Int64Value\x12\x16\n\x0esignature_name\x18\x03 \x01(\t\"\xed\x01\n\x0ePredictRequest\x12\x32\n\nmodel_spec\x18\x01 \x01(\x0b\x32\x1e.mlenabler.tfserving.ModelSpec\x12?\n\x06inputs\x18\x02 \x03(\x0b\x32/.mlenabler.tfserving.PredictRequest.InputsEntry\x12\x15\n\routput_filter\x18\x03 \x03(\t\x1aO\n\x0bInputsEntry\x12\x0b\n\x03key\x18\x01 \x01(\t\x12/\n\x05value\x18\x02 \x01(\x0b\x32 .mlenabler.tfserving.TensorProto:\x02\x38\x01\"\xdb\x01\n\x0fPredictResponse\x12\x32\n\nmodel_spec\x18\x02 \x01(\x0b\x32\x1e.mlenabler.tfserving.ModelSpec\x12\x42\n\x07outputs\x18\x01 \x03(\x0b\x32\x31.mlenabler.tfserving.PredictResponse.OutputsEntry\x1aP\n\x0cOutputsEntry\x12\x0b\n\x03key\x18\x01 \x01(\t\x12/\n\x05value\x18\x02 \x01(\x0b\x32 .mlenabler.tfserving.TensorProto:\x02\x38\x01*\xc5\x01\n\x08\x44\x61taType\x12\x0e\n\nDT_INVALID\x10\x00\x12\x0c\n\x08\x44T_FLOAT\x10\x01\x12\r\n\tDT_DOUBLE\x10\x02\x12\x0c\n\x08\x44T_INT32\x10\x03\x12\x0c\n\x08\x44T_UINT8\x10\x04\x12\x0c\n\x08\x44T_INT16\x10\x05\x12\x0b\n\x07\x44T_INT8\x10\x06\x12\r\n\tDT_STRING\x10\x07\x12\x0c\n\x08\x44T_INT64\x10\t\x12\x0b\n\x07\x44T_BOOL\x10\n\x12\x0f\n\x0b\x44T_BFLOAT16\x10\x0e\x12\r\n\tDT_UINT16\x10\x11\x12\x0b\n\x07\x44T_HALF\x10\x13\x62\x06proto3')
+
+_builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, globals())
+_builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'download_and_predict.protos.predict_pb2', globals())
+if _descriptor._USE_C_DESCRIPTORS == False:
+
+  DESCRIPTOR._options = None
+  _PREDICTREQUEST_INPUTSENTRY._options = None
+  _PREDICTREQUEST_INPUTSENTRY._serialized_options = b'8\001'
+  _PREDICTRESPONSE_OUTPUTSENTRY._options = None
+  _PREDICTRESPONSE_OUTPUTSENTRY._serialized_options = b'8\001'
+  _DATATYPE._serialized_start=1095
+  _DATATYPE._serialized_end=1292
+  _TENSORSHAPEPROTO._serialized_start=67
+  _TENSORSHAPEPROTO._serialized_end=198
+  _TENSORSHAPEPROTO_DIM._serialized_start=165
+  _TENSORSHAPEPROTO_DIM._serialized_end=198
+  _TENSORPROTO._serialized_start=201
+  _TENSORPROTO._serialized_end=500
+  _INT64VALUE._serialized_start=502
+  _INT64VALUE._serialized_end=529
+  _MODELSPEC._serialized_start=531
+  _MODELSPEC._serialized_end=630
+  _PREDICTREQUEST._serialized_start=633
+  _PREDICTREQUEST._serialized_end=870
+  _PREDICTREQUEST_INPUTSENTRY._serialized_start=791
+  _PREDICTREQUEST_INPUTSENTRY._serialized_end=870
+  _PREDICTRESPONSE._serialized_start=873
+  _PREDICTRESPONSE._serialized_end=1092
+  _PREDICTRESPONSE_OUTPUTSENTRY._serialized_start=1012
+  _PREDICTRESPONSE_OUTPUTSENTRY._serialized_end=1092
+# @@protoc_insertion_point(module_scope)
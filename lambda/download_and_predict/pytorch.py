@@ -4,13 +4,19 @@ to a remote ML serving image, and saving them
 @author:Development Seed
 """
 import json
+import math
+import time
+import base64
 import affine
 import geojson
 import requests
 import rasterio
 import boto3
 
-from download_and_predict.chips import Chips
+from download_and_predict.chips import Chips, get_session, json_loads
+from download_and_predict.masks import Masks
+from download_and_predict.metrics import metrics
+from concurrent.futures import ThreadPoolExecutor
 from requests.auth import HTTPBasicAuth
 from io import BytesIO
 from urllib.parse import urlparse
@@ -33,6 +39,9 @@ class PTModelMeta:
         self.inf_type = inf_type
         self.size = { 'x': 256, 'y': 256 }
 
+        # Images are posted to TorchServe as encoded bytes
+        self.array_input = False
+
 
 class PTDownloadAndPredict(object):
     """
@@ -66,36 +75,78 @@ class PTDownloadAndPredict(object):
     def classification(self, payload, chips):
         print("UNSUPPORTED")
 
-    def segmentation(self, payload, chip):
-        try:
-            r = requests.post(self.prediction_endpoint + ":predict", data=payload)
-            r.raise_for_status()
+    def decode_mask(self, r: requests.Response) -> np.ndarray:
+        """
+        Decode a segmentation response into a 2D uint8 class mask
+
+        Supported response formats:
+        - image/png: single band PNG mask
+        - application/octet-stream: raw row major uint8 mask of a square tile
+        - application/json: nested [x][y][class] list or a base64 encoded PNG string
+        """
+        content_type = r.headers.get('Content-Type', '').split(';')[0].strip()
+
+        if content_type == 'image/png':
+            return np.asarray(Image.open(BytesIO(r.content)), dtype=np.uint8)
+        elif content_type == 'application/octet-stream':
+            side = math.isqrt(len(r.content))
+            return np.frombuffer(r.content, dtype=np.uint8).reshape((side, side))
+
+        body = json_loads(r.content)
+
+        if isinstance(body, str):
+            return np.asarray(Image.open(BytesIO(base64.b64decode(body))), dtype=np.uint8)
+
+        img = np.asarray(body, dtype=np.uint8)
+        if img.ndim == 3:
+            img = img[:, :, 0]
+
+        return img
+
+    def post(self, payloads, batch_size: int = 10, retries: int = 3) -> List[requests.Response]:
+        """
+        Post each payload to TorchServe, batch_size requests at a time over a single
+        keep-alive session so they are grouped by the server side batcher
+
+        Connection errors, throttling and server errors are retried with exponential
+        backoff, a request still failing after `retries` retries or failing with a client
+        error raises so no chip is silently left without predictions
+        """
+        session = get_session(self.prediction_endpoint, batch_size)
+
+        def predict(payload):
+            for attempt in range(retries + 1):
+                try:
+                    with metrics.timer('predict') as timer:
+                        r = session.post(self.prediction_endpoint + ":predict", data=payload)
+                        r.raise_for_status()
+
+                        timer.bytes = len(payload) + len(r.content)
 
-            lst = r.json()
+                    return r
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.HTTPError) as e:
+                    response = getattr(e, 'response', None)
+                    if response is not None:
+                        print (response.text)
 
-            img = np.ndarray((len(lst), len(lst[0])), dtype=np.uint8)
+                    retry = response is None or response.status_code >= 500 or response.status_code == 429
+                    if not retry or attempt == retries:
+                        raise
 
-            for x in range(len(lst)):
-                for y in range(len(lst[x])):
-                    img[x][y] = int(lst[x][y][0])
+                    time.sleep(min(0.1 * 2 ** attempt, 5))
 
+        with ThreadPoolExecutor(max_workers=batch_size) as pool:
+            return list(pool.map(predict, payloads))
 
-            img_bytes = BytesIO()
-            Image.fromarray(img).resize((256, 256)).save(img_bytes, 'PNG')
+    def seg_postprocess(self, responses: List[requests.Response], chips: List[dict], fmt: str = 'png', inferences: Optional[List[str]] = None) -> List[dict]:
+        """Encode the class mask of each chip as `fmt`"""
+        preds = []
 
-            return {
-                "type": "Image",
-                "name": chip.get("name"),
-                "bounds": chip.get("bounds"),
-                "x": chip.get("x"),
-                "y": chip.get("y"),
-                "z": chip.get("z"),
-                "submission_id": chip.get('submission'),
-                "image": Chips.b64encode_image(img_bytes.getvalue())
-            }
+        with metrics.timer('postprocess'):
+            for chip, r in zip(chips, responses):
+                preds.extend(Masks.predictions(chip, self.decode_mask(r), fmt, inferences))
 
-        except requests.exceptions.HTTPError as e:
-            print (e.response.text)
+        return preds
 
     def detection(self, payload, chips):
         print("UNSUPPORTED")
@@ -0,0 +1,120 @@
+"""
+Introspection of the TF Serving model signature, resolving how images are sent
+to a model and what kind of output it returns
+@author:Development Seed
+"""
+from typing import Dict, List, Optional, Any
+
+# Signature dtypes accepting pixel values as integers, sent as is
+INT_DTYPES = ('DT_UINT8', 'DT_INT8', 'DT_UINT16', 'DT_INT16', 'DT_INT32', 'DT_INT64')
+
+# Signature dtypes accepting pixel values scaled to 0-1
+FLOAT_DTYPES = ('DT_FLOAT', 'DT_HALF', 'DT_BFLOAT16', 'DT_DOUBLE')
+
+# Output names of the TF Object Detection API
+DETECTION_OUTPUTS = ('num_detections', 'detection_boxes', 'detection_scores')
+
+class TensorSpec:
+    """
+    A single input or output of a signature
+
+    dims holds the size of each dimension, None where the size is variable (-1),
+    dims is None if the rank itself is unknown
+    """
+
+    def __init__(self, name: str, info: Dict[str, Any]):
+        self.name = name
+        self.dtype = info.get('dtype')
+
+        shape = info.get('tensor_shape', {})
+        if shape.get('unknown_rank') or 'dim' not in shape:
+            self.dims: Optional[List[Optional[int]]] = None
+        else:
+            self.dims = [int(dim.get('size', -1)) for dim in shape['dim']]
+            self.dims = [dim if dim >= 0 else None for dim in self.dims]
+
+    @property
+    def rank(self) -> Optional[int]:
+        return None if self.dims is None else len(self.dims)
+
+
+class Signature:
+    """
+    Resolve the batch dimension, height/width, channels and dtype of the image input
+    and the kind of output of a serving_default signature
+
+    Images are sent with the cheapest encoding the input accepts:
+    - b64: DT_STRING inputs get the image bytes as served, decoded by the model
+    - uint8: integer inputs get the raw pixel values, no scaling
+    - float: float inputs get pixel values scaled to 0-1
+
+    Array inputs are expected as [batch, height, width, channels] or [height, width, channels],
+    height/width are None if the model accepts any size so tiles are sent without resizing
+    """
+
+    def __init__(self, signature: Dict[str, Any]):
+        self.inputs = { name: TensorSpec(name, info) for name, info in signature['inputs'].items() }
+        self.outputs = { name: TensorSpec(name, info) for name, info in signature['outputs'].items() }
+
+        # As far as I know there can be only a single named i/o key
+        self.input = list(self.inputs.values())[0]
+        self.output = list(self.outputs.values())[0]
+
+        if self.input.dtype == 'DT_STRING':
+            self.encoding = 'b64'
+        elif self.input.dtype in INT_DTYPES:
+            self.encoding = 'uint8'
+        elif self.input.dtype in FLOAT_DTYPES:
+            self.encoding = 'float'
+        else:
+            raise Exception('Unsupported model input dtype: {}'.format(self.input.dtype))
+
+        # Fixed number of instances per request, None if any number of instances is accepted
+        self.batch: Optional[int] = None
+        self.height: Optional[int] = None
+        self.width: Optional[int] = None
+        self.channels = 3
+
+        dims = self.input.dims
+        if self.encoding != 'b64' and dims is not None:
+            if len(dims) == 4:
+                self.batch = dims[0]
+                dims = dims[1:]
+            elif len(dims) == 3:
+                # Without a batch dimension every request holds a single instance
+                self.batch = 1
+            else:
+                raise Exception('Unsupported model input shape: {}'.format(self.input.dims))
+
+            self.height, self.width = dims[0], dims[1]
+
+            if dims[2] is not None:
+                if dims[2] not in (1, 3, 4):
+                    raise Exception('Unsupported number of model input channels: {}'.format(dims[2]))
+
+                self.channels = dims[2]
+
+        self.output_kind = self.get_output_kind()
+
+    def get_output_kind(self) -> str:
+        """
+        - detection: TF Object Detection API outputs
+        - scores: [batch, classes] class scores
+        - probabilities: [batch, height, width, classes] per pixel class scores
+        - mask: [batch, height, width] or [batch, height, width, 1] per pixel class ids
+        - unknown: anything else
+        """
+        if any(name in self.outputs for name in DETECTION_OUTPUTS):
+            return 'detection'
+
+        dims = self.output.dims
+        if dims is None:
+            return 'unknown'
+        elif len(dims) == 2:
+            return 'scores'
+        elif len(dims) == 3 or (len(dims) == 4 and dims[3] == 1):
+            return 'mask'
+        elif len(dims) == 4:
+            return 'probabilities'
+
+        return 'unknown'
@@ -4,6 +4,7 @@ to a remote ML serving image, and saving them
 @author:Development Seed
 """
 import json
+import time
 import affine
 import geojson
 import requests
@@ -11,7 +12,10 @@ import rasterio
 import shapely
 import boto3
 
-from download_and_predict.chips import Chips
+from download_and_predict.chips import Chips, json_dumps
+from download_and_predict.masks import Masks
+from download_and_predict.metrics import metrics
+from download_and_predict.signature import Signature
 from shapely.geometry import box
 from requests.auth import HTTPBasicAuth
 from shapely import affinity, geometry
@@ -33,33 +37,52 @@ from download_and_predict.custom_types import SQSEvent
 
 firehose = boto3.client('firehose')
 
+# Parsed model metadata is kept across warm invocations, keyed by (endpoint, inf_type)
+meta_cache: Dict[Tuple[str, str], Dict[str, Any]] = {}
+
+# Normalized value of each uint8 pixel value, rounded so the JSON representation of each value stays short
+NORMALIZED = np.round(np.arange(256) / 255, 6).astype(np.float32)
+
+# PIL mode of the images sent for each number of model input channels
+MODES = { 1: 'L', 3: 'RGB', 4: 'RGBA' }
+
 class TFModelMeta:
     def __init__(self, meta, inf_type):
         self.raw = meta
 
+        # Served model version, used to invalidate cached metadata
+        self.version = self.raw.get("model_spec", {}).get("version")
+
+        self.signature = Signature(self.raw["metadata"]["signature_def"]["signature_def"]["serving_default"])
+
         self.inputs = self.raw["metadata"]["signature_def"]["signature_def"]["serving_default"]["inputs"]
         self.outputs = self.raw["metadata"]["signature_def"]["signature_def"]["serving_default"]["outputs"]
 
         self.inf_type = inf_type
 
-        # As far as I know there can be only a single named i/o key
-        self.input_name = list(self.inputs.keys())[0]
-        self.output_name = list(self.outputs.keys())[0]
+        self.input_name = self.signature.input.name
+        self.output_name = self.signature.output.name
 
-        # We assume B64 encoded images are 256,256 as we have no other way of determining their inputs
-        if self.inputs[self.input_name].get('dtype') == 'DT_FLOAT':
-            dims = self.inputs[self.input_name]['tensor_shape']['dim']
+        # Cheapest transport the input signature accepts, see Signature
+        self.encoding = self.signature.encoding
+        self.array_input = self.encoding != 'b64'
 
-            # For now pick the dimension that is duplicated twice as most models use square inputs
-            dimlist = []
-            for dim in dims:
-                dimlist.append(int(dim.get('size')))
+        # Model input size, None where the model accepts any size
+        # B64 encoded images are decoded by the model so they are always sent as is
+        self.size = { 'x': self.signature.width, 'y': self.signature.height }
+        self.channels = self.signature.channels
 
-            cmn = max(set(dimlist), key=dimlist.count)
+        # Fixed number of instances per request, None if any number is accepted
+        self.batch = self.signature.batch
 
-            self.size = { 'x': cmn, 'y': cmn }
-        else:
-            self.size = { 'x': 256, 'y': 256 }
+        self.output_kind = self.signature.output_kind
+
+    def input_size(self) -> Optional[Tuple[int, int]]:
+        """(x, y) size images are resized to, None if they are sent at their own size"""
+        if self.size['x'] is None or self.size['y'] is None:
+            return None
+
+        return (self.size['x'], self.size['y'])
 
 
 class TFDownloadAndPredict(object):
@@ -74,58 +97,141 @@ class TFDownloadAndPredict(object):
         self.prediction_endpoint = prediction_endpoint
         self.meta = False
 
-    def get_meta(self, inf_type: str):
+    def get_meta(self, inf_type: str, ttl: float = 300):
+        """
+        Load the model metadata, reusing the cached copy from a previous invocation
+        Once the cached copy is older than ttl seconds it is only reused if the
+        served model version is unchanged
+        """
+        key = (self.prediction_endpoint, inf_type)
+        cached = meta_cache.get(key)
+        now = time.monotonic()
+
+        if cached is not None:
+            if now < cached['expires']:
+                self.meta = cached['meta']
+                return
+
+            if cached['meta'].version is not None and cached['meta'].version == self.get_version():
+                cached['expires'] = now + ttl
+                self.meta = cached['meta']
+                return
+
         r = requests.get(self.prediction_endpoint + "/metadata")
         r.raise_for_status()
 
         self.meta = TFModelMeta(r.json(), inf_type)
 
-    def listencode_image(self, image: bytes):
-        img = Image.open(io.BytesIO(image))
+        meta_cache[key] = {
+            'meta': self.meta,
+            'expires': now + ttl
+        }
 
-        # Resize input to be happy with model expectations
-        # TODO don't assume input image size starts at 256^2
-        if self.meta.size['x'] != 256 or self.meta.size['y'] != 256:
-            img = img.resize((self.meta.size['x'], self.meta.size['y']))
+    def get_version(self) -> Optional[str]:
+        """Return the served model version from the (cheap) model status endpoint"""
+        try:
+            r = requests.get(self.prediction_endpoint)
+            r.raise_for_status()
 
-        img = np.array(img, dtype=np.uint8)
+            return r.json()["model_version_status"][0]["version"]
+        except (requests.exceptions.RequestException, KeyError, IndexError, ValueError):
+            return None
 
-        try:
-            img = img.reshape((self.meta.size['x'], self.meta.size['y'], 3))
-        except ValueError:
-            img = img.reshape((self.meta.size['x'], self.meta.size['y'], 4))
+    def decode_image(self, image, size: Optional[Tuple[int, int]] = None) -> np.ndarray:
+        """
+        Decode image bytes or an already decoded supertile into a (y, x, channels) uint8
+        array with the channels of the model input, resized to the (x, y) size if given
+        """
+        mode = MODES[self.meta.channels]
 
-        # TODO: Eventually check channel size from model metadata
-        img = img[:, :, :3]
+        if isinstance(image, np.ndarray):
+            if mode == 'RGB' and (size is None or image.shape[:2] == (size[1], size[0])):
+                return image[:, :, :3]
 
-        # Custom
-        img = img * (1/255)
+            img = Image.fromarray(image[:, :, :3])
+        else:
+            img = Image.open(io.BytesIO(image))
+
+        # Grayscale, paletted and RGBA imagery are converted by mode
+        if img.mode != mode:
+            img = img.convert(mode)
+
+        # Resize input to be happy with model expectations
+        if size is not None and img.size != size:
+            img = img.resize(size)
+
+        img = np.asarray(img, dtype=np.uint8)
+        if img.ndim == 2:
+            img = img[:, :, None]
 
         return img
 
-    def get_prediction_payload(self, t_i) -> Tuple[List[dict], Dict[str, Any]]:
+    def normalize(self, img: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Write decoded pixels as the model input dtype into `out` if given
+
+        uint8 models get the pixel values as is, float models get them scaled to 0-1
+        as float32, looked up per pixel so no intermediate float copy is made
+        """
+        if out is None:
+            out = np.empty(img.shape, dtype=np.uint8 if self.meta.encoding == 'uint8' else np.float32)
+
+        if self.meta.encoding == 'uint8':
+            out[...] = img
+        else:
+            np.take(NORMALIZED, img, out=out, mode='clip')
+
+        return out
+
+    def listencode_image(self, image, out: Optional[np.ndarray] = None) -> np.ndarray:
+        """Decode a single image into the model input, writing into `out` if given"""
+        size = self.meta.input_size() if out is None else (out.shape[1], out.shape[0])
+
+        return self.normalize(self.decode_image(image, size), out)
+
+    def listencode_images(self, images, pad: int = 0) -> np.ndarray:
+        """
+        Decode images straight into a single preallocated (N, y, x, channels) batch of the model input dtype,
+        followed by `pad` zero images
+        """
+        size = self.meta.input_size()
+
+        batch = None
+        for i, image in enumerate(images):
+            with metrics.timer('decode'):
+                img = self.decode_image(image, size)
+
+                if batch is None:
+                    # Models accepting any size get the tiles as served, sized as the first one
+                    size = (img.shape[1], img.shape[0])
+                    batch = np.empty((len(images) + pad, ) + img.shape, dtype=np.uint8 if self.meta.encoding == 'uint8' else np.float32)
+                    batch[len(images):] = 0
+
+                self.normalize(img, batch[i])
+
+        return batch
+
+    def get_prediction_payload(self, t_i, pad: int = 0) -> Tuple[List[dict], Dict[str, Any]]:
         """
         chps: list image tilesk
         imagery: str an imagery API endpoint with three variables {z}/{x}/{y} to replace
         Return:
         - an array of b64 encoded images to send to our prediction endpoint
+        Array inputs are followed by `pad` zero images
         These arrays are returned together because they are parallel operations: we
         need to match up the tile indicies with their corresponding images
         """
 
         tile_indices, images = zip(*t_i)
 
-        if self.meta.inf_type == "segmentation":
-            # Hack submit as list for seg - b64 for others - eventually detemine & support both for any inf
-            img_l = [];
-            for img in images:
-                img_l.append(self.listencode_image(img))
-
-            instances = np.stack(img_l, axis=0).tolist()
+        if self.meta.array_input:
+            # Left as an array, json_dumps serializes it without building nested lists
+            instances = self.listencode_images(images, pad)
         else:
-            instances = [{
-                self.meta.input_name: dict(b64=Chips.b64encode_image(img))
-            } for img in images]
+            with metrics.timer('encode'):
+                instances = [{
+                    self.meta.input_name: dict(b64=Chips.b64encode_image(img))
+                } for img in images]
 
         payload = {
             "instances": instances
@@ -133,12 +239,23 @@ class TFDownloadAndPredict(object):
 
         return payload
 
-    def cl_post_prediction(self, payload: Dict[str, Any], chips: List[dict], inferences: List[str]) -> Dict[str, Any]:
-        try:
-            r = requests.post(self.prediction_endpoint + ":predict", data=json.dumps(payload))
+    def post(self, payload: Dict[str, Any]) -> requests.Response:
+        """Serialize and post a prediction request, the encode and model round trip are timed separately"""
+        with metrics.timer('encode') as timer:
+            data = json_dumps(payload)
+            timer.bytes = len(data)
+
+        with metrics.timer('predict') as timer:
+            r = requests.post(self.prediction_endpoint + ":predict", data=data)
             r.raise_for_status()
 
-            preds = r.json()["predictions"]
+            timer.bytes = len(data) + len(r.content)
+
+        return r
+
+    def cl_postprocess(self, preds: List[List[float]], chips: List[dict], inferences: List[str]) -> List[dict]:
+        """Turn the [batch, classes] scores of each chip into a Feature of its bounds"""
+        with metrics.timer('postprocess'):
             pred_list = [];
 
             for i in range(len(chips)):
@@ -160,71 +277,49 @@ class TFDownloadAndPredict(object):
 
                 pred_list.append(body)
 
-            return pred_list
-        except requests.exceptions.HTTPError as e:
-            print (e.response.text)
-
-    def seg_post_prediction(self, payload: Dict[str, Any], chips: List[dict]) -> Dict[str, Any]:
-        try:
-            r = requests.post(self.prediction_endpoint + ":predict", data=json.dumps(payload))
-            r.raise_for_status()
+        return pred_list
 
+    def seg_postprocess(self, preds: Any, chips: List[dict], fmt: str = 'png', inferences: Optional[List[str]] = None) -> List[dict]:
+        """Encode the class mask of each chip as `fmt`, see Masks.predictions"""
+        with metrics.timer('postprocess'):
             res = [];
-            preds = np.argmax(np.array(r.json()['predictions']), axis=-1).astype('uint8')
+            preds = np.asarray(preds)
 
-            for i in range(len(preds)):
-                img_bytes = BytesIO()
-                # TODO don't assume input image size starts at 256^2 - and that the desired end state is 256^2
-                Image.fromarray(preds[i]).resize((256, 256)).save(img_bytes, 'PNG')
-
-                res.append({
-                    "type": "Image",
-                    "name": chips[i].get("name"),
-                    "bounds": chips[i].get("bounds"),
-                    "x": chips[i].get("x"),
-                    "y": chips[i].get("y"),
-                    "z": chips[i].get("z"),
-                    "submission_id": chips[i].get('submission'),
-                    "image": Chips.b64encode_image(img_bytes.getvalue())
-                })
+            if self.meta.output_kind == 'mask':
+                # Class ids already, drop the trailing class dimension of [batch, height, width, 1]
+                preds = preds.reshape(preds.shape[:3]).astype('uint8')
+            else:
+                preds = np.argmax(preds, axis=-1).astype('uint8')
 
-            return res
+            for i in range(len(preds)):
+                res.extend(Masks.predictions(chips[i], preds[i], fmt, inferences))
 
-        except requests.exceptions.HTTPError as e:
-            print (e.response.text)
+        return res
 
-    def od_post_prediction(self, payload: str, chips: List[dict]) -> Dict[str, Any]:
+    def od_postprocess(self, preds: List[Dict[str, Any]], chips: List[dict]) -> List[dict]:
+        """Turn the detections of each chip into Features of their bounding boxes"""
         pred_list = [];
 
-        for i in range(len(chips)):
-            r = requests.post(self.prediction_endpoint + ":predict", data=json.dumps({
-                "instances": [ payload["instances"][i] ]
-            }))
-
-            r.raise_for_status()
+        with metrics.timer('postprocess'):
+            # Flatten the detections of every chip in the batch so they can be transformed at once
+            owners = []
+            scores = []
+            bboxes = []
+            bounds = []
+            for i, pred in enumerate(preds):
+                num_detections = int(pred["num_detections"])
 
-            # We only post a single chip for od detection
-            preds = r.json()["predictions"][0]
+                owners.extend([i] * num_detections)
+                scores.extend(pred['detection_scores'][:num_detections])
+                bboxes.extend(pred['detection_boxes'][:num_detections])
+                bounds.extend([chips[i].get('bounds')] * num_detections)
 
-            if preds["num_detections"] == 0.0:
-                continue
+            if len(owners) == 0:
+                return pred_list
 
-            # Create lists of num_detections length
-            scores = preds['detection_scores'][:int(preds["num_detections"])]
-            bboxes = preds['detection_boxes'][:int(preds["num_detections"])]
-
-            bboxes_256 = []
-            for bbox in bboxes:
-                bboxes_256.append([c * 256 for c in bbox])
-
-            for j in range(len(bboxes_256)):
-                bbox = geojson.Feature(
-                    geometry=self.tf_bbox_geo(bboxes_256[j], chips[i].get('bounds')),
-                    properties={}
-                ).geometry
-
-                score = preds["detection_scores"][j]
+            geoms = self.tf_bbox_geo(np.array(bboxes, dtype=np.float64), np.array(bounds, dtype=np.float64))
 
+            for i, score, bbox in zip(owners, scores, geoms):
                 body = {
                     "type": "Feature",
                     "submission_id": chips[i].get('submission'),
@@ -241,13 +336,22 @@ class TFDownloadAndPredict(object):
 
         return pred_list
 
-    def tf_bbox_geo(self, bbox, chip_bounds):
-        pred = [bbox[1], bbox[0], bbox[3], bbox[2]]
+    def tf_bbox_geo(self, bboxes: np.ndarray, chip_bounds: np.ndarray) -> List[dict]:
+        """
+        Convert (N, 4) normalized [ymin, xmin, ymax, xmax] detection boxes into GeoJSON polygons
+        given the (N, 4) [west, south, east, north] bounds of the chip each box was detected in
+        """
+        west, south, east, north = chip_bounds.T
+
+        # Box corners in normalized pixel space, ring ordered as shapely.geometry.box
+        cols = bboxes[:, [3, 3, 1, 1, 3]]
+        rows = bboxes[:, [0, 2, 2, 0, 0]]
+
         # Affine Transform
-        width = chip_bounds[2] - chip_bounds[0]
-        height = chip_bounds[3] - chip_bounds[1]
-        a = affine.Affine(width / 256, 0.0, chip_bounds[0], 0.0, (0 - height / 256), chip_bounds[3])
-        a_lst = [a.a, a.b, a.d, a.e, a.xoff, a.yoff]
-        geographic_bbox = affinity.affine_transform(geometry.box(*pred), a_lst)
+        lon = west[:, None] + cols * (east - west)[:, None]
+        lat = north[:, None] - rows * (north - south)[:, None]
 
-        return geographic_bbox
+        return [{
+            "type": "Polygon",
+            "coordinates": [ring]
+        } for ring in np.stack((lon, lat), axis=-1).tolist()]
@@ -0,0 +1,257 @@
+"""
+Imagery tile cache shared by prediction (lambda/download_and_predict) and
+retraining (tasks/task-tfrecords)
+
+This is the only copy, the task-tfrecords image is built from the repo root and
+copies it in. Entries are keyed by the hash of the normalized tile url, so either
+side reads the tiles the other one wrote to a shared backend.
+
+TILE_CACHE is a comma separated list of backends, checked in order:
+
+    sqlite:///tmp/tiles.db?max_size=268435456,s3://bucket/tile-cache/
+
+@author:Development Seed
+"""
+import os
+import time
+import sqlite3
+import hashlib
+import boto3
+
+from abc import ABC, abstractmethod
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from threading import Lock
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+from typing import Dict, List, Optional, Any
+
+# Query parameters that authenticate a request rather than select a tile
+CREDENTIALS = {
+    'access_token', 'token', 'key', 'apikey', 'api_key', 'sig', 'signature', 'expires'
+}
+
+# Error codes of a GET on a missing key, S3 answers 403 rather than 404 without s3:ListBucket
+MISSING_CODES = ('NoSuchKey', 'NotFound', '404', 'AccessDenied', '403')
+
+def normalize_url(url: str) -> str:
+    """Return the url without credentials, with a lower case host and sorted query parameters"""
+    parsed = urlparse(url)
+
+    query = sorted((k, v) for k, v in parse_qsl(parsed.query, keep_blank_values=True) if k.lower() not in CREDENTIALS)
+
+    return urlunparse((
+        parsed.scheme.lower(),
+        parsed.netloc.lower(),
+        parsed.path,
+        parsed.params,
+        urlencode(query),
+        ''
+    ))
+
+def tile_key(url: str) -> str:
+    return hashlib.sha256(normalize_url(url).encode('utf-8')).hexdigest()
+
+class TileCache(ABC):
+    """
+    Cache of encoded imagery tiles
+
+    Backends implement get and put by key and are selected by url scheme
+    """
+
+    backends: Dict[str, Any] = {}
+
+    # One default cache per process, forked workers open their own
+    instance: Optional['TileCache'] = None
+    instance_pid: Optional[int] = None
+    instance_lock = Lock()
+
+    @staticmethod
+    def register(scheme: str):
+        def decorator(cls):
+            TileCache.backends[scheme] = cls
+            return cls
+
+        return decorator
+
+    @staticmethod
+    def from_url(url: Optional[str]) -> Optional['TileCache']:
+        """Return the cache for a comma separated list of backend urls, or None if it is empty"""
+        if not url:
+            return None
+
+        tiers = []
+        for part in url.split(','):
+            parsed = urlparse(part.strip())
+
+            backend = TileCache.backends.get(parsed.scheme)
+            if backend is None:
+                raise Exception('Unsupported TILE_CACHE scheme: {}'.format(parsed.scheme))
+
+            tiers.append(backend(parsed))
+
+        if len(tiers) == 1:
+            return tiers[0]
+
+        return TieredTileCache(tiers)
+
+    @staticmethod
+    def default() -> Optional['TileCache']:
+        """Return the cache configured by the TILE_CACHE environment variable"""
+        with TileCache.instance_lock:
+            if TileCache.instance_pid != os.getpid():
+                TileCache.instance = TileCache.from_url(os.getenv('TILE_CACHE'))
+                TileCache.instance_pid = os.getpid()
+
+            return TileCache.instance
+
+    def fetch(self, url: str, download) -> bytes:
+        """Return the cached tile for a url, calling download(url) and storing the result on a miss"""
+        key = tile_key(url)
+
+        # The cache is best effort, a failing backend falls back to downloading
+        try:
+            content = self.get(key)
+        except Exception as e:
+            print('TILE CACHE: get failed: {}'.format(e))
+            content = None
+
+        if content is not None:
+            return content
+
+        content = download(url)
+
+        try:
+            self.put(key, content)
+        except Exception as e:
+            print('TILE CACHE: put failed: {}'.format(e))
+
+        return content
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[bytes]:
+        pass
+
+    @abstractmethod
+    def put(self, key: str, content: bytes):
+        pass
+
+
+class TieredTileCache(TileCache):
+    """Read through a list of caches, tiles found in a slower cache are copied into the faster ones"""
+
+    def __init__(self, tiers: List[TileCache]):
+        self.tiers = tiers
+
+    def get(self, key: str) -> Optional[bytes]:
+        for i, tier in enumerate(self.tiers):
+            content = tier.get(key)
+
+            if content is not None:
+                for faster in self.tiers[:i]:
+                    faster.put(key, content)
+
+                return content
+
+        return None
+
+    def put(self, key: str, content: bytes):
+        for tier in self.tiers:
+            tier.put(key, content)
+
+
+@TileCache.register('sqlite')
+class SQLiteTileCache(TileCache):
+    """
+    Single file on disk cache bounded to max_size bytes (default 256MB)
+
+    Once the cache grows past max_size the least recently used tiles are evicted
+    until it is back under 90% of it
+    """
+
+    def __init__(self, url):
+        params = dict(parse_qsl(url.query))
+
+        self.path = url.netloc + url.path
+        self.max_size = int(params.get('max_size', 256 * 1024 * 1024))
+
+        self.lock = Lock()
+        self.db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS tiles (key TEXT PRIMARY KEY, data BLOB NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS tiles_accessed ON tiles (accessed)')
+
+        self.size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM tiles').fetchone()[0]
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self.lock, self.db:
+            row = self.db.execute('SELECT data FROM tiles WHERE key = ?', (key, )).fetchone()
+
+            if row is None:
+                return None
+
+            self.db.execute('UPDATE tiles SET accessed = ? WHERE key = ?', (time.time(), key))
+
+        return bytes(row[0])
+
+    def put(self, key: str, content: bytes):
+        if len(content) > self.max_size:
+            return
+
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO tiles (key, data, size, accessed) VALUES (?, ?, ?, ?)',
+                (key, sqlite3.Binary(content), len(content), time.time())
+            )
+
+            self.size += len(content)
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        # Other processes may share the file so the running total is only an estimate
+        self.size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM tiles').fetchone()[0]
+
+        target = self.max_size * 0.9
+
+        # Collect just enough of the least recently used tiles, then delete them at once
+        keys = []
+        for key, size in self.db.execute('SELECT key, size FROM tiles ORDER BY accessed ASC'):
+            if self.size <= target:
+                break
+
+            keys.append((key, ))
+            self.size -= size
+
+        self.db.executemany('DELETE FROM tiles WHERE key = ?', keys)
+
+        print('TILE CACHE: evicted {} tiles'.format(len(keys)))
+
+
+@TileCache.register('s3')
+class S3TileCache(TileCache):
+    """
+    One object per tile under the given bucket prefix
+
+    S3 can not track access times cheaply, the prefix is bounded by a lifecycle
+    expiration rule instead of LRU eviction
+    """
+
+    def __init__(self, url):
+        self.bucket = url.netloc
+        self.prefix = url.path.lstrip('/')
+        if len(self.prefix) > 0 and not self.prefix.endswith('/'):
+            self.prefix += '/'
+
+        self.s3 = boto3.client('s3', config=Config(max_pool_connections=32))
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            return self.s3.get_object(Bucket=self.bucket, Key=self.prefix + key)['Body'].read()
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in MISSING_CODES:
+                return None
+
+            raise
+
+    def put(self, key: str, content: bytes):
+        self.s3.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=content)
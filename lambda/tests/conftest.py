@@ -0,0 +1,50 @@
+import io
+import os
+import pytest
+
+from PIL import Image
+from botocore.exceptions import ClientError
+
+# boto3 clients are created when download_and_predict is imported
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+@pytest.fixture
+def t_i():
+    """Factory of `count` (chip, image) pairs of a red PNG tile, as the pipeline passes them to a backend"""
+    def make(count: int = 2) -> list:
+        buf = io.BytesIO()
+        Image.new('RGB', (256, 256), (255, 0, 0)).save(buf, 'PNG')
+
+        return [({ "submission": 1, "name": str(i), "x": i, "y": 0, "z": 3, "bounds": [i, 0, i + 1, 1] }, buf.getvalue()) for i in range(count)]
+
+    return make
+
+@pytest.fixture
+def tensor():
+    """Factory of the tensor info of a TF Serving signature, of unknown rank without dims"""
+    def make(dtype: str, dims=None) -> dict:
+        if dims is None:
+            return { "dtype": dtype, "tensor_shape": { "unknown_rank": True } }
+
+        return { "dtype": dtype, "tensor_shape": { "dim": [{ "size": str(dim) } for dim in dims] } }
+
+    return make
+
+class StubS3:
+    """Stand-in for the S3 client failing every call with the given error code"""
+
+    def __init__(self, code: str):
+        self.code = code
+        self.puts = 0
+
+    def get_object(self, Bucket, Key):
+        raise ClientError({ 'Error': { 'Code': self.code, 'Message': self.code } }, 'GetObject')
+
+    def put_object(self, **kwargs):
+        self.puts += 1
+        raise ClientError({ 'Error': { 'Code': self.code, 'Message': self.code } }, 'PutObject')
+
+@pytest.fixture
+def failing_s3():
+    """Factory of S3 client stand-ins failing every call with the given error code"""
+    return StubS3
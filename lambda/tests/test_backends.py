@@ -0,0 +1,113 @@
+import os
+import pytest
+import requests
+import numpy as np
+
+from download_and_predict.backends import Backend, TFRestBackend, TorchServeBackend
+from download_and_predict.pipeline import Pipeline
+from benchmarks import servers
+
+def test_registry():
+    assert(Backend.backends['tensorflow'] is TFRestBackend)
+    assert(Backend.backends['pytorch'] is TorchServeBackend)
+    assert(set(Backend.backends.keys()) >= { 'tensorflow', 'tensorflow-grpc', 'pytorch', 'onnx' })
+
+    with pytest.raises(Exception, match='Unsupported prediction backend'):
+        Backend.create('caffe', 'http://localhost', 'classification')
+
+    with pytest.raises(Exception, match='Unsupported INF_TYPE'):
+        Backend.create('pytorch', 'http://localhost', 'classification')
+
+def test_tensorflow(t_i):
+    backend = Backend.create('tensorflow', servers.tf_server('classification', dtype='DT_UINT8'), 'classification', inferences=['background', 'building'])
+
+    assert(backend.array_input)
+    assert(backend.version == '1')
+    assert(not backend.allow_empty())
+
+    preds = backend(t_i())
+
+    assert(len(preds) == 2)
+    assert(set(preds[0]['properties'].keys()) == { 'background', 'building' })
+
+def test_fixed_batch(t_i):
+    backend = Backend.create('tensorflow', servers.tf_server('segmentation', dtype='DT_UINT8', batch=4), 'segmentation', fmt='png')
+
+    assert(backend.max_batch_size == 4)
+
+    # 6 chips run as a full batch of 4 and a batch of 2 padded with zero images
+    images = dict((chip['name'], image) for chip, image in t_i(6))
+    saved: list = []
+    Pipeline(
+        download=lambda chip: images[chip['name']],
+        predict=backend,
+        save=lambda chips, preds: saved.extend(preds),
+        batch_size=backend.max_batch_size
+    ).run([chip for chip, image in t_i(6)])
+
+    assert(sorted(pred['name'] for pred in saved) == [str(i) for i in range(6)])
+
+    payload = backend.prepare_batch(t_i(2))
+    assert(payload['instances'].shape == (4, 256, 256, 3))
+    assert((payload['instances'][2:] == 0).all())
+
+def test_pytorch(t_i):
+    backend = Backend.create('pytorch', servers.pt_server(), 'segmentation', fmt='vector', inferences=['background', 'building'])
+
+    assert(backend.allow_empty())
+    assert(not backend.array_input)
+
+    preds = backend(t_i())
+
+    assert(len(preds) > 0)
+    assert(all(pred['properties']['class'] == 'building' for pred in preds))
+
+def test_pytorch_failures(t_i):
+    # Worker restarts are retried
+    backend = Backend.create('pytorch', servers.pt_server(failures=2), 'segmentation', fmt='vector', inferences=['background', 'building'])
+    assert(len(backend(t_i())) > 0)
+
+    # Failures outlasting the retries fail the batch instead of dropping its chips
+    backend = Backend.create('pytorch', servers.pt_server(failures=100), 'segmentation', fmt='vector', retries=1)
+    with pytest.raises(requests.exceptions.HTTPError):
+        backend(t_i())
+
+def test_onnx(tmp_path, t_i):
+    pytest.importorskip('onnxruntime')
+    onnx = pytest.importorskip('onnx')
+
+    from onnx import helper, numpy_helper, TensorProto
+
+    def save(path: str, weights: list):
+        # 1x1 convolution of a channels first input
+        graph = helper.make_graph(
+            [helper.make_node('Conv', ['x', 'w'], ['y'])],
+            'segmentation',
+            [helper.make_tensor_value_info('x', TensorProto.FLOAT, ['N', 3, 256, 256])],
+            [helper.make_tensor_value_info('y', TensorProto.FLOAT, ['N', 2, 256, 256])],
+            [numpy_helper.from_array(np.array(weights, dtype=np.float32).reshape(2, 3, 1, 1), 'w')]
+        )
+
+        onnx.save(helper.make_model(graph, opset_imports=[helper.make_opsetid('', 13)], ir_version=8), path)
+
+    # Class 1 wherever green beats red
+    path = str(tmp_path / 'model.onnx')
+    save(path, [[1, 0, 0], [0, 1, 0]])
+
+    backend = Backend.create('onnx', path, 'segmentation', fmt='png', meta_ttl=0)
+
+    assert(backend.channels_first)
+    assert(backend.dap.meta.size == { 'x': 256, 'y': 256 })
+    assert(backend.concurrency == 1)
+
+    preds = backend(t_i())
+
+    assert([pred['type'] for pred in preds] == ['Image', 'Image'])
+
+    # Past meta_ttl the session is kept while the model is unchanged and reloaded once it is replaced
+    assert(Backend.create('onnx', path, 'segmentation', fmt='png', meta_ttl=0).session is backend.session)
+
+    save(path, [[0, 1, 0], [1, 0, 0]])
+    os.utime(path, ns=(0, 0))
+
+    assert(Backend.create('onnx', path, 'segmentation', fmt='png', meta_ttl=0).version != backend.version)
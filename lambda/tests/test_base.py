@@ -1,20 +1,54 @@
+import time
 import pytest
 from mercantile import Tile
 
-from download_and_predict.base import DownloadAndPredict
-
-def test_get_tiles():
-    # create a class with fake environment variables
-    dap = DownloadAndPredict(
-        imagery='https://example.com/{z}/{x}/{y}.png',
-        db='postgres://usr:pw@host:port/database',
-        prediction_endpoint='https://myloadbalancer.com/v1/models/ml:predict'
-    )
+from download_and_predict import chips as chips_module
+from download_and_predict.chips import Chips, FIREHOSE_MAX_RECORD_BYTES
+from download_and_predict.metrics import metrics
+from benchmarks import servers
 
+def test_get_chips():
     # create an example SQS event which invokes a lambda
     event = { 'Records': [ { "body": '{ "x": 4, "y": 5, "z":3 }' }] }
 
-    tiles = dap.get_tiles(event)
+    chips = Chips.get_chips(event)
+    tiles = [Tile(x=chip['x'], y=chip['y'], z=chip['z']) for chip in chips]
     fixture_tiles = [Tile(x=4, y=5, z=3)]
 
     assert(tiles == fixture_tiles)
+
+def test_get_super_image():
+    url = servers.tile_server(latency=0.3) + '/{z}/{x}/{y}.png'
+    chip = { "x": 1, "y": 2, "z": 3, "url": url.format(x=1, y=2, z=3) }
+
+    start = time.time()
+    supertile = Chips.get_super_image(chip, raw=True, concurrency=2)
+
+    # children are fetched at once, not one after the other
+    assert(time.time() - start < 0.9)
+
+    # tiles are coloured by their x, y, z
+    assert(supertile.shape == (512, 512, 3))
+    assert(supertile[0, 0].tolist() == [2, 4, 4])
+    assert(supertile[0, 256].tolist() == [3, 4, 4])
+    assert(supertile[256, 0].tolist() == [2, 5, 4])
+    assert(supertile[511, 511].tolist() == [3, 5, 4])
+
+def test_save_oversized(monkeypatch):
+    firehose = servers.StubFirehose()
+    monkeypatch.setattr(chips_module, 'firehose', firehose)
+    metrics.reset()
+
+    preds = [
+        { "name": "a", "properties": {} },
+        { "name": "b", "properties": { "mask": "x" * FIREHOSE_MAX_RECORD_BYTES } },
+        { "name": "c", "properties": {} }
+    ]
+
+    # the oversized record is skipped, the others still delivered
+    assert(Chips.save(preds, 'stream'))
+    assert(firehose.records == 2)
+
+    errors = { key: values["Errors"] for key, values in metrics.stages.items() if key[0] == 'firehose' }
+    assert(errors[('firehose', ('Reason', 'oversized'))] == 1)
+    metrics.reset()
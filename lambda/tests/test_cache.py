@@ -0,0 +1,61 @@
+import pytest
+
+from botocore.exceptions import ClientError
+
+from download_and_predict.cache import PredictionCache
+
+def chip(x, y, z, submission=1):
+    return { 'x': x, 'y': y, 'z': z, 'name': '{}-{}-{}'.format(x, y, z), 'submission': submission }
+
+def test_cache_roundtrip(tmp_path):
+    url = 'sqlite://' + str(tmp_path / 'predictions.db')
+    cache = PredictionCache.from_url(url, version='stack:1', imagery='2', supertile=False)
+
+    chips = [chip(1, 2, 3), chip(2, 2, 3), { 'name': 'list', 'bounds': [0, 0, 1, 1] }]
+
+    cached, misses = cache.lookup(chips)
+    assert(cached == [])
+    assert(misses == chips)
+
+    # The second tile has no detections, which is a valid result to cache
+    cache.store(chips, [{ 'quadkey': '021', 'submission_id': 1, 'properties': { 'default': 0.9 } }], allow_empty=True)
+
+    cached, misses = cache.lookup([chip(1, 2, 3, 5), chip(2, 2, 3, 5), chips[2]])
+    assert(cached == [{ 'quadkey': '021', 'submission_id': 5, 'properties': { 'default': 0.9 } }])
+    assert(misses == [chips[2]])
+
+def test_cache_key():
+    cache = PredictionCache.from_url('sqlite://:memory:', version='stack:1', imagery='2', supertile=False)
+    other = PredictionCache.from_url('sqlite://:memory:', version='stack:2', imagery='2', supertile=False)
+
+    assert(cache.key('021') != other.key('021'))
+    assert(PredictionCache.from_url(None, version='stack:1', imagery='2', supertile=False) is None)
+
+    with pytest.raises(Exception):
+        PredictionCache.from_url('redis://host', version='stack:1', imagery='2', supertile=False)
+
+def test_s3_missing(failing_s3):
+    cache = PredictionCache.from_url('s3://bucket/prediction-cache/', version='stack:1', imagery='2', supertile=False)
+
+    # Without s3:ListBucket a missing key is a 403 rather than a NoSuchKey
+    for code in ['AccessDenied', 'NoSuchKey', '404']:
+        cache.s3 = failing_s3(code)
+        assert(cache.get(cache.key('021')) is None)
+
+    cache.s3 = failing_s3('InternalError')
+    with pytest.raises(ClientError):
+        cache.get(cache.key('021'))
+
+def test_s3_fail_open(failing_s3):
+    cache = PredictionCache.from_url('s3://bucket/prediction-cache/', version='stack:1', imagery='2', supertile=False)
+    cache.s3 = failing_s3('InternalError')
+
+    chips = [chip(1, 2, 3), chip(2, 2, 3)]
+
+    # A failing backend only costs predicting the tiles again
+    cached, misses = cache.lookup(chips)
+    assert(cached == [])
+    assert(misses == chips)
+
+    cache.store(chips, [{ 'quadkey': '021', 'properties': { 'default': 0.9 } }])
+    assert(cache.s3.puts == 1)
@@ -0,0 +1,17 @@
+import json
+
+from download_and_predict.chips import Chips
+
+def test_get_chips_packed():
+    event = { 'Records': [
+        { "body": json.dumps({ "submission": 1, "chips": [{ "name": "a", "url": "https://example.com/a.png", "bounds": [0, 0, 1, 1] }] }) },
+        { "messageId": "m2", "body": json.dumps({ "submission": 2, "imagery": "https://example.com/{z}/{x}/{y}.png", "quadkey": "0", "z": 3, "tiles": [[0, 0], [3, 1]] }) }
+    ] }
+
+    chips = Chips.get_chips(event)
+
+    assert([chip['submission'] for chip in chips] == [1, 2, 2])
+    assert(chips[0]['name'] == 'a')
+    assert([(chip['x'], chip['y'], chip['z']) for chip in chips[1:]] == [(0, 0, 3), (3, 1, 3)])
+    assert(chips[2]['url'] == 'https://example.com/3/3/1.png')
+    assert([chip['message'] for chip in chips] == [None, 'm2', 'm2'])
@@ -0,0 +1,136 @@
+import pytest
+import numpy as np
+
+from concurrent import futures
+
+grpc = pytest.importorskip('grpc')
+
+from download_and_predict.backends import Backend, to_bfloat16, from_bfloat16
+from download_and_predict.protos import predict_pb2
+from benchmarks import servers
+
+def tensor_proto(value: np.ndarray, dtype: int) -> predict_pb2.TensorProto:
+    proto = predict_pb2.TensorProto(dtype=dtype, tensor_content=value.tobytes())
+    proto.tensor_shape.dim.extend([predict_pb2.TensorShapeProto.Dim(size=size) for size in value.shape])
+
+    return proto
+
+@pytest.fixture
+def grpc_server():
+    """TF Serving PredictionService stand-in, `outputs` builds the response of each request"""
+    requests = []
+
+    def predict(request, context):
+        requests.append(request)
+        return grpc_server.outputs(request)
+
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=2))
+    server.add_generic_rpc_handlers([grpc.method_handlers_generic_handler('tensorflow.serving.PredictionService', {
+        'Predict': grpc.unary_unary_rpc_method_handler(
+            predict,
+            request_deserializer=predict_pb2.PredictRequest.FromString,
+            response_serializer=predict_pb2.PredictResponse.SerializeToString
+        )
+    })])
+    port = server.add_insecure_port('127.0.0.1:0')
+    server.start()
+
+    grpc_server.requests = requests
+    grpc_server.target = '127.0.0.1:{}'.format(port)
+
+    yield grpc_server
+
+    server.stop(None)
+
+def test_uint8_input(grpc_server, t_i):
+    def outputs(request):
+        count = request.inputs['inputs'].tensor_shape.dim[0].size
+
+        response = predict_pb2.PredictResponse()
+        response.outputs['outputs'].CopyFrom(tensor_proto(np.tile(np.array([0.25, 0.75], dtype=np.float32), (count, 1)), predict_pb2.DT_FLOAT))
+        return response
+
+    grpc_server.outputs = outputs
+
+    backend = Backend.create('tensorflow-grpc', servers.tf_server('classification', dtype='DT_UINT8'), 'classification', inferences=['background', 'building'], grpc_endpoint=grpc_server.target)
+    preds = backend(t_i(3))
+
+    request = grpc_server.requests[0]
+    assert(request.model_spec.name == 'default')
+    assert(request.model_spec.signature_name == 'serving_default')
+    assert(not request.model_spec.HasField('version'))
+
+    tensor_in = request.inputs['inputs']
+    assert(tensor_in.dtype == predict_pb2.DT_UINT8)
+    assert([dim.size for dim in tensor_in.tensor_shape.dim] == [3, 256, 256, 3])
+    assert((np.frombuffer(tensor_in.tensor_content, dtype=np.uint8).reshape(3, 256, 256, 3)[:, 0, 0] == [255, 0, 0]).all())
+
+    assert(len(preds) == 3)
+    assert(preds[0]['properties'] == { 'background': 0.25, 'building': 0.75 })
+    assert(type(preds[0]['properties']['building']) is float)
+
+def test_string_input(grpc_server, t_i):
+    def outputs(request):
+        count = len(request.inputs['inputs'].string_val)
+
+        # Detections as TF Serving returns them, values in the repeated fields, no tensor_content
+        response = predict_pb2.PredictResponse()
+        num = response.outputs['num_detections']
+        num.dtype = predict_pb2.DT_FLOAT
+        num.tensor_shape.dim.add(size=count)
+        num.float_val.append(1.0)
+
+        scores = response.outputs['detection_scores']
+        scores.dtype = predict_pb2.DT_HALF
+        scores.tensor_shape.dim.add(size=count)
+        scores.tensor_shape.dim.add(size=1)
+        scores.half_val.extend(np.full(count, 0.5, dtype=np.float16).view(np.uint16).tolist())
+
+        response.outputs['detection_boxes'].CopyFrom(tensor_proto(np.tile(np.array([0, 0, 0.5, 0.5], dtype=np.float32), (count, 1, 1)), predict_pb2.DT_FLOAT))
+        return response
+
+    grpc_server.outputs = outputs
+
+    backend = Backend.create('tensorflow-grpc', servers.tf_server('detection') + '/versions/2', 'detection', grpc_endpoint=grpc_server.target)
+    chips = t_i(3)
+    preds = backend(chips)
+
+    request = grpc_server.requests[0]
+    assert(request.model_spec.version.value == 2)
+
+    # Image bytes are sent as served, without base64
+    assert(request.inputs['inputs'].dtype == predict_pb2.DT_STRING)
+    assert(list(request.inputs['inputs'].string_val) == [image for _, image in chips])
+
+    assert(len(preds) == 3)
+    assert(all(pred['properties']['default'] == 0.5 for pred in preds))
+
+def test_bfloat16(grpc_server, t_i):
+    values = np.array([0, 0.25, 1 / 3, 1, 255], dtype=np.float32)
+    assert(np.allclose(from_bfloat16(to_bfloat16(values)), values, rtol=2 ** -8))
+
+    def outputs(request):
+        count = request.inputs['inputs'].tensor_shape.dim[0].size
+
+        response = predict_pb2.PredictResponse()
+        proto = response.outputs['outputs']
+        proto.dtype = predict_pb2.DT_BFLOAT16
+        proto.tensor_shape.dim.add(size=count)
+        proto.tensor_shape.dim.add(size=2)
+        proto.half_val.extend(to_bfloat16(np.tile([0.25, 0.75], count)).tolist())
+        return response
+
+    grpc_server.outputs = outputs
+
+    backend = Backend.create('tensorflow-grpc', servers.tf_server('classification', dtype='DT_BFLOAT16'), 'classification', inferences=['background', 'building'], grpc_endpoint=grpc_server.target)
+    preds = backend(t_i(3))
+
+    tensor_in = grpc_server.requests[0].inputs['inputs']
+    assert(tensor_in.dtype == predict_pb2.DT_BFLOAT16)
+    assert((from_bfloat16(np.frombuffer(tensor_in.tensor_content, dtype=np.uint16)).reshape(3, 256, 256, 3)[:, 0, 0] == [1, 0, 0]).all())
+
+    assert(preds[0]['properties'] == { 'background': 0.25, 'building': 0.75 })
+
+def test_missing_endpoint():
+    with pytest.raises(Exception, match='PREDICTION_GRPC_ENDPOINT'):
+        Backend.create('tensorflow-grpc', servers.tf_server('classification'), 'classification', inferences=['background', 'building'])
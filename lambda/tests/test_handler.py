@@ -0,0 +1,57 @@
+import json
+import time
+import pytest
+
+from download_and_predict import chips as chips_module
+from download_and_predict.chips import Chips
+from download_and_predict.handler import handler
+from benchmarks import servers
+
+@pytest.fixture
+def env(monkeypatch):
+    monkeypatch.setenv('StackName', 'stream')
+    monkeypatch.setenv('INF_TYPE', 'classification')
+    monkeypatch.setenv('MODEL_TYPE', 'tensorflow')
+    monkeypatch.setenv('INFERENCES', 'background,building')
+    monkeypatch.setenv('PREDICTION_ENDPOINT', servers.tf_server('classification'))
+    monkeypatch.setenv('PREDICTION_BATCH_SIZE', '1')
+    monkeypatch.setenv('PREDICTION_CONCURRENCY', '1')
+    monkeypatch.setenv('IMAGERY_CONCURRENCY', '1')
+
+    firehose = servers.StubFirehose()
+    monkeypatch.setattr(chips_module, 'firehose', firehose)
+
+    fetch = Chips.fetch
+    def failing_fetch(url, concurrency=10, timeout=30):
+        if 'fail' in url:
+            # Let the chips downloaded before it be predicted and saved first
+            time.sleep(0.5)
+            raise Exception('Imagery unavailable')
+
+        return fetch(url, concurrency, timeout)
+
+    monkeypatch.setattr(Chips, 'fetch', staticmethod(failing_fetch))
+
+    return firehose
+
+def record(message: str, url: str) -> dict:
+    return { 'messageId': message, 'body': json.dumps({ 'name': message, 'x': 0, 'y': 0, 'z': 1, 'bounds': [0, 0, 1, 1], 'url': url }) }
+
+def test_batch_item_failures(env):
+    tiles = servers.tile_server()
+
+    event = { 'Records': [
+        record('a', tiles + '/1/0/0.png'),
+        record('b', tiles + '/1/1/0.png'),
+        record('c', 'https://fail.example.com/1/0/1.png')
+    ] }
+
+    # Only the message of the failed chip is redelivered
+    assert(handler(event, {}) == { 'batchItemFailures': [{ 'itemIdentifier': 'c' }] })
+    assert(env.records == 2)
+
+    assert(handler({ 'Records': event['Records'][:2] }, {}) == { 'batchItemFailures': [] })
+
+    # Failing every message still fails the invocation
+    with pytest.raises(Exception, match='Imagery unavailable'):
+        handler({ 'Records': event['Records'][2:] }, {})
@@ -0,0 +1,28 @@
+import numpy as np
+
+from download_and_predict.masks import Masks
+
+chip = { 'x': 1, 'y': 2, 'z': 3, 'name': '1-2-3', 'bounds': [0, 0, 1, 1], 'submission': 4 }
+
+def mask():
+    m = np.zeros((128, 128), dtype=np.uint8)
+    m[10:60, 20:90] = 1
+    m[70:100, 5:40] = 2
+    return m
+
+def test_rle_roundtrip():
+    for m in [Masks.resize(mask()), np.zeros((256, 256), dtype=np.uint8), np.random.randint(0, 3, (256, 256)).astype(np.uint8)]:
+        assert((Masks.unrle(Masks.rle(m), m.shape) == m).all())
+
+def test_resize_keeps_classes():
+    assert(set(np.unique(Masks.resize(mask())).tolist()) == {0, 1, 2})
+
+def test_predictions():
+    rle, = Masks.predictions(chip, mask(), 'rle')
+    assert(rle['quadkey'] == '021')
+    assert(rle['submission_id'] == 4)
+    assert((Masks.unrle(rle['rle'], rle['shape']) == Masks.resize(mask())).all())
+
+    features = Masks.predictions(chip, mask(), 'vector', ['background', 'building', 'road'])
+    assert([f['properties']['class'] for f in features] == ['building', 'road'])
+    assert(all(f['type'] == 'Feature' and f['quadkey'] == '021' for f in features))
@@ -0,0 +1,69 @@
+import json
+import pytest
+
+from download_and_predict.metrics import Metrics
+
+def emf(out: str) -> list:
+    """Return the EMF documents among the printed log lines"""
+    return [json.loads(line) for line in out.splitlines() if line.startswith('{"_aws"')]
+
+def test_flush(capsys):
+    metrics = Metrics(dimensions={ 'Stack': 'test' })
+
+    with metrics.timer('fetch', Host='a.example.com') as timer:
+        timer.bytes = 10
+    with metrics.timer('fetch', Host='a.example.com') as timer:
+        timer.bytes = 5
+
+    with pytest.raises(ValueError):
+        with metrics.timer('fetch', Host='b.example.com'):
+            raise ValueError()
+
+    metrics.flush()
+
+    docs = { doc['Host']: doc for doc in emf(capsys.readouterr().out) }
+
+    assert(docs['a.example.com']['Calls'] == 2)
+    assert(docs['a.example.com']['Bytes'] == 15)
+    assert(docs['a.example.com']['Errors'] == 0)
+    assert(docs['b.example.com']['Errors'] == 1)
+
+    directive = docs['a.example.com']['_aws']['CloudWatchMetrics'][0]
+    assert(directive['Dimensions'] == [['Stack', 'Stage', 'Host']])
+    assert(set(m['Name'] for m in directive['Metrics']) == { 'Duration', 'Calls', 'Bytes', 'Errors' })
+    assert(docs['a.example.com']['Stack'] == 'test')
+    assert(docs['a.example.com']['Stage'] == 'fetch')
+
+    # flushing resets the recorded stages
+    assert(metrics.flush() == [])
+
+def test_handler(capsys, monkeypatch):
+    from benchmarks import servers
+    from benchmarks.__main__ import event
+
+    tiles = servers.tile_server()
+
+    monkeypatch.setenv('StackName', 'test')
+    monkeypatch.setenv('MODEL_TYPE', 'tensorflow')
+    monkeypatch.setenv('INF_TYPE', 'classification')
+    monkeypatch.setenv('INF_SUPERTILE', 'False')
+    monkeypatch.setenv('INFERENCES', 'background,building')
+    monkeypatch.setenv('PREDICTION_ENDPOINT', servers.tf_server('classification'))
+    monkeypatch.delenv('PREDICTION_CACHE', raising=False)
+    monkeypatch.delenv('TILE_CACHE', raising=False)
+
+    from download_and_predict import chips
+    from download_and_predict.handler import handler
+
+    firehose = servers.StubFirehose()
+    monkeypatch.setattr(chips, 'firehose', firehose)
+
+    handler(event(tiles + '/{z}/{x}/{y}.png', 4), {})
+
+    docs = { doc['Stage']: doc for doc in emf(capsys.readouterr().out) }
+
+    assert(set(docs.keys()) == { 'parse', 'fetch', 'encode', 'predict', 'postprocess', 'firehose' })
+    assert(docs['fetch']['Host'] == tiles.split('//')[1])
+    assert(docs['fetch']['Calls'] == 4)
+    assert(docs['firehose']['Bytes'] == firehose.bytes)
+    assert(all(doc['Errors'] == 0 for doc in docs.values()))
@@ -0,0 +1,37 @@
+import time
+import pytest
+
+from download_and_predict.pipeline import Pipeline
+
+def chip(i: int) -> dict:
+    return { 'name': str(i), 'x': i, 'y': 0, 'z': 10 }
+
+def test_run():
+    saved: list = []
+
+    count = Pipeline(
+        download=lambda chip: chip['name'],
+        predict=lambda batch: [{ 'name': image } for chip, image in batch],
+        save=lambda chips, preds: saved.append(len(chips)),
+        batch_size=4
+    ).run([chip(i) for i in range(10)])
+
+    assert(count == 10)
+    assert(sorted(saved) == [2, 4, 4])
+
+def test_cancel():
+    downloads: list = []
+
+    def download(chip):
+        downloads.append(chip)
+        time.sleep(0.01)
+        return chip['name']
+
+    def predict(batch):
+        raise Exception('Model unavailable')
+
+    # The failed prediction stops the downloads of the remaining chips
+    with pytest.raises(Exception, match='Model unavailable'):
+        Pipeline(download=download, predict=predict, save=lambda chips, preds: None, concurrency=2, batch_size=2).run([chip(i) for i in range(100)])
+
+    assert(len(downloads) < 20)
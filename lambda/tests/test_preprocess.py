@@ -0,0 +1,72 @@
+import io
+import json
+import pytest
+import numpy as np
+
+from PIL import Image
+
+from download_and_predict.tensorflow import TFDownloadAndPredict, TFModelMeta
+from download_and_predict.chips import json_dumps
+
+def model(dtype: str, size: int = 256) -> TFDownloadAndPredict:
+    dap = TFDownloadAndPredict(prediction_endpoint='http://localhost')
+    dap.meta = TFModelMeta({ "metadata": { "signature_def": { "signature_def": { "serving_default": {
+        "inputs": { "inputs": { "dtype": dtype, "tensor_shape": { "dim": [{ "size": "-1" }, { "size": str(size) }, { "size": str(size) }, { "size": "3" }] } } },
+        "outputs": { "outputs": { "dtype": "DT_FLOAT" } }
+    } } } } }, 'classification')
+
+    return dap
+
+def png(mode: str, size: int = 256) -> bytes:
+    img = Image.new('RGB', (size, size), (255, 51, 0))
+    if mode == 'P':
+        img = img.convert('P', palette=Image.ADAPTIVE)
+    elif mode != 'RGB':
+        img = img.convert(mode)
+
+    buf = io.BytesIO()
+    img.save(buf, 'PNG')
+    return buf.getvalue()
+
+@pytest.mark.parametrize('mode', ['RGB', 'RGBA', 'L', 'LA', 'P'])
+def test_modes(mode):
+    batch = model('DT_UINT8').listencode_images([png(mode), png(mode, 512)])
+
+    assert(batch.shape == (2, 256, 256, 3))
+    assert(batch.dtype == np.uint8)
+
+    expected = np.asarray(Image.open(io.BytesIO(png(mode))).convert('RGB'))[0, 0]
+    assert((batch[:, 0, 0] == expected).all())
+
+def test_float():
+    dap = model('DT_FLOAT', 128)
+    supertile = np.full((512, 512, 3), 255, dtype=np.uint8)
+
+    batch = dap.listencode_images([png('RGB'), supertile])
+
+    assert(batch.shape == (2, 128, 128, 3))
+    assert(batch.dtype == np.float32)
+    assert(batch[0, 0, 0].tolist() == pytest.approx([1.0, 0.2, 0.0]))
+    assert((batch[1] == 1.0).all())
+
+    # Serialized with the same short values as the rounded float64 pixels
+    assert(json.loads(json_dumps({ "instances": batch[:1, :1, :1] })) == { "instances": [[[[1.0, 0.2, 0.0]]]] })
+
+def test_any_size():
+    dap = model('DT_UINT8', -1)
+
+    # Sent as served, without resizing
+    assert(dap.meta.input_size() is None)
+    assert(dap.listencode_images([png('RGB', 300), png('RGB', 300)]).shape == (2, 300, 300, 3))
+
+    supertile = np.zeros((512, 512, 3), dtype=np.uint8)
+    assert(dap.listencode_images([supertile]).shape == (1, 512, 512, 3))
+
+def test_channels():
+    dap = model('DT_UINT8')
+    dap.meta.channels = 1
+
+    batch = dap.listencode_images([png('RGBA')])
+
+    assert(batch.shape == (1, 256, 256, 1))
+    assert(batch[0, 0, 0, 0] == np.asarray(Image.open(io.BytesIO(png('RGB'))).convert('L'))[0, 0])
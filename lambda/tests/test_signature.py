@@ -0,0 +1,54 @@
+import pytest
+
+from download_and_predict.signature import Signature
+
+def test_string_input(tensor):
+    sig = Signature({
+        "inputs": { "image_bytes": tensor('DT_STRING', [-1]) },
+        "outputs": { "scores": tensor('DT_FLOAT', [-1, 2]) }
+    })
+
+    assert(sig.encoding == 'b64')
+    assert(sig.input.name == 'image_bytes')
+    assert((sig.batch, sig.height, sig.width, sig.channels) == (None, None, None, 3))
+    assert(sig.output_kind == 'scores')
+
+def test_array_input(tensor):
+    sig = Signature({
+        "inputs": { "inputs": tensor('DT_FLOAT', [-1, 224, 224, 1]) },
+        "outputs": { "outputs": tensor('DT_FLOAT', [-1, 224, 224, 4]) }
+    })
+
+    assert(sig.encoding == 'float')
+    assert((sig.batch, sig.height, sig.width, sig.channels) == (None, 224, 224, 1))
+    assert(sig.output_kind == 'probabilities')
+
+def test_variable_input(tensor):
+    sig = Signature({
+        "inputs": { "input_tensor": tensor('DT_UINT8', [1, -1, -1, 3]) },
+        "outputs": {
+            "detection_boxes": tensor('DT_FLOAT', [1, 100, 4]),
+            "num_detections": tensor('DT_FLOAT', [1])
+        }
+    })
+
+    assert(sig.encoding == 'uint8')
+    assert((sig.batch, sig.height, sig.width, sig.channels) == (1, None, None, 3))
+    assert(sig.output_kind == 'detection')
+
+def test_unbatched_input(tensor):
+    sig = Signature({
+        "inputs": { "inputs": tensor('DT_INT32', [256, 512, -1]) },
+        "outputs": { "outputs": tensor('DT_INT64', [-1, 256, 512]) }
+    })
+
+    assert(sig.encoding == 'uint8')
+    assert((sig.batch, sig.height, sig.width, sig.channels) == (1, 256, 512, 3))
+    assert(sig.output_kind == 'mask')
+
+def test_unsupported(tensor):
+    with pytest.raises(Exception):
+        Signature({ "inputs": { "inputs": tensor('DT_BOOL', [-1]) }, "outputs": { "outputs": tensor('DT_FLOAT') } })
+
+    with pytest.raises(Exception):
+        Signature({ "inputs": { "inputs": tensor('DT_FLOAT', [-1, 256, 256, 5]) }, "outputs": { "outputs": tensor('DT_FLOAT') } })
@@ -0,0 +1,52 @@
+import pytest
+
+from botocore.exceptions import ClientError
+
+from download_and_predict.tilecache import TileCache, normalize_url, tile_key
+
+def test_normalize_url():
+    assert(normalize_url('HTTPS://Tiles.Example.com/1/2/3.png?access_token=abc&b=2&a=1') == 'https://tiles.example.com/1/2/3.png?a=1&b=2')
+    assert(tile_key('https://example.com/1/2/3.png?token=1') == tile_key('https://example.com/1/2/3.png?token=2'))
+    assert(tile_key('https://example.com/1/2/3.png') != tile_key('https://example.com/1/2/4.png'))
+
+def test_sqlite_lru(tmp_path):
+    cache = TileCache.from_url('sqlite://{}?max_size=1000'.format(tmp_path / 'tiles.db'))
+
+    downloads = []
+    def download(url):
+        downloads.append(url)
+        return b'x' * 300
+
+    cache.fetch('https://example.com/1', download)
+    cache.fetch('https://example.com/2', download)
+    cache.fetch('https://example.com/1', download)
+    assert(len(downloads) == 2)
+
+    # Exceeding max_size evicts the least recently used tile (2) first
+    cache.fetch('https://example.com/3', download)
+    cache.fetch('https://example.com/4', download)
+
+    assert(cache.get(tile_key('https://example.com/2')) is None)
+    assert(cache.get(tile_key('https://example.com/4')) is not None)
+    assert(cache.size <= 900)
+
+def test_tiered(tmp_path):
+    slow = TileCache.from_url('sqlite://{}'.format(tmp_path / 'slow.db'))
+    cache = TileCache.from_url('sqlite://{},sqlite://{}'.format(tmp_path / 'fast.db', tmp_path / 'slow.db'))
+
+    slow.put('key', b'tile')
+
+    assert(cache.get('key') == b'tile')
+    assert(cache.tiers[0].get('key') == b'tile')
+
+def test_s3_missing(failing_s3):
+    cache = TileCache.from_url('s3://bucket/tile-cache/')
+
+    # Without s3:ListBucket a missing key is a 403 rather than a NoSuchKey
+    for code in ['AccessDenied', 'NoSuchKey', '404']:
+        cache.s3 = failing_s3(code)
+        assert(cache.get('key') is None)
+
+    cache.s3 = failing_s3('InternalError')
+    with pytest.raises(ClientError):
+        cache.get('key')
@@ -0,0 +1,62 @@
+import json
+import time
+import boto3
+
+from threading import Lock
+
+class Checkpoint:
+    """
+    Persist how far a submission has been populated so a restarted task can resume
+
+    The state is a small JSON document stored in S3, one of:
+    - { "offset": 1234 } byte offset in the CSV list that every message before it was delivered from
+    - { "index": 12 } number of entries of a tile list payload that were delivered
+    - { "quadkey": "0231" } last quadkey of a wms cover that was delivered
+    - { "done": true } the submission was fully populated
+
+    If no bucket is given checkpoints are disabled and the task always starts from scratch
+    """
+
+    def __init__(self, bucket, key, interval=10):
+        self.bucket = bucket
+        self.key = key
+        self.interval = interval
+
+        self.s3 = boto3.client('s3') if bucket else None
+        self.lock = Lock()
+        self.saved = 0
+        self.state = {}
+
+    def load(self):
+        if self.s3 is None:
+            return self.state
+
+        try:
+            obj = self.s3.get_object(Bucket=self.bucket, Key=self.key)
+            self.state = json.loads(obj['Body'].read())
+
+            print('ok - resuming from checkpoint {}'.format(self.state))
+        except self.s3.exceptions.NoSuchKey:
+            self.state = {}
+
+        return self.state
+
+    def save(self, state, force=False):
+        """Save the given state, at most once every `interval` seconds unless forced"""
+        with self.lock:
+            self.state = state
+
+            if self.s3 is None:
+                return
+
+            if not force and time.monotonic() - self.saved < self.interval:
+                return
+
+            self.s3.put_object(
+                Bucket=self.bucket,
+                Key=self.key,
+                Body=json.dumps(self.state).encode('utf-8'),
+                ContentType='application/json'
+            )
+
+            self.saved = time.monotonic()
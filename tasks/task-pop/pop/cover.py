@@ -0,0 +1,77 @@
+import mercantile
+
+from functools import lru_cache
+from pyproj import Transformer
+from shapely.geometry import box
+from shapely.ops import transform
+from shapely.prepared import prep
+
+@lru_cache(maxsize=None)
+def transformer(src="epsg:4326", dst="epsg:3857"):
+    """Return a cached lon/lat to web mercator Transformer"""
+    return Transformer.from_crs(src, dst, always_xy=True)
+
+def children(tile):
+    """Return the 4 children of a tile in quadkey order"""
+    x = tile.x * 2
+    y = tile.y * 2
+    z = tile.z + 1
+
+    return [
+        mercantile.Tile(x, y, z),
+        mercantile.Tile(x + 1, y, z),
+        mercantile.Tile(x, y + 1, z),
+        mercantile.Tile(x + 1, y + 1, z)
+    ]
+
+def descendants(tile, zoom):
+    """Yield every descendant of a tile at the given zoom in quadkey order"""
+    if tile.z == zoom:
+        yield tile
+        return
+
+    for child in children(tile):
+        yield from descendants(child, zoom)
+
+def cover(geom, zoom, after=None):
+    """
+    Yield the tiles at the given zoom that cover a lon/lat (Multi)Polygon in quadkey order
+
+    The quadtree is walked from the root tile, so no tiles are materialized up front.
+    Tiles fully inside the geometry are expanded without further geometry tests and
+    tiles outside of it (including those that fall entirely in a hole) are pruned
+
+    If `after` is a quadkey, only the tiles following it in quadkey order are yielded
+    """
+    geom = transform(transformer().transform, geom)
+
+    prepared = prep(geom)
+
+    def walk(tile):
+        if after is not None:
+            quadkey = mercantile.quadkey(tile)
+
+            # Every tile of this subtree precedes the resume point
+            if quadkey < after[:len(quadkey)]:
+                return
+
+            # The resume point itself was already delivered
+            if quadkey == after[:len(quadkey)] and tile.z == zoom:
+                return
+
+        tile_geom = box(*mercantile.xy_bounds(tile))
+
+        if not prepared.intersects(tile_geom):
+            return
+
+        if tile.z == zoom:
+            # Ignore tiles that only share an edge with the geometry
+            if not prepared.touches(tile_geom):
+                yield tile
+        elif prepared.contains(tile_geom) and (after is None or mercantile.quadkey(tile) > after):
+            yield from descendants(tile, zoom)
+        else:
+            for child in children(tile):
+                yield from walk(child)
+
+    yield from walk(mercantile.Tile(0, 0, 0))
@@ -3,19 +3,44 @@ import boto3
 import requests
 import csv
 import json
-import pyproj
 import mercantile
 import geojson
 from shapely.geometry import shape
-from shapely.ops import transform
-from functools import partial
-from tiletanic import tilecover, tileschemes
+from itertools import islice
 from contextlib import closing
-
-tiler = tileschemes.WebMercator()
+from pop.checkpoint import Checkpoint
+from pop.cover import cover
+from pop.sender import Sender
+from pop.packer import Packer
 
 cw = boto3.client("cloudwatch")
 
+def lines(r, skip=0):
+    """
+    Yield (start byte offset, end byte offset, line) for each line of a streamed response
+    Lines ending before the `skip` byte offset are not yielded
+    """
+    offset = 0
+    buffer = b''
+
+    for chunk in r.iter_content(chunk_size=65536):
+        parts = (buffer + chunk).split(b'\n')
+        buffer = parts.pop()
+
+        for part in parts:
+            start = offset
+            offset += len(part) + 1
+
+            if offset > skip:
+                yield start, offset, part.decode('utf-8').rstrip('\r')
+
+    if len(buffer) > 0:
+        start = offset
+        offset += len(buffer)
+
+        if offset > skip:
+            yield start, offset, buffer.decode('utf-8').rstrip('\r')
+
 def handler(event) -> bool:
     queue_name = event['queue']
     assert(queue_name)
@@ -28,72 +53,96 @@ def handler(event) -> bool:
     fmt = event['fmt']
     submission = event['submission']
 
-    if fmt == "list":
+    checkpoint = Checkpoint(
+        os.getenv('ASSET_BUCKET'),
+        'checkpoint/submission-{}.json'.format(submission)
+    )
+    state = checkpoint.load()
+
+    # Positions given to the sender are the checkpoint state to save once they are delivered
+    sender = Sender(
+        queue.url,
+        concurrency=int(os.getenv('SQS_CONCURRENCY', '16')),
+        on_progress=checkpoint.save
+    )
+
+    # Number of chips packed into each SQS message, 1 keeps the single chip format
+    pack = int(event.get('pack', 1))
+    packer = Packer(sender, submission, pack)
+
+    if state.get('done'):
+        print('ok - submission {} was already populated'.format(submission))
+
+    elif fmt == "list":
         url = event['url']
+        offset = state.get('offset', 0)
+
+        # Byte offsets must refer to the unencoded CSV for Range requests to line up
+        headers = { 'Accept-Encoding': 'identity' }
+        if offset > 0:
+            headers['Range'] = 'bytes={}-'.format(offset)
 
-        with closing(requests.get(url, stream=True)) as r:
+        with closing(requests.get(url, stream=True, headers=headers)) as r:
             r.raise_for_status()
 
-            r.encoding = 'utf-8'
-            reader = csv.reader(r.iter_lines(decode_unicode=True), delimiter=',', quotechar='"')
+            if r.status_code == 206:
+                base, skip = offset, 0
+            else:
+                base, skip = 0, offset
 
-            cache = []
-            total = -1
-            for row in reader:
-                if total == -1:
-                    total += 1
+            for start, end, line in lines(r, skip):
+                # CSV header
+                if base + start == 0:
                     continue
 
-                cache.append({
-                    "Id": row[0],
-                    "MessageBody": json.dumps({
-                        "name": row[0],
-                        "submission": submission,
-                        "url": row[1],
-                        "bounds": list(map(lambda x: float(x), row[2].split(",")))
-                    }),
-                })
-                total += 1
-
-                if len(cache) == 10:
-                    queue.send_messages(Entries=cache)
-                    cache = []
-
-            if len(cache) > 0:
-                queue.send_messages(Entries=cache)
+                if line.strip() == '':
+                    continue
 
-        print('ok - {} messages delivered', total)
+                row = next(csv.reader([line], delimiter=',', quotechar='"'))
+                bounds = list(map(lambda x: float(x), row[2].split(",")))
+                position = { "offset": base + end }
+
+                if pack > 1:
+                    packer.add_chip(row[0], row[1], bounds, position)
+                else:
+                    sender.send({
+                        "Id": row[0],
+                        "MessageBody": json.dumps({
+                            "name": row[0],
+                            "submission": submission,
+                            "url": row[1],
+                            "bounds": bounds
+                        }),
+                    }, position)
 
     elif fmt == "wms":
         payload = event['payload']
         zoom = event['zoom']
         imagery = event['imagery']
 
-        tiles = []
-
         if type(payload) is list:
-            for tile in payload:
-                tile = tile.split("-")
-                tiles.append(
-                    mercantile.Tile(int(tile[0]), int(tile[1]), int(tile[2]))
-                )
+            start = state.get('index', 0)
+
+            tiles = (
+                ({ "index": i + 1 }, mercantile.Tile(*map(int, tile.split("-"))))
+                for i, tile in enumerate(islice(payload, start, None), start)
+            )
 
         else:
             poly = shape(geojson.loads(json.dumps(payload)))
 
-            project = partial(
-                pyproj.transform,
-                pyproj.Proj(init="epsg:4326"),
-                pyproj.Proj(init="epsg:3857"),
+            # Streamed in quadkey order, nothing is sent until the cover is complete otherwise
+            tiles = (
+                ({ "quadkey": mercantile.quadkey(tile) }, tile)
+                for tile in cover(poly, zoom, after=state.get('quadkey'))
             )
 
-            poly = transform(project, poly)
+        for position, tile in tiles:
+            if pack > 1:
+                packer.add_tile(tile, imagery, position)
+                continue
 
-            tiles = tilecover.cover_geometry(tiler, poly, zoom)
-
-        cache = []
-        for tile in tiles:
-            cache.append(
+            sender.send(
                 {
                     "Id": str(tile.z) + "-" + str(tile.x) + "-" + str(tile.y),
                     "MessageBody": json.dumps(
@@ -111,16 +160,14 @@ def handler(event) -> bool:
                             "z": tile.z,
                         }
                     ),
-                }
+                },
+                position
             )
 
-            if len(cache) == 10:
-                queue.send_messages(Entries=cache)
-
-                cache = []
+    packer.flush()
+    sender.close()
 
-        if len(cache) > 0:
-            queue.send_messages(Entries=cache)
+    checkpoint.save({ "done": True }, force=True)
 
     cw.enable_alarm_actions(
         AlarmNames=[alarm]
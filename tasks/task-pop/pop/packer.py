@@ -0,0 +1,83 @@
+import json
+import math
+import mercantile
+
+class Packer:
+    """
+    Pack several chips into each SQS message
+
+    List chips are packed as:
+
+        { "submission": 1, "chips": [{ "name": "", "url": "", "bounds": [] }, ...] }
+
+    Tiles of a wms cover are grouped by a common parent tile and packed as the
+    parent quadkey plus the offset of each tile within it:
+
+        { "submission": 1, "imagery": "", "quadkey": "", "z": 18, "tiles": [[dx, dy], ...] }
+
+    Both are expanded back into individual chips by Chips.get_chips in the lambda
+    """
+
+    def __init__(self, sender, submission, pack):
+        self.sender = sender
+        self.submission = submission
+        self.pack = pack
+
+        self.key = None
+        self.body = None
+        self.position = None
+        self.messages = 0
+
+    def flush(self):
+        if self.body is None:
+            return
+
+        self.sender.send({
+            "Id": "{}-{}".format(self.key, self.messages),
+            "MessageBody": json.dumps(self.body)
+        }, self.position)
+
+        self.messages += 1
+        self.body = None
+
+    def add_chip(self, name, url, bounds, position=None):
+        if self.body is not None and len(self.body['chips']) == self.pack:
+            self.flush()
+
+        if self.body is None:
+            self.key = name
+            self.body = {
+                "submission": self.submission,
+                "chips": []
+            }
+
+        self.body['chips'].append({
+            "name": name,
+            "url": url,
+            "bounds": bounds
+        })
+        self.position = position
+
+    def add_tile(self, tile, imagery, position=None):
+        # Smallest parent tile that can hold a full message worth of children
+        shift = min(math.ceil(math.log(self.pack, 4)), tile.z)
+        quadkey = mercantile.quadkey(tile.x >> shift, tile.y >> shift, tile.z - shift)
+
+        if self.body is not None and (self.body['quadkey'] != quadkey or len(self.body['tiles']) == self.pack):
+            self.flush()
+
+        if self.body is None:
+            self.key = 'q' + quadkey
+            self.body = {
+                "submission": self.submission,
+                "imagery": imagery,
+                "quadkey": quadkey,
+                "z": tile.z,
+                "tiles": []
+            }
+
+        self.body['tiles'].append([
+            tile.x - ((tile.x >> shift) << shift),
+            tile.y - ((tile.y >> shift) << shift)
+        ])
+        self.position = position
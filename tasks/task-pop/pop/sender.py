@@ -0,0 +1,154 @@
+import time
+import boto3
+import hashlib
+
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+
+class Sender:
+    """
+    Pipelined SQS producer
+
+    Messages are grouped into SendMessageBatch calls of 10 entries, up to
+    `concurrency` of which are in flight at once. Entries that fail with a
+    retryable error are resent with exponential backoff.
+
+    Each entry can carry an opaque position in the input. Once every batch up
+    to and including a position was delivered, `on_progress` is called with it
+    so the caller can checkpoint. Batches complete out of order so only the
+    contiguous low watermark is reported.
+    """
+
+    def __init__(self, queue_url, concurrency=16, retries=5, report=10000, on_progress=None):
+        self.queue_url = queue_url
+        self.retries = retries
+        self.report = report
+        self.on_progress = on_progress
+
+        # Only FIFO queues deduplicate, the id is derived from the message so resends are dropped
+        self.fifo = queue_url.endswith('.fifo')
+
+        # boto3 clients are thread safe, resources are not
+        self.sqs = boto3.client('sqs', config=Config(max_pool_connections=concurrency))
+
+        self.pool = ThreadPoolExecutor(max_workers=concurrency)
+        self.inflight = BoundedSemaphore(concurrency * 2)
+        self.lock = Lock()
+
+        self.cache = []
+        self.position = None
+        self.futures = []
+        self.delivered = 0
+        self.reported = 0
+        self.start = time.monotonic()
+
+        # Batch sequence numbers used to compute the delivered low watermark
+        self.seq = 0
+        self.watermark = 0
+        self.completed = {}
+
+    def send(self, entry, position=None):
+        if self.fifo:
+            dedup = hashlib.sha256(entry['MessageBody'].encode('utf-8')).hexdigest()
+            entry['MessageDeduplicationId'] = dedup
+            entry['MessageGroupId'] = dedup
+
+        self.cache.append(entry)
+        self.position = position
+
+        if len(self.cache) == 10:
+            self.flush()
+
+    def flush(self):
+        if len(self.cache) == 0:
+            return
+
+        entries = self.cache
+        position = self.position
+        seq = self.seq
+
+        self.cache = []
+        self.seq += 1
+
+        # Block the producer once enough batches are queued to bound memory
+        self.inflight.acquire()
+        future = self.pool.submit(self.send_batch, entries)
+        future.add_done_callback(lambda f: self.done(f, seq, position))
+
+        self.futures.append(future)
+
+        # Surface failures early and keep the futures list from growing unbounded
+        if len(self.futures) > 1000:
+            for done in [f for f in self.futures if f.done()]:
+                done.result()
+
+            self.futures = [f for f in self.futures if not f.done()]
+
+    def send_batch(self, entries):
+        for attempt in range(self.retries + 1):
+            res = self.sqs.send_message_batch(QueueUrl=self.queue_url, Entries=entries)
+
+            self.delivered_count(len(res.get('Successful', [])))
+
+            failed = res.get('Failed', [])
+            if len(failed) == 0:
+                return
+
+            fatal = [f for f in failed if f.get('SenderFault')]
+            if len(fatal) > 0:
+                raise Exception('Failed to send messages: {}'.format(fatal))
+
+            # Only retry the entries that failed
+            ids = set(f['Id'] for f in failed)
+            entries = [entry for entry in entries if entry['Id'] in ids]
+
+            time.sleep(min(0.1 * 2 ** attempt, 5))
+
+        raise Exception('Failed to send {} messages after {} retries'.format(len(entries), self.retries))
+
+    def done(self, future, seq, position):
+        self.inflight.release()
+
+        if future.cancelled() or future.exception() is not None:
+            return
+
+        with self.lock:
+            self.completed[seq] = position
+
+            progress = None
+            while self.watermark in self.completed:
+                progress = self.completed.pop(self.watermark)
+                self.watermark += 1
+
+        if progress is not None and self.on_progress is not None:
+            self.on_progress(progress)
+
+    def delivered_count(self, count):
+        with self.lock:
+            self.delivered += count
+
+            if self.delivered - self.reported >= self.report:
+                self.reported = self.delivered
+                print('ok - {} messages delivered ({:.0f}/s)'.format(self.delivered, self.rate()))
+
+    def rate(self):
+        return self.delivered / max(time.monotonic() - self.start, 1e-6)
+
+    def close(self):
+        """Send any remaining entries and wait for every batch to be delivered"""
+        self.flush()
+
+        try:
+            for future in self.futures:
+                future.result()
+        finally:
+            self.pool.shutdown(wait=True)
+
+        print('ok - {} messages delivered in {:.1f}s ({:.0f}/s)'.format(
+            self.delivered,
+            time.monotonic() - self.start,
+            self.rate()
+        ))
+
+        return self.delivered
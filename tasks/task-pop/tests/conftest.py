@@ -0,0 +1,44 @@
+import os
+import threading
+import pytest
+
+# boto3 clients are created when the pop modules are imported
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+class StubSQS:
+    """Stand-in for the SQS client, entries with an Id in `fail` are rejected `failures` times"""
+
+    def __init__(self, fail=(), failures=1, sender_fault=False, hold=None):
+        self.lock = threading.Lock()
+        self.calls = []
+        self.fail = dict((id, failures) for id in fail)
+        self.sender_fault = sender_fault
+
+        # Batches starting with the Id `hold` wait for the event before completing
+        self.hold = hold
+        self.release = threading.Event()
+
+    def send_message_batch(self, QueueUrl, Entries):
+        if self.hold is not None and Entries[0]['Id'] == self.hold:
+            self.release.wait(5)
+
+        with self.lock:
+            self.calls.append([entry['Id'] for entry in Entries])
+
+            failed = []
+            for entry in Entries:
+                if self.fail.get(entry['Id'], 0) > 0:
+                    self.fail[entry['Id']] -= 1
+                    failed.append({ 'Id': entry['Id'], 'SenderFault': self.sender_fault, 'Code': 'InternalError' })
+
+        ids = set(f['Id'] for f in failed)
+
+        return {
+            'Successful': [{ 'Id': entry['Id'] } for entry in Entries if entry['Id'] not in ids],
+            'Failed': failed
+        }
+
+@pytest.fixture
+def stub_sqs():
+    """Factory of SQS client stand-ins, see StubSQS"""
+    return StubSQS
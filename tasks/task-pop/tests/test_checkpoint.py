@@ -0,0 +1,127 @@
+import io
+import json
+import boto3
+import mercantile
+
+from pop import handler
+from pop.checkpoint import Checkpoint
+
+class NoSuchKey(Exception):
+    pass
+
+class StubS3:
+    """Stand-in for the S3 client holding objects in memory"""
+
+    class exceptions:
+        NoSuchKey = NoSuchKey
+
+    def __init__(self):
+        self.objects = {}
+        self.puts = 0
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise NoSuchKey(Key)
+
+        return { 'Body': io.BytesIO(self.objects[(Bucket, Key)]) }
+
+    def put_object(self, Bucket, Key, Body, ContentType=None):
+        self.puts += 1
+        self.objects[(Bucket, Key)] = Body
+
+def checkpoint(s3, interval=10):
+    c = Checkpoint('bucket', 'checkpoint/submission-1.json', interval)
+    c.s3 = s3
+    return c
+
+def test_load_save():
+    s3 = StubS3()
+
+    c = checkpoint(s3)
+    assert(c.load() == {})
+
+    c.save({ "offset": 10 }, force=True)
+    assert(json.loads(s3.objects[('bucket', 'checkpoint/submission-1.json')]) == { "offset": 10 })
+
+    # Saves within the interval only update the in memory state
+    c.save({ "offset": 20 })
+    assert(s3.puts == 1)
+    assert(c.state == { "offset": 20 })
+
+    c.save({ "offset": 30 }, force=True)
+
+    # A restarted task resumes from the last saved state
+    assert(checkpoint(s3).load() == { "offset": 30 })
+
+def test_disabled():
+    c = Checkpoint(None, 'checkpoint/submission-1.json')
+
+    c.save({ "offset": 10 }, force=True)
+    assert(c.load() == { "offset": 10 })
+
+class StubQueue:
+    url = 'https://sqs.us-east-1.amazonaws.com/1/queue'
+
+class StubResource:
+    def get_queue_by_name(self, QueueName):
+        return StubQueue()
+
+class StubCloudWatch:
+    def enable_alarm_actions(self, AlarmNames):
+        pass
+
+def run(monkeypatch, s3, sqs, event):
+    clients = { 's3': s3, 'sqs': sqs }
+
+    monkeypatch.setenv('ALARM', 'alarm')
+    monkeypatch.setenv('ASSET_BUCKET', 'bucket')
+    monkeypatch.setattr(boto3, 'client', lambda name, **kwargs: clients[name])
+    monkeypatch.setattr(boto3, 'resource', lambda name, **kwargs: StubResource())
+    monkeypatch.setattr(handler, 'cw', StubCloudWatch())
+
+    return handler.handler(event)
+
+def sent(sqs):
+    return sorted(id for call in sqs.calls for id in call)
+
+def quadkeys(sqs):
+    """Quadkeys of the z-x-y ids of the tiles sent"""
+    return sorted(mercantile.quadkey(int(x), int(y), int(z)) for z, x, y in (id.split('-') for id in sent(sqs)))
+
+def test_resume_tile_list(monkeypatch, stub_sqs):
+    tiles = ['{}-{}-{}'.format(x, 0, 5) for x in range(25)]
+    event = { "queue": "queue", "fmt": "wms", "submission": 1, "payload": tiles, "zoom": 5, "imagery": "https://example.com/{z}/{x}/{y}.png" }
+
+    s3 = StubS3()
+    s3.objects[('bucket', 'checkpoint/submission-1.json')] = json.dumps({ "index": 20 }).encode('utf-8')
+
+    sqs = stub_sqs()
+    assert(run(monkeypatch, s3, sqs, event))
+
+    # Only the entries after the checkpointed index are sent
+    assert(sent(sqs) == sorted('5-{}-0'.format(x) for x in range(20, 25)))
+    assert(checkpoint(s3).load() == { "done": True })
+
+    # A completed submission is not sent again
+    sqs = stub_sqs()
+    assert(run(monkeypatch, s3, sqs, event))
+    assert(sqs.calls == [])
+
+def test_resume_cover(monkeypatch, stub_sqs):
+    payload = { "type": "Polygon", "coordinates": [[[0.1, 0.1], [2.9, 0.1], [2.9, 2.9], [0.1, 2.9], [0.1, 0.1]]] }
+    event = { "queue": "queue", "fmt": "wms", "submission": 1, "payload": payload, "zoom": 8, "imagery": "https://example.com/{z}/{x}/{y}.png" }
+
+    s3 = StubS3()
+    sqs = stub_sqs()
+    run(monkeypatch, s3, sqs, event)
+
+    everything = quadkeys(sqs)
+    after = everything[len(everything) // 2]
+
+    s3 = StubS3()
+    s3.objects[('bucket', 'checkpoint/submission-1.json')] = json.dumps({ "quadkey": after }).encode('utf-8')
+    sqs = stub_sqs()
+    run(monkeypatch, s3, sqs, event)
+
+    assert(len(everything) > 1)
+    assert(quadkeys(sqs) == [quadkey for quadkey in everything if quadkey > after])
@@ -0,0 +1,62 @@
+import mercantile
+import pytest
+
+from shapely.geometry import box, Polygon, shape
+from shapely.ops import transform
+
+from pop.cover import cover, transformer
+
+def brute_force(geom, zoom):
+    """Every tile of the bounding box intersecting the geometry by more than an edge"""
+    merc = transform(transformer().transform, geom)
+
+    tiles = set()
+    for tile in mercantile.tiles(*geom.bounds, zoom):
+        tile_geom = box(*mercantile.xy_bounds(tile))
+
+        if merc.intersects(tile_geom) and not merc.touches(tile_geom):
+            tiles.add(tile)
+
+    return tiles
+
+def test_box():
+    geom = box(-77.05, 38.85, -76.95, 38.95)
+
+    # Edges off the tile grid, the cover is the bounding box tiles
+    assert(set(cover(geom, 14)) == set(mercantile.tiles(*geom.bounds, 14)))
+
+def test_polygon_with_hole():
+    geom = Polygon(
+        [(0.1, 0.1), (4.9, 0.2), (4.5, 4.8), (0.3, 4.1), (0.1, 0.1)],
+        [[(1.5, 1.5), (3.5, 1.5), (3.5, 3.5), (1.5, 3.5), (1.5, 1.5)]]
+    )
+
+    tiles = list(cover(geom, 9))
+
+    assert(len(tiles) == len(set(tiles)))
+    assert(set(tiles) == brute_force(geom, 9))
+
+    # Tiles inside the hole are pruned
+    assert(mercantile.tile(2.5, 2.5, 9) not in tiles)
+
+def test_quadkey_order():
+    geom = shape({ "type": "MultiPolygon", "coordinates": [
+        [[[10.1, 10.1], [11.9, 10.1], [11.9, 11.9], [10.1, 11.9], [10.1, 10.1]]],
+        [[[-20.1, -5.1], [-18.9, -5.1], [-18.9, -3.9], [-20.1, -3.9], [-20.1, -5.1]]]
+    ] })
+
+    quadkeys = [mercantile.quadkey(tile) for tile in cover(geom, 10)]
+
+    assert(len(quadkeys) > 0)
+    assert(quadkeys == sorted(quadkeys))
+
+@pytest.mark.parametrize('at', [0, 1, 17, -2, -1])
+def test_after(at):
+    geom = box(-77.05, 38.85, -76.95, 38.95)
+
+    quadkeys = [mercantile.quadkey(tile) for tile in cover(geom, 14)]
+    after = quadkeys[at]
+
+    resumed = [mercantile.quadkey(tile) for tile in cover(geom, 14, after=after)]
+
+    assert(resumed == [quadkey for quadkey in quadkeys if quadkey > after])
@@ -0,0 +1,68 @@
+import os
+import sys
+import pytest
+import mercantile
+
+from shapely.geometry import box
+
+from pop.cover import cover
+from pop.packer import Packer
+
+# Packed messages are expanded by the prediction lambda
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'lambda'))
+chips_module = pytest.importorskip('download_and_predict.chips')
+
+IMAGERY = 'https://example.com/{z}/{x}/{y}.png'
+
+class StubSender:
+    def __init__(self):
+        self.entries = []
+        self.positions = []
+
+    def send(self, entry, position=None):
+        self.entries.append(entry)
+        self.positions.append(position)
+
+def unpack(sender):
+    return chips_module.Chips.get_chips({ 'Records': [{ 'body': entry['MessageBody'] } for entry in sender.entries] })
+
+@pytest.mark.parametrize('pack', [2, 4, 7, 16, 50])
+def test_tiles(pack):
+    tiles = list(cover(box(-77.05, 38.85, -76.95, 38.95), 14))
+
+    sender = StubSender()
+    packer = Packer(sender, 1, pack)
+    for i, tile in enumerate(tiles):
+        packer.add_tile(tile, IMAGERY, { "index": i + 1 })
+    packer.flush()
+
+    chips = unpack(sender)
+
+    assert(len(set(entry['Id'] for entry in sender.entries)) == len(sender.entries))
+    assert(all(len(entry['Id']) <= 80 for entry in sender.entries))
+
+    assert([mercantile.Tile(chip['x'], chip['y'], chip['z']) for chip in chips] == tiles)
+    assert(len(set(chip['name'] for chip in chips)) == len(tiles))
+    assert(all(chip['url'] == IMAGERY.format(x=chip['x'], y=chip['y'], z=chip['z']) for chip in chips))
+    assert(all(chip['submission'] == 1 for chip in chips))
+
+    # The last message checkpoints the position of the last tile
+    assert(sender.positions[-1] == { "index": len(tiles) })
+
+@pytest.mark.parametrize('pack', [2, 3, 10])
+def test_chips(pack):
+    rows = [('chip-{}'.format(i), 'https://example.com/{}.png'.format(i), [i, 0, i + 1, 1]) for i in range(23)]
+
+    sender = StubSender()
+    packer = Packer(sender, 1, pack)
+    for i, (name, url, bounds) in enumerate(rows):
+        packer.add_chip(name, url, bounds, { "offset": i })
+    packer.flush()
+
+    chips = unpack(sender)
+
+    assert(len(sender.entries) == -(-len(rows) // pack))
+    assert(len(set(entry['Id'] for entry in sender.entries)) == len(sender.entries))
+
+    assert([(chip['name'], chip['url'], chip['bounds']) for chip in chips] == rows)
+    assert(all(chip['submission'] == 1 for chip in chips))
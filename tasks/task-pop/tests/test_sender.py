@@ -0,0 +1,102 @@
+import time
+import json
+import hashlib
+import pytest
+
+from pop.sender import Sender
+
+def sender(sqs, queue_url='https://sqs.us-east-1.amazonaws.com/1/queue', **kwargs):
+    s = Sender(queue_url, **kwargs)
+    s.sqs = sqs
+    return s
+
+def entry(i):
+    return { "Id": str(i), "MessageBody": json.dumps({ "name": str(i) }) }
+
+def test_batches(stub_sqs):
+    sqs = stub_sqs()
+    s = sender(sqs)
+
+    for i in range(25):
+        s.send(entry(i))
+
+    assert(s.close() == 25)
+    assert(sorted(len(call) for call in sqs.calls) == [5, 10, 10])
+
+def test_retry_failed_entries(stub_sqs):
+    sqs = stub_sqs(fail=['3', '7'], failures=2)
+    s = sender(sqs, retries=3)
+
+    for i in range(10):
+        s.send(entry(i))
+
+    assert(s.close() == 10)
+
+    # Only the rejected entries are resent
+    assert(sqs.calls == [[str(i) for i in range(10)], ['3', '7'], ['3', '7']])
+
+def test_retries_exhausted(stub_sqs):
+    sqs = stub_sqs(fail=['3'], failures=10)
+    s = sender(sqs, retries=1)
+
+    for i in range(10):
+        s.send(entry(i))
+
+    with pytest.raises(Exception, match='after 1 retries'):
+        s.close()
+
+def test_sender_fault(stub_sqs):
+    s = sender(stub_sqs(fail=['3'], sender_fault=True))
+
+    for i in range(10):
+        s.send(entry(i))
+
+    with pytest.raises(Exception, match='Failed to send messages'):
+        s.close()
+
+def test_watermark(stub_sqs):
+    # The first batch completes last
+    sqs = stub_sqs(hold='0')
+    progress = []
+    s = sender(sqs, concurrency=4, on_progress=progress.append)
+
+    for i in range(40):
+        s.send(entry(i), { "index": i + 1 })
+    s.flush()
+
+    deadline = time.monotonic() + 5
+    while len(sqs.calls) < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    # Later batches were delivered, but not the first so nothing can be checkpointed
+    assert(len(sqs.calls) == 3)
+    assert(progress == [])
+
+    sqs.release.set()
+    s.close()
+
+    indices = [p['index'] for p in progress]
+    assert(indices == sorted(indices))
+    assert(indices[-1] == 40)
+
+def test_fifo_dedup(stub_sqs):
+    sqs = stub_sqs()
+    s = sender(sqs, queue_url='https://sqs.us-east-1.amazonaws.com/1/queue.fifo')
+
+    e = entry(1)
+    s.send(e)
+    s.close()
+
+    dedup = hashlib.sha256(e['MessageBody'].encode('utf-8')).hexdigest()
+    assert(e['MessageDeduplicationId'] == dedup)
+    assert(e['MessageGroupId'] == dedup)
+
+    # Standard queues reject deduplication ids
+    s = sender(stub_sqs())
+
+    e = entry(1)
+    s.send(e)
+    s.close()
+
+    assert('MessageDeduplicationId' not in e)
+    assert('MessageGroupId' not in e)
@@ -0,0 +1,204 @@
+import io
+import os
+import zipfile
+import boto3
+
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore
+
+class MultipartWriter(io.RawIOBase):
+    """
+    Write only file object that streams into an S3 multipart upload
+
+    Written bytes are buffered into `part_size` parts which are uploaded by a pool of
+    `concurrency` threads while the caller keeps writing. At most `concurrency` parts
+    are held in memory at once.
+    """
+
+    def __init__(self, bucket, key, part_size=16 * 1024 * 1024, concurrency=8):
+        if part_size < 5 * 1024 * 1024:
+            raise ValueError('S3 multipart parts must be at least 5MB')
+
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+
+        self.s3 = boto3.client('s3', config=Config(max_pool_connections=concurrency))
+        self.pool = ThreadPoolExecutor(max_workers=concurrency)
+        self.inflight = BoundedSemaphore(concurrency)
+
+        self.buffer = bytearray()
+        self.position = 0
+        self.futures = []
+
+        self.upload = self.s3.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def write(self, b):
+        self.buffer += b
+        self.position += len(b)
+
+        while len(self.buffer) >= self.part_size:
+            self.submit(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+
+        return len(b)
+
+    def submit(self, body):
+        number = len(self.futures) + 1
+
+        # Block the writer once enough parts are queued to bound memory
+        self.inflight.acquire()
+        future = self.pool.submit(self.upload_part, number, body)
+        future.add_done_callback(lambda f: self.inflight.release())
+
+        self.futures.append(future)
+
+    def upload_part(self, number, body):
+        res = self.s3.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload,
+            PartNumber=number,
+            Body=body
+        )
+
+        return { 'PartNumber': number, 'ETag': res['ETag'] }
+
+    def abort(self):
+        self.pool.shutdown(wait=True)
+        self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload)
+
+        super().close()
+
+    def close(self):
+        """Upload the last part and complete the upload"""
+        if self.closed:
+            return
+
+        if len(self.buffer) > 0 or len(self.futures) == 0:
+            self.submit(bytes(self.buffer))
+            self.buffer = bytearray()
+
+        try:
+            parts = [future.result() for future in self.futures]
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            super().close()
+
+        self.pool.shutdown(wait=True)
+        self.s3.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload,
+            MultipartUpload={ 'Parts': parts }
+        )
+
+        print('ok - uploaded s3://{}/{} ({} parts, {} bytes)'.format(self.bucket, self.key, len(parts), self.position))
+
+
+class ZipUploader:
+    """
+    Zip files straight into S3 as they are added
+
+    Members are stored uncompressed as tfrecords of PNG/JPEG images do not deflate
+    well, so adding a file costs little more than reading it. Use as a context manager,
+    the upload is aborted if the block raises.
+    """
+
+    def __init__(self, bucket, key, **kwargs):
+        self.bucket = bucket
+        self.key = key
+
+        self.writer = MultipartWriter(bucket, key, **kwargs)
+        self.zip = zipfile.ZipFile(self.writer, 'w', compression=zipfile.ZIP_STORED, allowZip64=True)
+
+    def add(self, path, arcname=None):
+        self.zip.write(path, arcname or os.path.basename(path))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            # Detach the writer so the zip does not write its end record on garbage collection
+            self.zip.fp = None
+            self.writer.abort()
+            return False
+
+        self.zip.close()
+        self.writer.close()
+
+
+class S3Reader(io.RawIOBase):
+    """
+    Read only, seekable file object over an S3 object using ranged GETs
+
+    Reads are made in blocks of at least `block_size` bytes, enough for ZipFile to
+    find the central directory and then read each member sequentially
+    """
+
+    def __init__(self, bucket, key, block_size=16 * 1024 * 1024, s3=None):
+        self.bucket = bucket
+        self.key = key
+        self.block_size = block_size
+
+        self.s3 = s3 or boto3.client('s3')
+        self.size = self.s3.head_object(Bucket=bucket, Key=key)['ContentLength']
+
+        self.position = 0
+        self.block = b''
+        self.block_start = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        else:
+            raise ValueError('Invalid whence: {}'.format(whence))
+
+        return self.position
+
+    def readinto(self, b):
+        if self.position >= self.size:
+            return 0
+
+        offset = self.position - self.block_start
+        if offset < 0 or offset >= len(self.block):
+            end = min(self.position + max(self.block_size, len(b)), self.size) - 1
+
+            res = self.s3.get_object(
+                Bucket=self.bucket,
+                Key=self.key,
+                Range='bytes={}-{}'.format(self.position, end)
+            )
+
+            self.block = res['Body'].read()
+            self.block_start = self.position
+            offset = 0
+
+        n = min(len(b), len(self.block) - offset)
+        b[:n] = self.block[offset:offset + n]
+        self.position += n
+
+        return n
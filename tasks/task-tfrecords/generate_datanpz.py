@@ -3,9 +3,12 @@ import os
 from os import path as op
 import requests
 import rasterio
-import glob
+import zipfile
 
 from requests.auth import HTTPBasicAuth
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from io import BytesIO
 from base64 import b64encode
 from urllib.parse import urlparse
@@ -19,6 +22,8 @@ import mercantile
 from mercantile import Tile, children
 import numpy as np
 
+from tilecache import TileCache
+
 def get_image_format(imagery):
     #TO-DO fix for non-mapbox imagery
     o = urlparse(imagery)
@@ -31,24 +36,66 @@ def url(tile, imagery):
     """Return a tile url provided an imagery template and a tile"""
     return imagery.replace('{x}', tile[0]).replace('{y}', tile[1]).replace('{z}', tile[2])
 
-def download_tilelist(chip, imagery, folder):
+def get_session(workers=16, retries=5):
+    """Return a keep-alive session that retries failed tile requests with exponential backoff"""
+    retry = Retry(
+        total=retries,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504]
+    )
+
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers, max_retries=retry)
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+def fetch(session, tile_url):
+    """Return the image at tile_url, from the TILE_CACHE tile cache if one is configured"""
+    def download(tile_url):
+        r = session.get(tile_url, timeout=60)
+        r.raise_for_status()
+
+        return r.content
+
+    cache = TileCache.default()
+    if cache is None:
+        return download(tile_url)
+
+    return cache.fetch(tile_url, download)
+
+def exists(tile_img):
+    """Chips are written atomically so any non empty file is a complete download"""
+    return op.isfile(tile_img) and op.getsize(tile_img) > 0
+
+def write(tile_img, content):
+    tmp = tile_img + '.tmp'
+    with open(tmp, 'wb') as w:
+        w.write(content)
+    os.replace(tmp, tile_img)
+
+def download_tilelist(chip, imagery, folder, session=requests):
     image_format = get_image_format(imagery['imglist'][chip]['url'])
     tile_img = op.join(folder, '{}{}'.format(imagery['imglist'][chip]['name'], image_format))
 
-    r = requests.get(imagery['imglist'][chip]['url'])
-    r.raise_for_status()
+    if exists(tile_img):
+        return tile_img
 
-    with open(tile_img, 'wb')as w:
-        w.write(r.content)
+    write(tile_img, fetch(session, imagery['imglist'][chip]['url']))
 
     return tile_img
 
-def download_tile_tms(tile, imagery, folder, zoom, supertile):
+def download_tile_tms(tile, imagery, folder, zoom, supertile, session=requests):
     """Download a satellite image tile from a tms endpoint"""
 
     image_format = get_image_format(imagery['url'])
-    r = requests.get(url(tile.split('-'), imagery['url']))
     tile_img = op.join(folder, '{}{}'.format(tile, image_format))
+
+    if exists(tile_img):
+        return tile_img
+
     tile = tile.split('-')
 
     #super-tile special case
@@ -67,12 +114,12 @@ def download_tile_tms(tile, imagery, folder, zoom, supertile):
                 w_lst.append(window)
 
         # request children
-        with rasterio.open(tile_img, 'w', driver='jpeg', height=new_dim,
+        tmp = tile_img + '.tmp'
+        with rasterio.open(tmp, 'w', driver='jpeg', height=new_dim,
                         width=new_dim, count=3, dtype=rasterio.uint8) as w:
                 for num, t in enumerate(child_tiles):
                     t = [str(t[0]), str(t[1]), str(t[2])]
-                    r = requests.get(url(t, imagery['url']))
-                    img = np.array(Image.open(io.BytesIO(r.content)), dtype=np.uint8)
+                    img = np.array(Image.open(io.BytesIO(fetch(session, url(t, imagery['url'])))), dtype=np.uint8)
                     try:
                         img = img.reshape((256, 256, 3)) # 4 channels returned from some endpoints, but not all
                     except ValueError:
@@ -80,13 +127,35 @@ def download_tile_tms(tile, imagery, folder, zoom, supertile):
                     img = img[:, :, :3]
                     img = np.rollaxis(img, 2, 0)
                     w.write(img, window=w_lst[num])
+        os.replace(tmp, tile_img)
     else:
-        r = requests.get(url(tile, imagery['url']))
-        with open(tile_img, 'wb')as w:
-            w.write(r.content)
+        write(tile_img, fetch(session, url(tile, imagery['url'])))
     return tile_img
 
-def download_img_match_labels(labels_folder, imagery, folder, zoom, supertile=False):
+def chip_bytes(chip, imagery, zoom, supertile, session=requests):
+    """
+    Return the encoded image of a chip without writing it to disk
+
+    Supertiles are assembled from their 4 children and encoded as PNG
+    """
+    if imagery['fmt'] != 'wms':
+        return fetch(session, imagery['imglist'][chip]['url'])
+
+    tile = chip.split('-')
+
+    if not supertile:
+        return fetch(session, url(tile, imagery['url']))
+
+    img = Image.new('RGB', (512, 512))
+    for t in children(int(tile[0]), int(tile[1]), int(tile[2]), zoom=zoom + 1):
+        child = Image.open(io.BytesIO(fetch(session, url([str(t.x), str(t.y), str(t.z)], imagery['url']))))
+        img.paste(child.convert('RGB'), ((t.x - int(tile[0]) * 2) * 256, (t.y - int(tile[1]) * 2) * 256))
+
+    buf = io.BytesIO()
+    img.save(buf, 'PNG')
+    return buf.getvalue()
+
+def download_img_match_labels(labels_folder, imagery, folder, zoom, supertile=False, workers=16, retries=5):
     #open the labels file and read the key (so we only download the images we have labels for)
     labels_file = op.join(labels_folder, 'labels.npz')
     nplabels = np.load(labels_file)
@@ -96,18 +165,34 @@ def download_img_match_labels(labels_folder, imagery, folder, zoom, supertile=Fa
         os.makedirs(chips_dir)
     class_chips = [tile for tile in nplabels.files]
 
-    #download images
-    for chip in class_chips:
+    session = get_session(workers, retries)
+
+    def download(chip):
         if imagery['fmt'] == 'wms':
-            download_tile_tms(chip, imagery, folder, zoom, supertile)
+            return download_tile_tms(chip, imagery, folder, zoom, supertile, session)
         else:
-            download_tilelist(chip, imagery, folder)
+            return download_tilelist(chip, imagery, folder, session)
+
+    #download images, chips already on disk from a previous run are skipped
+    failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(download, chip): chip for chip in class_chips}
+
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                failed += 1
+                print('not ok - failed to download {}: {}'.format(futures[future], e))
+
+    print('ok - downloaded {} of {} chips'.format(len(class_chips) - failed, len(class_chips)))
 
 # package up the images + labels into one data.npz file
 def make_datanpz(dest_folder, imagery, supertile,
                     seed=False,
                     split_names=('train', 'val', 'test'),
-                    split_vals=(0.7, .2, .1)):
+                    split_vals=(0.7, .2, .1),
+                    workers=8):
     """Generate an .npz file containing arrays for training machine learning algorithms
     Parameters
     ------------
@@ -124,6 +209,11 @@ def make_datanpz(dest_folder, imagery, supertile,
     split_names: tupel
         Default: ('train', 'test')
         List of names for each subset of the data.
+    workers: int
+        Number of threads decoding images.
+
+    Images are decoded straight into a memory mapped array on disk and each split
+    is streamed into the .npz from it, so the dataset never has to fit in memory.
     """
     # if a seed is given, use it
     if seed:
@@ -143,58 +233,82 @@ def make_datanpz(dest_folder, imagery, supertile,
     tiles = np.array(tile_names)
     np.random.shuffle(tiles)
 
-    # open the images and load those plus the labels into the final arrays
+    # index the downloaded images by tile name instead of globbing once per tile
+    tiles_dir = op.join(dest_folder, 'tiles')
+    image_files = {}
+    for entry in os.scandir(tiles_dir):
+        name, ext = op.splitext(entry.name)
+        if entry.is_file() and ext != '.tmp':
+            image_files[name] = entry.path
+
+    # we often don't download images for each label (e.g. background tiles)
+    tiles = [tile for tile in tiles if tile in image_files]
 
-    x_vals = []
-    y_vals = []
+    if len(tiles) == 0:
+        raise ValueError('No images were found for the labels in {}'.format(tiles_dir))
 
-    for tile in tiles:
-        image_file = glob.glob(dest_folder + '/' + 'tiles/' + tile + '*')[0]
+    # all images share the shape of the first one
+    with Image.open(image_files[tiles[0]]) as img:
+        width, height = img.size
+
+    x_path = op.join(dest_folder, 'x_vals.mmap')
+    x_vals = np.lib.format.open_memmap(x_path, mode='w+', dtype=np.uint8, shape=(len(tiles), height, width, 3))
+
+    def decode(i):
+        image_file = image_files[tiles[i]]
         try:
-            img = Image.open(image_file)
-        except FileNotFoundError:
-            # we often don't download images for each label (e.g. background tiles)
-            continue
+            with Image.open(image_file) as img:
+                # 4 channels returned from some endpoints, but not all
+                if img.mode != 'RGB':
+                    img = img.convert('RGB')
+
+                if img.size != (width, height):
+                    print('Unexpected size {} for {}, skipping'.format(img.size, image_file))
+                    return False
+
+                x_vals[i] = np.asarray(img, dtype=np.uint8)
         except OSError:
             print('Couldn\'t open {}, skipping'.format(image_file))
-            continue
+            return False
 
-        np_image = np.array(img)
-        img.close()
+        return True
 
-        if not supertile:
-            try:
-                np_image = np_image.reshape((256, 256, 3)) # 4 channels returned from some endpoints, but not all
-            except ValueError:
-                np_image = np_image.reshape((256, 256, 4))
-                np_image = np_image[:, :, :3]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        valid = list(pool.map(decode, range(len(tiles))))
 
-        #focusing just on classification
-        x_vals.append(np_image)
-        y_vals.append(labels[tile])
-
-    # Convert lists to numpy arrays
-    x_vals = np.array(x_vals, dtype=np.uint8)
-    y_vals = np.array(y_vals, dtype=np.uint8)
+    rows = [i for i in range(len(tiles)) if valid[i]]
 
     # Get number of data samples per split from the float proportions
-    split_n_samps = [len(x_vals) * val for val in split_vals]
+    split_n_samps = [len(rows) * val for val in split_vals]
 
-    if np.any(split_n_samps == 0):
+    if np.any(np.array(split_n_samps) == 0):
         raise ValueError('Split must not generate zero samples per partition.')
 
     # Convert into a cumulative sum to get indices
-    split_inds = np.cumsum(split_n_samps).astype(np.integer)
+    split_inds = np.cumsum(split_n_samps).astype(int)
 
     # Exclude last index as `np.split` handles splitting without that value
-    split_arrs_x = np.split(x_vals, split_inds[:-1])
-    split_arrs_y = np.split(y_vals, split_inds[:-1])
+    split_rows = np.split(np.array(rows, dtype=int), split_inds[:-1])
+
+    with zipfile.ZipFile(op.join(dest_folder, 'data.npz'), mode='w', compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+        for si, split_name in enumerate(split_names):
+            split = split_rows[si]
+
+            with zf.open('x_{}.npy'.format(split_name), 'w', force_zip64=True) as f:
+                np.lib.format.write_array_header_1_0(f, {
+                    'descr': np.lib.format.dtype_to_descr(x_vals.dtype),
+                    'fortran_order': False,
+                    'shape': (len(split), height, width, 3)
+                })
+
+                for i in split:
+                    f.write(x_vals[i].tobytes())
 
-    save_dict = {}
+            with zf.open('y_{}.npy'.format(split_name), 'w', force_zip64=True) as f:
+                y_vals = np.array([labels[tiles[i]] for i in split], dtype=np.uint8)
+                np.lib.format.write_array(f, y_vals)
 
-    for si, split_name in enumerate(split_names):
-        save_dict['x_{}'.format(split_name)] = split_arrs_x[si]
-        save_dict['y_{}'.format(split_name)] = split_arrs_y[si]
+    del x_vals
+    os.remove(x_path)
 
-    np.savez(op.join(dest_folder, 'data.npz'), **save_dict)
     print('Saving packaged file to {}'.format(op.join(dest_folder, 'data.npz')))
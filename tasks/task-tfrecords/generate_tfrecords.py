@@ -1,113 +1,281 @@
 import tensorflow as tf
+import multiprocessing
+import hashlib
+import zipfile
 import shutil
+import io
 import os
 import numpy as np
 
-def _bytes_feature(value):
-    """Returns a bytes_list from a single image numpy array representation from label maker ie npz['x_train'][i]"""
-    img = tf.convert_to_tensor(value)
-    img_t_encode = tf.image.encode_png(img, compression=-1)
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+from generate_datanpz import chip_bytes, get_session
+
+ENCODINGS = ('png', 'jpeg', 'raw')
+
+def _encode_image(value, encoding='png'):
+    """Encode a single image numpy array representation from label maker ie npz['x_train'][i]"""
+    img = tf.convert_to_tensor(np.asarray(value))
 
-    if isinstance(img_t_encode, type(tf.constant(0))):
-        value_b = img_t_encode.numpy()  # BytesList won't unpack a string from an EagerTensor
-    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value_b]))
+    if encoding == 'png':
+        return tf.image.encode_png(img, compression=-1).numpy()
+    elif encoding == 'jpeg':
+        return tf.image.encode_jpeg(img, quality=95).numpy()
+    elif encoding == 'raw':
+        # Decode with tf.io.parse_tensor(out_type=tf.uint8)
+        return tf.io.serialize_tensor(img).numpy()
+
+    raise ValueError('Unknown image encoding: {}'.format(encoding))
+
+
+def _bytes_feature(value, encoding='png'):
+    """Returns a bytes_list from a single image numpy array representation from label maker ie npz['x_train'][i]"""
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[_encode_image(value, encoding)]))
 
 
 def _bytes_feature_label(value):
     """Returns a bytes_list from a single label numpy array representation from label maker ie npz['y_train'][i]"""
-    label = tf.convert_to_tensor(value)
-    label = tf.io.serialize_tensor(label)
+    label = tf.io.serialize_tensor(tf.convert_to_tensor(value)).numpy()
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[label]))
 
-    if isinstance(label, type(tf.constant(0))):
-        label_b = label.numpy()  # BytesList won't unpack a string from an EagerTensor
-    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[label_b]))
+
+def gen_tf_image_example(img, label, encoding='png'):
+    feature = {
+        'image': _bytes_feature(img, encoding),
+        'label': _bytes_feature_label(label)}
+    return tf.train.Example(features=tf.train.Features(feature=feature))
 
 
-def gen_tf_image_example(img, label):
+def gen_tf_encoded_example(image_bytes, label):
+    """Example from an already encoded PNG/JPEG image, readable with tf.io.decode_image"""
     feature = {
-        'image': _bytes_feature(img),
+        'image': tf.train.Feature(bytes_list=tf.train.BytesList(value=[image_bytes])),
         'label': _bytes_feature_label(label)}
     return tf.train.Example(features=tf.train.Features(feature=feature))
 
 
-def create_tfr(npz_path, dest_folder='/tmp/tfrecords/', n_imgs_shard=800):
+def npz_array(npz_path, key):
+    """
+    Return a single array of an .npz file without reading it into memory
+
+    Uncompressed members (np.savez, make_datanpz) are memory mapped in place, the
+    zip member data is contiguous so only the local zip and .npy headers need parsing
+    """
+    with zipfile.ZipFile(npz_path) as zf:
+        info = zf.getinfo(key + '.npy')
+
+        if info.compress_type != zipfile.ZIP_STORED:
+            with zf.open(info) as f:
+                return np.lib.format.read_array(f)
+
+    with open(npz_path, 'rb') as f:
+        # Local file header is 30 bytes followed by the file name and extra field
+        f.seek(info.header_offset + 26)
+        name_len = int.from_bytes(f.read(2), 'little')
+        extra_len = int.from_bytes(f.read(2), 'little')
+
+        f.seek(info.header_offset + 30 + name_len + extra_len)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+
+        offset = f.tell()
+
+    if 0 in shape:
+        return np.empty(shape, dtype=dtype)
+
+    return np.memmap(npz_path, dtype=dtype, mode='r', shape=shape, offset=offset, order='F' if fortran_order else 'C')
+
+
+def write_shard(args):
+    """Write rows [start, end) of a split into a single tfrecords file"""
+    npz_path, split, start, end, path, encoding, compression = args
+
+    x = npz_array(npz_path, 'x_' + split)
+    y = npz_array(npz_path, 'y_' + split)
+
+    with tf.io.TFRecordWriter(path, options=tf.io.TFRecordOptions(compression_type=compression or '')) as writer:
+        for i in range(start, end):
+            tf_example = gen_tf_image_example(x[i], y[i], encoding)
+            writer.write(tf_example.SerializeToString())
+
+    return path
+
+
+def create_tfr(npz_path, dest_folder='/tmp/tfrecords/', n_imgs_shard=800,
+                splits=('train', 'test', 'val'),
+                encoding='png',
+                compression=None,
+                processes=None,
+                archive=None):
     """
     Converts a data.npz file with keys train, test, and val into a 3 tf records files (train, test, and val).
+
+    Splits larger than n_imgs_shard are written as several split_{i}.tfrecords shards.
+    Shards are encoded in parallel by a pool of `processes` workers (default: one per core)
+    each of which reads its rows straight from the memory mapped npz. Workers are forked,
+    so no TF op may have run in the calling process before.
+
+    encoding: png, jpeg or raw (tf.io.serialize_tensor) image bytes
+    compression: None or GZIP record compression
+    archive: optional assets.ZipUploader each shard is added to as soon as it is written,
+        otherwise the shards are zipped into /tmp/tfrecords.zip once all are done
+    """
+    if encoding not in ENCODINGS:
+        raise ValueError('encoding must be one of {}'.format(ENCODINGS))
+
+    if not os.path.isdir(dest_folder):
+        os.mkdir(dest_folder)
+
+    jobs = []
+    for split in splits:
+        count = npz_array(npz_path, 'y_' + split).shape[0]
+
+        if count > n_imgs_shard:
+            shards = np.array_split(np.arange(count), round(count / n_imgs_shard))
+
+            for i, shard in enumerate(shards):
+                path = dest_folder + '{}_{}.tfrecords'.format(split, i)
+                jobs.append((npz_path, split, int(shard[0]), int(shard[-1]) + 1, path, encoding, compression))
+        else:
+            path = dest_folder + '{}.tfrecords'.format(split)
+            jobs.append((npz_path, split, 0, count, path, encoding, compression))
+
+    # Workers are forked so they do not re-run the calling script. The TF runtime is not
+    # fork safe once started (its thread pools are not copied into the children), so the
+    # calling process must not have run any TF op before this point: importing tensorflow
+    # is fine, encoding an image or writing a record is not and can hang the workers
+    with multiprocessing.get_context('fork').Pool(processes=processes) as pool:
+        for path in pool.imap_unordered(write_shard, jobs):
+            print('ok - wrote {}'.format(path))
+
+            if archive is not None:
+                archive.add(path)
+
+    print('ok - tfrecords created for {}.'.format(', '.join(splits)))
+
+    if archive is None:
+        #zip up tf-records next to the folder ie /tmp/tfrecords.zip
+        shutil.make_archive(dest_folder.rstrip('/'), 'zip', dest_folder)
+
+
+def hash_split(tile, split_names, split_vals):
+    """Deterministically assign a tile to a split from the hash of its id"""
+    h = int.from_bytes(hashlib.sha256(tile.encode('utf-8')).digest()[:8], 'big') / 2 ** 64
+
+    for name, edge in zip(split_names, np.cumsum(split_vals)):
+        if h < edge:
+            return name
+
+    return split_names[-1]
+
+
+def passthrough(image_bytes, size):
+    """
+    Return image bytes as is if they are an RGB PNG/JPEG of the expected size,
+    otherwise decode them and re-encode as an RGB PNG
+    Only the image header is parsed in the common case
     """
+    img = Image.open(io.BytesIO(image_bytes))
+
+    if img.format in ('PNG', 'JPEG') and img.mode == 'RGB' and img.size == (size, size):
+        return image_bytes
+
+    img = img.convert('RGB')
+    if img.size != (size, size):
+        img = img.resize((size, size))
+
+    buf = io.BytesIO()
+    img.save(buf, 'PNG')
+    return buf.getvalue()
+
+
+def write_stream_shard(args):
+    """Download the chips of a single shard and write them straight into a tfrecords file"""
+    chips, labels_path, imagery, zoom, supertile, path, compression, workers = args
+
+    labels = np.load(labels_path)
+    session = get_session(workers)
+    size = 512 if supertile else 256
+
+    def download(chip):
+        try:
+            return passthrough(chip_bytes(chip, imagery, zoom, supertile, session), size)
+        except Exception as e:
+            print('not ok - failed to download {}: {}'.format(chip, e))
+
+    written = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        with tf.io.TFRecordWriter(path, options=tf.io.TFRecordOptions(compression_type=compression or '')) as writer:
+            for chip, image_bytes in zip(chips, pool.map(download, chips)):
+                if image_bytes is None:
+                    continue
+
+                writer.write(gen_tf_encoded_example(image_bytes, labels[chip]).SerializeToString())
+                written += 1
+
+    return path, written
+
+
+def stream_tfr(labels_folder, imagery, zoom, supertile,
+                dest_folder='/tmp/tfrecords/', n_imgs_shard=800,
+                split_names=('train', 'val', 'test'),
+                split_vals=(0.7, .2, .1),
+                compression=None,
+                processes=None,
+                workers=16,
+                archive=None):
+    """
+    Download the chips matching labels.npz straight into sharded tf records files,
+    skipping the intermediate tiles folder and data.npz
+
+    PNG/JPEG chips are stored as downloaded, without a decode and re-encode round trip.
+    Each tile is assigned to a split by a hash of its id, so splits are stable across runs.
+    Shards are written in parallel by `processes` workers each downloading with `workers` threads
+    and, like create_tfr, added to `archive` as soon as they are written if it is given
+    """
+    if len(split_names) != len(split_vals):
+        raise ValueError('`split_names` and `split_vals` must be the same '
+                            'length. Please update your config.')
+    if not np.isclose(sum(split_vals), 1):
+        raise ValueError('`split_vals` must sum to one. Please update your config.')
+
     if not os.path.isdir(dest_folder):
         os.mkdir(dest_folder)
 
-    npz = np.load(npz_path)
-    train_shp = npz['y_train'].shape[0]
-
-    if train_shp > n_imgs_shard:
-        train_shards_num = round(train_shp / n_imgs_shard)
-        train_split_x = np.array_split(npz['x_train'], train_shards_num)
-        train_split_y = np.array_split(npz['y_train'], train_shards_num)
-
-        for i in np.arange(0, train_shards_num):
-            path = dest_folder + 'train_{}.tfrecords'.format(i)
-            with tf.io.TFRecordWriter(path) as writer:
-                z = zip(train_split_x[i], train_split_y[i])
-                for img, label in z:
-                    tf_example = gen_tf_image_example(img, label)
-                    writer.write(tf_example.SerializeToString())
-        print('ok - tfrecords created for train.')
-    else:
-        path = dest_folder + 'train.tfrecords'
-        with tf.io.TFRecordWriter(path) as writer:
-            z = zip(npz['x_train'], npz['y_train'])
-            for img, label in z:
-                tf_example = gen_tf_image_example(img, label)
-                writer.write(tf_example.SerializeToString())
-            print('ok - tfrecords created for train.')
-
-    test_shp = npz['y_test'].shape[0]
-    if test_shp > n_imgs_shard:
-        test_shards_num = round(test_shp / n_imgs_shard)
-        test_split_x = np.array_split(npz['x_test'], test_shards_num)
-        test_split_y = np.array_split(npz['y_test'], test_shards_num)
-
-        for i in np.arange(0, test_shards_num):
-            path = dest_folder + 'test_{}.tfrecords'.format(i)
-            with tf.io.TFRecordWriter(path) as writer:
-                z = zip(test_split_x[i], test_split_y[i])
-                for img, label in z:
-                    tf_example = gen_tf_image_example(img, label)
-                    writer.write(tf_example.SerializeToString())
-        print('ok - tfrecords created for test.')
-
-    else:
-        path = dest_folder + 'test.tfrecords'
-        with tf.io.TFRecordWriter(path) as writer:
-            z = zip(npz['x_test'], npz['y_test'])
-            for img, label in z:
-                tf_example = gen_tf_image_example(img, label)
-                writer.write(tf_example.SerializeToString())
-            print('ok - tfrecords created for test.')
-
-    val_shp = npz['y_val'].shape[0]
-    if val_shp > n_imgs_shard:
-        val_shards_num = round(val_shp / n_imgs_shard)
-        val_split_x = np.array_split(npz['x_val'], val_shards_num)
-        val_split_y = np.array_split(npz['y_val'], val_shards_num)
-
-        for i in np.arange(0, val_shards_num):
-            path = dest_folder + 'val_{}.tfrecords'.format(i)
-            with tf.io.TFRecordWriter(path) as writer:
-                z = zip(val_split_x[i], val_split_y[i])
-                for img, label in z:
-                    tf_example = gen_tf_image_example(img, label)
-                    writer.write(tf_example.SerializeToString())
-        print('ok - tfrecords created for val.')
-    else:
-        path = dest_folder + 'val.tfrecords'
-        with tf.io.TFRecordWriter(path) as writer:
-            z = zip(npz['x_val'], npz['y_val'])
-            for img, label in z:
-                tf_example = gen_tf_image_example(img, label)
-                writer.write(tf_example.SerializeToString())
-        print('ok - tfrecords created for val.')
-
-    #zip up tf-records
-    shutil.make_archive(dest_folder, 'zip', dest_folder)
+    labels_path = os.path.join(labels_folder, 'labels.npz')
+    tiles = sorted(np.load(labels_path).files)
+
+    if imagery['fmt'] != 'wms':
+        # we often don't have images for each label (e.g. background tiles)
+        tiles = [tile for tile in tiles if tile in imagery['imglist']]
+
+    splits = {name: [] for name in split_names}
+    for tile in tiles:
+        splits[hash_split(tile, split_names, split_vals)].append(tile)
+
+    jobs = []
+    for split, chips in splits.items():
+        if len(chips) > n_imgs_shard:
+            for i, shard in enumerate(np.array_split(np.array(chips), round(len(chips) / n_imgs_shard))):
+                path = dest_folder + '{}_{}.tfrecords'.format(split, i)
+                jobs.append((list(shard), labels_path, imagery, zoom, supertile, path, compression, workers))
+        else:
+            path = dest_folder + '{}.tfrecords'.format(split)
+            jobs.append((chips, labels_path, imagery, zoom, supertile, path, compression, workers))
+
+    # Forked like create_tfr, so no TF op may have run in the calling process before this point
+    with multiprocessing.get_context('fork').Pool(processes=processes) as pool:
+        for path, written in pool.imap_unordered(write_stream_shard, jobs):
+            print('ok - wrote {} records to {}'.format(written, path))
+
+            if archive is not None:
+                archive.add(path)
+
+    print('ok - tfrecords created for {}.'.format(', '.join(split_names)))
+
+    if archive is None:
+        #zip up tf-records next to the folder ie /tmp/tfrecords.zip
+        shutil.make_archive(dest_folder.rstrip('/'), 'zip', dest_folder)
@@ -10,9 +10,10 @@ from requests_toolbelt.multipart.encoder import MultipartEncoder
 from requests_toolbelt.utils import dump
 from zipfile import ZipFile
 from imagery import chiplist
+from assets import S3Reader, ZipUploader
 
 from generate_datanpz import download_img_match_labels, make_datanpz
-from generate_tfrecords import create_tfr
+from generate_tfrecords import create_tfr, stream_tfr
 
 s3 = boto3.client('s3')
 
@@ -44,15 +45,11 @@ def get_imagery(model_id, imagery_id):
 def get_asset(bucket, key):
     print('ok - downloading: ' + bucket + '/' + key)
     parsed = key.split('/')
-    obj = s3.download_file(
-        Filename='/tmp/' + parsed[len(parsed) - 1],
-        Bucket=bucket,
-        Key=key
-    )
 
     dirr =  parsed[len(parsed) - 1].replace('.zip', '')
-    with ZipFile('/tmp/' + parsed[len(parsed) - 1], 'r') as zipObj:
-       # Extract all the contents of zip file in different directory
+
+    # Extract straight from S3 with ranged reads, the zip itself never touches disk
+    with ZipFile(S3Reader(bucket, key, s3=s3), 'r') as zipObj:
           zipObj.extractall('/tmp/' + dirr)
 
     return '/tmp/' + dirr
@@ -83,6 +80,22 @@ def update_link(pred, link_type, zip_path):
 
     r.raise_for_status()
 
+def asset_key(pred, link_type):
+    return 'project/{}/iteration/{}/{}.zip'.format(pred['modelId'], pred['predictionsId'], link_type)
+
+def set_link(pred, link_type, key):
+    model_id = pred['modelId']
+    prediction_id = pred['predictionsId']
+    print('ok - saving {}_link: {}'.format(link_type, key))
+
+    r = requests.patch(
+        api + '/v1/model/' + str(model_id) + '/prediction/' + str(prediction_id),
+        json = {link_type + '_link': key},
+        auth=HTTPBasicAuth('machine', auth)
+    )
+
+    r.raise_for_status()
+
 def get_versions(model_id):
     r = requests.get(api + '/v1/model/' + model_id + '/prediction/all', auth=HTTPBasicAuth('machine', auth))
     r.raise_for_status()
@@ -110,21 +123,42 @@ v = get_versions(model_id)
 
 get_label_npz(model_id, prediction_id)
 
-# download image tiles that match validated labels.npz file
-download_img_match_labels(
-    labels_folder='/tmp',
-    imagery=imagery,
-    folder='/tmp/tiles',
-    zoom=zoom,
-    supertile=supertile
-)
-
-# create data.npz file that matchs up images and labels
-make_datanpz(dest_folder='/tmp', imagery=imagery, supertile=supertile)
-
-
-#convert data.npz into tf-records
-create_tfr(npz_path='/tmp/data.npz')
+def build_tfrecords(archive=None):
+    if os.getenv('TFRECORD_STREAM') == 'True':
+        # download image tiles that match validated labels.npz file straight into tf-records
+        stream_tfr(
+            labels_folder='/tmp',
+            imagery=imagery,
+            zoom=zoom,
+            supertile=supertile,
+            archive=archive
+        )
+    else:
+        # download image tiles that match validated labels.npz file
+        download_img_match_labels(
+            labels_folder='/tmp',
+            imagery=imagery,
+            folder='/tmp/tiles',
+            zoom=zoom,
+            supertile=supertile
+        )
+
+        # create data.npz file that matchs up images and labels
+        make_datanpz(dest_folder='/tmp', imagery=imagery, supertile=supertile)
+
+        #convert data.npz into tf-records
+        create_tfr(npz_path='/tmp/data.npz', archive=archive)
+
+if bucket:
+    # each shard is zipped into an S3 multipart upload as soon as it is written
+    key = asset_key(pred, 'tfrecord')
+    with ZipUploader(bucket, key) as archive:
+        build_tfrecords(archive)
+
+    set_link(pred, link_type='tfrecord', key=key)
+else:
+    build_tfrecords()
+
+    update_link(pred, link_type='tfrecord', zip_path = '/tmp/tfrecords.zip')
 
-update_link(pred, link_type='tfrecord', zip_path = '/tmp/tfrecords.zip')
 print("ok - tfrecords link updated")
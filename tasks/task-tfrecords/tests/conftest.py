@@ -0,0 +1,8 @@
+import os
+import sys
+
+# boto3 clients are created when the task modules are imported
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+# The tile cache is shared with the prediction lambda, the Dockerfile copies it in
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'lambda', 'download_and_predict'))
@@ -0,0 +1,149 @@
+import io
+import os
+import zipfile
+import threading
+import pytest
+import assets
+
+from assets import MultipartWriter, ZipUploader, S3Reader
+
+MB = 1024 * 1024
+
+class StubS3:
+    """Stand-in for the S3 client holding multipart uploads and objects in memory"""
+
+    def __init__(self, fail_part=None):
+        self.lock = threading.Lock()
+        self.fail_part = fail_part
+
+        self.parts = {}
+        self.objects = {}
+        self.aborted = []
+        self.ranges = []
+
+    def create_multipart_upload(self, Bucket, Key):
+        return { 'UploadId': 'upload' }
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        if PartNumber == self.fail_part:
+            raise Exception('upload failed')
+
+        with self.lock:
+            self.parts[PartNumber] = Body
+
+        return { 'ETag': 'etag-{}'.format(PartNumber) }
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = MultipartUpload['Parts']
+
+        assert([part['PartNumber'] for part in parts] == list(range(1, len(parts) + 1)))
+        assert([part['ETag'] for part in parts] == ['etag-{}'.format(part['PartNumber']) for part in parts])
+
+        self.objects[(Bucket, Key)] = b''.join(self.parts[part['PartNumber']] for part in parts)
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted.append((Bucket, Key))
+
+    def head_object(self, Bucket, Key):
+        return { 'ContentLength': len(self.objects[(Bucket, Key)]) }
+
+    def get_object(self, Bucket, Key, Range):
+        start, end = map(int, Range[len('bytes='):].split('-'))
+        self.ranges.append((start, end))
+
+        return { 'Body': io.BytesIO(self.objects[(Bucket, Key)][start:end + 1]) }
+
+@pytest.fixture
+def s3(monkeypatch):
+    stub = StubS3()
+    monkeypatch.setattr(assets.boto3, 'client', lambda *args, **kwargs: stub)
+    return stub
+
+@pytest.mark.parametrize('size,parts', [
+    (0, [0]),
+    (5 * MB, [5 * MB]),
+    (5 * MB + 1, [5 * MB, 1]),
+    (12 * MB, [5 * MB, 5 * MB, 2 * MB])
+])
+def test_part_boundaries(s3, size, parts):
+    data = os.urandom(size)
+
+    writer = MultipartWriter('bucket', 'key', part_size=5 * MB, concurrency=2)
+
+    # Writes of odd sizes straddle the part boundaries
+    for start in range(0, size, 777777):
+        writer.write(data[start:start + 777777])
+    writer.close()
+
+    assert(writer.tell() == size)
+    assert([len(s3.parts[number]) for number in sorted(s3.parts)] == parts)
+    assert(s3.objects[('bucket', 'key')] == data)
+
+def test_min_part_size(s3):
+    with pytest.raises(ValueError):
+        MultipartWriter('bucket', 'key', part_size=MB)
+
+def test_abort_failed_part(s3):
+    s3.fail_part = 2
+
+    writer = MultipartWriter('bucket', 'key', part_size=5 * MB, concurrency=2)
+    writer.write(os.urandom(11 * MB))
+
+    with pytest.raises(Exception, match='upload failed'):
+        writer.close()
+
+    assert(s3.aborted == [('bucket', 'key')])
+    assert(('bucket', 'key') not in s3.objects)
+
+def test_zip_abort(s3, tmp_path):
+    path = str(tmp_path / 'train.tfrecords')
+    with open(path, 'wb') as f:
+        f.write(b'records')
+
+    with pytest.raises(RuntimeError):
+        with ZipUploader('bucket', 'tfrecords.zip') as archive:
+            archive.add(path)
+            raise RuntimeError('shard failed')
+
+    assert(s3.aborted == [('bucket', 'tfrecords.zip')])
+    assert(('bucket', 'tfrecords.zip') not in s3.objects)
+
+def test_zip_round_trip(s3, tmp_path):
+    members = {}
+    for i, size in enumerate([0, 1000, 6 * MB + 3]):
+        name = 'train_{}.tfrecords'.format(i)
+        members[name] = os.urandom(size)
+
+        with open(str(tmp_path / name), 'wb') as f:
+            f.write(members[name])
+
+    with ZipUploader('bucket', 'tfrecords.zip', part_size=5 * MB) as archive:
+        for name in sorted(members):
+            archive.add(str(tmp_path / name))
+
+    assert(len(s3.parts) == 2)
+
+    # Members are extracted through ranged reads, never the whole object at once
+    reader = S3Reader('bucket', 'tfrecords.zip', block_size=MB, s3=s3)
+    with zipfile.ZipFile(reader) as zf:
+        assert(sorted(zf.namelist()) == sorted(members))
+        assert(all(info.compress_type == zipfile.ZIP_STORED for info in zf.infolist()))
+
+        for name, data in members.items():
+            assert(zf.read(name) == data)
+
+    size = len(s3.objects[('bucket', 'tfrecords.zip')])
+    assert(all(start <= end < size for start, end in s3.ranges))
+    assert(max(end - start + 1 for start, end in s3.ranges) < size)
+
+def test_reader_seek(s3):
+    s3.objects[('bucket', 'key')] = bytes(range(256)) * 10
+
+    reader = S3Reader('bucket', 'key', block_size=100, s3=s3)
+
+    assert(reader.read(10) == bytes(range(10)))
+    reader.seek(-6, io.SEEK_END)
+    assert(reader.read() == bytes(range(250, 256)))
+    reader.seek(300)
+    assert(reader.read(4) == bytes(range(44, 48)))
+    assert(reader.tell() == 304)
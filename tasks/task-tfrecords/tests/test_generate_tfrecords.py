@@ -0,0 +1,143 @@
+import io
+import os
+import struct
+import threading
+import pytest
+import numpy as np
+
+from PIL import Image
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+# Only imported here, shards are encoded by forked workers so no TF op may run in this process
+pytest.importorskip('tensorflow')
+
+import tensorflow as tf
+
+from generate_tfrecords import npz_array, create_tfr, hash_split, stream_tfr
+
+def records(path):
+    """Raw records of a tfrecords file, read without TF"""
+    out = []
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(12)
+            if len(header) == 0:
+                break
+
+            length = struct.unpack('<Q', header[:8])[0]
+            out.append(f.read(length))
+            f.read(4)
+
+    return out
+
+def arrays():
+    rng = np.random.RandomState(0)
+
+    return {
+        'x_train': rng.randint(0, 256, (30, 8, 8, 3)).astype(np.uint8),
+        'y_train': rng.randint(0, 2, (30, 2)),
+        'x_test': rng.randint(0, 256, (5, 8, 8, 3)).astype(np.uint8),
+        'y_test': rng.randint(0, 2, (5, 2)),
+        'x_val': np.asfortranarray(rng.randint(0, 256, (3, 8, 8, 3)).astype(np.uint8)),
+        'y_val': rng.rand(3, 2).astype(np.float32),
+        'empty': np.zeros((0, 8), dtype=np.int64)
+    }
+
+@pytest.mark.parametrize('save', [np.savez, np.savez_compressed])
+def test_npz_array(tmp_path, save):
+    path = str(tmp_path / 'data.npz')
+    save(path, **arrays())
+
+    npz = np.load(path)
+    for key in npz.files:
+        value = npz_array(path, key)
+
+        assert(value.dtype == npz[key].dtype)
+        assert(value.shape == npz[key].shape)
+        assert((value == npz[key]).all())
+
+    # Stored members are memory mapped rather than read
+    assert(isinstance(npz_array(path, 'x_train'), np.memmap) == (save is np.savez))
+
+def test_create_tfr_parallel(tmp_path):
+    path = str(tmp_path / 'data.npz')
+    np.savez(path, **arrays())
+
+    serial = str(tmp_path / 'serial') + '/'
+    parallel = str(tmp_path / 'parallel') + '/'
+
+    create_tfr(path, dest_folder=serial, n_imgs_shard=8, processes=1)
+    create_tfr(path, dest_folder=parallel, n_imgs_shard=8, processes=3)
+
+    files = sorted(name for name in os.listdir(serial))
+    assert(files == ['test.tfrecords', 'train_0.tfrecords', 'train_1.tfrecords', 'train_2.tfrecords', 'train_3.tfrecords', 'val.tfrecords'])
+    assert(sorted(os.listdir(parallel)) == files)
+
+    for name in files:
+        assert(records(serial + name) == records(parallel + name))
+
+    assert(sum(len(records(serial + name)) for name in files if name.startswith('train')) == 30)
+    assert(os.path.exists(str(tmp_path / 'serial.zip')))
+
+def test_hash_split():
+    tiles = ['{}-{}-14'.format(x, y) for x in range(100) for y in range(100)]
+    names, vals = ('train', 'val', 'test'), (0.7, 0.2, 0.1)
+
+    splits = [hash_split(tile, names, vals) for tile in tiles]
+
+    # Same split whatever the order or run
+    assert([hash_split(tile, names, vals) for tile in reversed(tiles)] == splits[::-1])
+
+    for name, val in zip(names, vals):
+        assert(abs(splits.count(name) / len(tiles) - val) < 0.02)
+
+def tile_server():
+    """Serve a PNG coloured by x for /{z}/{x}/{y}.png"""
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            x = int(self.path.split('/')[2])
+
+            buf = io.BytesIO()
+            Image.new('RGB', (256, 256), (x, 0, 0)).save(buf, 'PNG')
+
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(buf.getvalue())))
+            self.end_headers()
+            self.wfile.write(buf.getvalue())
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, 'http://127.0.0.1:{}/{{z}}/{{x}}/{{y}}.png'.format(server.server_address[1])
+
+def test_stream_tfr(tmp_path):
+    tiles = ['{}-0-14'.format(x) for x in range(30)]
+    np.savez(str(tmp_path / 'labels.npz'), **dict((tile, np.array([0, 1])) for tile in tiles))
+
+    server, url = tile_server()
+    dest = str(tmp_path / 'tfrecords') + '/'
+
+    try:
+        stream_tfr(str(tmp_path), { 'fmt': 'wms', 'url': url }, 14, False, dest_folder=dest, n_imgs_shard=5, processes=2, workers=2)
+    finally:
+        server.shutdown()
+
+    # Tiles are in the split their id hashes to, PNGs of the expected size as served
+    written = {}
+    for name in os.listdir(dest):
+        for record in records(dest + name):
+            image = tf.train.Example.FromString(record).features.feature['image'].bytes_list.value[0]
+            written.setdefault(name.split('.')[0].split('_')[0], []).append(Image.open(io.BytesIO(image)).getpixel((0, 0))[0])
+
+    expected = {}
+    for x, tile in enumerate(tiles):
+        expected.setdefault(hash_split(tile, ('train', 'val', 'test'), (0.7, .2, .1)), []).append(x)
+
+    assert(dict((split, sorted(xs)) for split, xs in written.items()) == expected)
@@ -1,4 +1,5 @@
 import fs from 'fs';
+import zlib from 'zlib';
 import path from 'path';
 import RL from 'readline';
 import MBTiles from './mbtiles.js';
@@ -83,7 +84,11 @@ class B64PNG {
 
             bbox.tile(line.z, line.x, line.y);
 
-            await mbtiles.putTile(line.z, line.x, line.y, this.color(new Buffer.from(line.image, 'base64')));
+            if (line.encoding === 'rle') {
+                await mbtiles.putTile(line.z, line.x, line.y, this.colorMask(line.shape[1], line.shape[0], B64PNG.unrle(line.rle, line.shape)));
+            } else {
+                await mbtiles.putTile(line.z, line.x, line.y, this.color(new Buffer.from(line.image, 'base64')));
+            }
         }
 
         if (!opts.silent) console.log('ok - finished writing base tiles');
@@ -198,6 +203,61 @@ class B64PNG {
         return Buffer.from(png);
     }
 
+    /**
+     * Given a class ID mask, add colours based on class IDs
+     *
+     * @param {Number}      width   Mask width
+     * @param {Number}      height  Mask height
+     * @param {Uint8Array}  data    Row major class IDs
+     * @return {Buffer} PNG Buffer with palette
+     */
+    colorMask(width, height, data) {
+        const png = exportPNG(loadPNGFromPalette({
+            width,
+            height,
+            data,
+            depth: 8,
+            palette: this.palette
+        }));
+
+        return Buffer.from(png);
+    }
+
+    /**
+     * Decode a run length encoded class mask written by the prediction lambda
+     *
+     * Runs are a class byte followed by an unsigned LEB128 varint length,
+     * deflated and base64 encoded
+     *
+     * @param {string}      rle     Encoded mask
+     * @param {Number[]}    shape   [height, width] of the mask
+     * @return {Uint8Array} Row major class IDs
+     */
+    static unrle(rle, shape) {
+        const data = zlib.inflateSync(Buffer.from(rle, 'base64'));
+        const mask = new Uint8Array(shape[0] * shape[1]);
+
+        let i = 0;
+        let pos = 0;
+        while (i < data.length) {
+            const value = data[i++];
+
+            let length = 0;
+            let shift = 0;
+            let byte;
+            do {
+                byte = data[i++];
+                length += (byte & 0x7F) * Math.pow(2, shift);
+                shift += 7;
+            } while (byte >= 0x80);
+
+            mask.fill(value, pos, pos + length);
+            pos += length;
+        }
+
+        return mask;
+    }
+
     class_mean(values) {
         const value = values.sort((a,b) => {
             values.filter((v) => v === a).length - values.filter((v) => v === b).length;